@@ -0,0 +1,339 @@
+#!/usr/bin/env python2
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "ramsay"))
+import ramsay  # noqa: E402
+
+"""
+Benchmarks Ramsay's pipeline on synthetic Bazel workspaces.
+
+The workspace is generated from a seed, so runs with the same parameters process the same code. Third-party modules
+are stubbed and Bazel is never run. Every phase of the pipeline is timed separately, the results are written as JSON
+and can be compared against a stored baseline to catch regressions.
+"""
+
+PHASES = ["config", "read", "parse", "filter", "reify", "resolve", "synthesize", "build", "render", "format"]
+
+SYSTEM_IMPORTS = ["os", "sys", "json", "logging", "collections", "re", "time"]
+
+
+class SyntheticWorkspace:
+    """
+    A generated Bazel workspace. Packages are nested `depth` levels deep (p000/p000_000/...) and each package has
+    `modules` modules, every third of them a test module, with `imports` imports each. Of the imports,
+    `relative_share` are relative imports of sibling modules, a tenth refer to third-party modules and the rest are
+    absolute imports of modules in other packages or of system modules.
+    """
+
+    def __init__(self, root, packages, modules, imports, depth, relative_share, pattern_deps, third_party, seed):
+        self.root = root
+        self.packages = packages
+        self.modules = modules
+        self.imports = imports
+        self.depth = depth
+        self.relative_share = relative_share
+        self.pattern_deps = pattern_deps
+        self.third_party = third_party
+        self.seed = seed
+        self.package_dirpaths = []
+        self.third_party_modules = set("tp_{:03d}".format(i) for i in xrange(third_party))
+
+    @classmethod
+    def from_args(cls, root, args):
+        # type: (str, argparse.Namespace) -> SyntheticWorkspace
+        return SyntheticWorkspace(root, args.packages, args.modules, args.imports, args.depth, args.relative_share,
+                args.pattern_deps, args.third_party, args.seed)
+
+    def params(self):
+        # type: () -> dict
+        return {
+            "packages": self.packages,
+            "modules": self.modules,
+            "imports": self.imports,
+            "depth": self.depth,
+            "relative_share": self.relative_share,
+            "pattern_deps": self.pattern_deps,
+            "third_party": self.third_party,
+            "seed": self.seed,
+        }
+
+    def generate(self):
+        # type: () -> None
+        rng = random.Random(self.seed)
+        with open(os.path.join(self.root, "WORKSPACE"), "w") as fp:
+            fp.write('workspace(name = "synthetic")\n')
+        self._write_ramsayrc()
+
+        package_names = []
+        for i in xrange(self.packages):
+            components = ["p{:03d}".format(i)]
+            for level in xrange(1, self.depth):
+                components.append("{}_{:03d}".format(components[-1], level))
+            package_names.append(components)
+
+        for components in package_names:
+            dirpath = self.root
+            for component in components:
+                dirpath = os.path.join(dirpath, component)
+                if not os.path.isdir(dirpath):
+                    os.mkdir(dirpath)
+                    open(os.path.join(dirpath, "__init__.py"), "w").close()
+            self.package_dirpaths.append(dirpath)
+            for j in xrange(self.modules):
+                with open(os.path.join(dirpath, self._module_filename(j)), "w") as fp:
+                    fp.write(self._module_code(rng, package_names, j))
+
+    def _write_ramsayrc(self):
+        # type: () -> None
+        # .ramsayrc files are YAML, but JSON is a subset of it and doesn't need a YAML library to be written.
+        pattern_deps = {}
+        for i in xrange(self.pattern_deps):
+            pattern_deps["^(test_)?mod_{:03d}\\.py$".format(i)] = {
+                "manual_dependencies": ["//p{:03d}:__init___py".format(i % max(self.packages, 1))],
+            }
+        # the third-party modules are listed as well, so that a kept workspace can be processed by ramsay itself.
+        with open(os.path.join(self.root, ramsay.Config.FILENAME), "w") as fp:
+            json.dump({"pattern_deps": pattern_deps, "third_party_modules": sorted(self.third_party_modules)}, fp,
+                      indent=2, sort_keys=True)
+
+    def _module_filename(self, j):
+        # type: (int) -> str
+        if j % 3 == 2:
+            return "test_mod_{:03d}.py".format(j)
+        return "mod_{:03d}.py".format(j)
+
+    def _module_code(self, rng, package_names, j):
+        # type: (random.Random, list, int) -> str
+        lines = []
+        for _ in xrange(self.imports):
+            roll = rng.random()
+            if roll < self.relative_share and self.modules > 1:
+                sibling = rng.choice([k for k in xrange(self.modules) if k != j])
+                lines.append("from . import {}".format(self._module_filename(sibling)[:-len(".py")]))
+            elif roll < self.relative_share + 0.1 and self.third_party_modules:
+                lines.append("import {}".format(rng.choice(sorted(self.third_party_modules))))
+            elif roll < self.relative_share + 0.3:
+                lines.append("import {}".format(rng.choice(SYSTEM_IMPORTS)))
+            else:
+                components = rng.choice(package_names)
+                module = self._module_filename(rng.randrange(self.modules))[:-len(".py")]
+                lines.append("from {} import {}".format(".".join(components), module))
+        lines.append("")
+        lines.append("")
+        lines.append("def function_{:03d}(value):".format(j))
+        lines.append("    if value:")
+        lines.append("        return [item for item in value]")
+        lines.append("    return None")
+        lines.append("")
+        return "\n".join(lines)
+
+
+class Benchmark:
+    """
+    Runs Ramsay's pipeline phase by phase for every package of a synthetic workspace.
+    """
+
+    def __init__(self, workspace, repeat, format_with_yapf):
+        self.workspace = workspace
+        self.repeat = repeat
+        self.format_with_yapf = format_with_yapf
+
+    def run(self):
+        # type: () -> dict
+        """
+        Returns the minimum and median seconds each phase took over all packages of the workspace.
+        """
+        samples = {phase: [] for phase in PHASES}
+        for _ in xrange(self.repeat):
+            timings = dict.fromkeys(PHASES, 0.0)
+            for dirpath in self.workspace.package_dirpaths:
+                self._run_package(dirpath, timings)
+            for phase, seconds in timings.iteritems():
+                samples[phase].append(seconds)
+
+        phases = {}
+        for phase in PHASES:
+            if phase == "format" and not self.format_with_yapf:
+                continue
+            values = sorted(samples[phase])
+            phases[phase] = {"min": values[0], "median": values[len(values) // 2]}
+        return phases
+
+    def _run_package(self, dirpath, timings):
+        # type: (str, dict) -> None
+        cwd = os.getcwd()
+        os.chdir(dirpath)
+        try:
+            filepaths = sorted(filename for filename in os.listdir(".") if filename.endswith(".py"))
+            args = ramsay.parse_args(
+                ["ramsay", "--workspace-dir", self.workspace.root, "--no-cache", "--no-daemon"] + filepaths)
+
+            start = time.time()
+            config = ramsay.Config.from_args(args, {module: module for module in self.workspace.third_party_modules})
+            workspace = ramsay.Workspace.from_config(config)
+            generator = ramsay.Ramsay.from_config(workspace, config)
+            timings["config"] += self._lap(start)
+
+            start = time.time()
+            # the stages stream one file at a time in ramsay; here each stage runs over all files to time it on its own.
+            sources = list(generator._read_code_files(generator._filter_ignored_files(filepaths)))
+            timings["read"] += self._lap(start)
+
+            start = time.time()
+            codes = [(filepath, generator._parse_code_file(filepath, data)) for filepath, data in sources]
+            timings["parse"] += self._lap(start)
+
+            start = time.time()
+            import_nodes = [(filepath, ramsay.Ramsay.find_import_nodes(filepath, code, config.allow_scoped_imports))
+                            for filepath, code in codes]
+            timings["filter"] += self._lap(start)
+
+            start = time.time()
+            import_stmts = [(filepath, generator._reify_import_nodes(filepath, nodes), (0, 0))
+                            for filepath, nodes in import_nodes]
+            timings["reify"] += self._lap(start)
+
+            start = time.time()
+            imports_sourcemap = {filepath: resolved_imports for filepath, resolved_imports, test_count
+                                 in generator._resolve_import_stmts(import_stmts)}
+            timings["resolve"] += self._lap(start)
+
+            start = time.time()
+            imports_sourcemap = generator._synthesize_imports(imports_sourcemap)
+            imports_sourcemap = generator._synthesize_dependencies(imports_sourcemap)
+            imports_sourcemap = generator._apply_pattern_deps(imports_sourcemap)
+            timings["synthesize"] += self._lap(start)
+
+            start = time.time()
+            build_template = ramsay.BazelBuildTemplate()
+            generator._append_header(build_template)
+            generator._build_library_targets(imports_sourcemap, build_template)
+            generator._build_test_targets(imports_sourcemap, build_template)
+            generator._build_shared_library_target(imports_sourcemap, build_template)
+            generator._build_test_suite_target(imports_sourcemap, build_template)
+            generator._append_footer(build_template)
+            timings["build"] += self._lap(start)
+
+            start = time.time()
+            ramsay.StarlarkEmitter(StringIO()).emit(build_template)
+            timings["render"] += self._lap(start)
+
+            if self.format_with_yapf:
+                from yapf.yapflib.yapf_api import FormatCode
+                contents = str(build_template)
+                start = time.time()
+                FormatCode(contents)
+                timings["format"] += self._lap(start)
+        finally:
+            os.chdir(cwd)
+
+    def _lap(self, start):
+        # type: (float) -> float
+        return time.time() - start
+
+
+def compare(results, baseline, threshold, min_delta):
+    # type: (dict, dict, float, float) -> list
+    """
+    Returns a description of every phase whose median is more than `threshold` (a fraction) and at least `min_delta`
+    seconds slower than in the baseline.
+    """
+    regressions = []
+    if results["workspace"] != baseline.get("workspace"):
+        sys.stderr.write("warning: the baseline was measured with different workspace parameters\n")
+    for phase, timing in sorted(results["phases"].iteritems()):
+        baseline_timing = baseline.get("phases", {}).get(phase)
+        if baseline_timing is None:
+            continue
+        current, previous = timing["median"], baseline_timing["median"]
+        if current > previous * (1 + threshold) and current - previous >= min_delta:
+            regressions.append("{}: {:.1f} ms -> {:.1f} ms ({:+.0f}%)".format(
+                phase, previous * 1000, current * 1000, (current / previous - 1) * 100 if previous else float("inf")))
+    return regressions
+
+
+def parse_args(argv):
+    # type: (list) -> argparse.Namespace
+    parser = argparse.ArgumentParser(description="Benchmarks Ramsay on a synthetic Bazel workspace.")
+    parser.add_argument("--packages", metavar="N", type=int, default=20, help="number of packages (default: 20)")
+    parser.add_argument("--modules", metavar="N", type=int, default=15,
+                        help="number of modules per package (default: 15)")
+    parser.add_argument("--imports", metavar="N", type=int, default=10,
+                        help="number of imports per module (default: 10)")
+    parser.add_argument("--depth", metavar="N", type=int, default=2,
+                        help="nesting depth of the packages (default: 2)")
+    parser.add_argument("--relative-share", metavar="FRACTION", dest="relative_share", type=float, default=0.2,
+                        help="share of relative imports (default: 0.2)")
+    parser.add_argument("--pattern-deps", metavar="N", dest="pattern_deps", type=int, default=10,
+                        help="number of pattern_deps entries in the workspace's .ramsayrc (default: 10)")
+    parser.add_argument("--third-party", metavar="N", dest="third_party", type=int, default=50,
+                        help="number of stubbed third-party modules (default: 50)")
+    parser.add_argument("--seed", metavar="N", type=int, default=0, help="seeds the workspace generator (default: 0)")
+    parser.add_argument("--repeat", metavar="N", type=int, default=5,
+                        help="runs the pipeline N times and reports the min and median (default: 5)")
+    parser.add_argument("--no-format", dest="format_with_yapf", action="store_false", default=True,
+                        help="skips the yapf format phase")
+    parser.add_argument("--output", metavar="FILE", type=str, default=None,
+                        help="writes the results to FILE instead of stdout")
+    parser.add_argument("--baseline", metavar="FILE", type=str, default=None,
+                        help="compares the results to FILE and exits with 1 on regressions")
+    parser.add_argument("--threshold", metavar="FRACTION", type=float, default=0.2,
+                        help="slowdown of a phase's median that counts as a regression (default: 0.2)")
+    parser.add_argument("--min-delta", metavar="SECONDS", dest="min_delta", type=float, default=0.005,
+                        help="ignores slowdowns smaller than this, as they're mostly noise (default: 0.005)")
+    parser.add_argument("--keep", metavar="DIR", type=str, default=None,
+                        help="generates the workspace in DIR and keeps it")
+    return parser.parse_args(argv[1:])
+
+
+def main(argv):
+    # type: (list) -> int
+    args = parse_args(argv)
+    root = os.path.realpath(args.keep) if args.keep else tempfile.mkdtemp(prefix="ramsay-bench-")
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    try:
+        workspace = SyntheticWorkspace.from_args(root, args)
+        workspace.generate()
+        phases = Benchmark(workspace, args.repeat, args.format_with_yapf).run()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    results = {
+        "python": platform.python_version(),
+        "workspace": workspace.params(),
+        "repeat": args.repeat,
+        "phases": phases,
+        "total": {"median": sum(timing["median"] for timing in phases.itervalues())},
+    }
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        for regression in regressions:
+            sys.stderr.write("regression: {}\n".format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,16 +1,44 @@
 #!/usr/bin/env python2
+import SocketServer
 import argparse
 import ast
+import collections
+import contextlib
+import copy
+import ctypes
+import ctypes.util
+import difflib
+import errno
+import hashlib
 import imp
-import jinja2
+import json
 import logging
+import multiprocessing
 import operator
 import os
 import re
+import select
+import socket
 import subprocess
+import sqlite3
+import stat
+import struct
 import sys
-from ruamel.yaml import YAML
-from yapf.yapflib.yapf_api import FormatCode
+import tempfile
+import threading
+import time
+import tokenize
+import traceback
+import xml.etree.cElementTree as ElementTree
+import zipfile
+from cStringIO import StringIO
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 """
 Ramsay is the Bazel BUILD file generator for python.
@@ -47,22 +75,576 @@ SYSTEM_MODULES = [
     "user", "UserDict", "UserList", "UserString", "uu", "uuid", "videoreader", "W", "warnings", "wave", "weakref",
     "webbrowser", "whichdb", "winsound", "wsgiref", "xdrlib", "xml", "xmlrpclib", "zipfile", "zipimport", "zlib"]
 
-yaml = YAML(typ="safe")
+# Source: https://docs.python.org/3/py-modindex.html
+PYTHON3_SYSTEM_MODULES = [
+    "__future__", "__main__", "_thread", "abc", "aifc", "antigravity", "argparse", "array", "ast", "asynchat",
+    "asyncio", "asyncore", "atexit", "audioop", "base64", "bdb", "binascii", "bisect", "builtins", "bz2", "calendar",
+    "cgi", "cgitb", "chunk", "cmath", "cmd", "code", "codecs", "codeop", "collections", "colorsys", "compileall",
+    "concurrent", "configparser", "contextlib", "contextvars", "copy", "copyreg", "cProfile", "crypt", "csv", "ctypes",
+    "curses", "dataclasses", "datetime", "dbm", "decimal", "difflib", "dis", "distutils", "doctest", "email",
+    "encodings", "ensurepip", "enum", "errno", "faulthandler", "fcntl", "filecmp", "fileinput", "fnmatch", "fractions",
+    "ftplib", "functools", "gc", "genericpath", "getopt", "getpass", "gettext", "glob", "graphlib", "grp", "gzip",
+    "hashlib", "heapq", "hmac", "html", "http", "idlelib", "imaplib", "imghdr", "imp", "importlib", "inspect", "io",
+    "ipaddress", "itertools", "json", "keyword", "lib2to3", "linecache", "locale", "logging", "lzma", "mailbox",
+    "mailcap", "marshal", "math", "mimetypes", "mmap", "modulefinder", "msilib", "msvcrt", "multiprocessing", "netrc",
+    "nis", "nntplib", "nt", "ntpath", "nturl2path", "numbers", "opcode", "operator", "optparse", "os", "ossaudiodev",
+    "pathlib", "pdb", "pickle", "pickletools", "pipes", "pkgutil", "platform", "plistlib", "poplib", "posix",
+    "posixpath", "pprint", "profile", "pstats", "pty", "pwd", "py_compile", "pyclbr", "pydoc", "pydoc_data", "pyexpat",
+    "queue", "quopri", "random", "re", "readline", "reprlib", "resource", "rlcompleter", "runpy", "sched", "secrets",
+    "select", "selectors", "shelve", "shlex", "shutil", "signal", "site", "smtpd", "smtplib", "sndhdr", "socket",
+    "socketserver", "spwd", "sqlite3", "sre_compile", "sre_constants", "sre_parse", "ssl", "stat", "statistics",
+    "string", "stringprep", "struct", "subprocess", "sunau", "symtable", "sys", "sysconfig", "syslog", "tabnanny",
+    "tarfile", "telnetlib", "tempfile", "termios", "textwrap", "this", "threading", "time", "timeit", "tkinter",
+    "token", "tokenize", "tomllib", "trace", "traceback", "tracemalloc", "tty", "turtle", "turtledemo", "types",
+    "typing", "unicodedata", "unittest", "urllib", "uu", "uuid", "venv", "warnings", "wave", "weakref", "webbrowser",
+    "winreg", "winsound", "wsgiref", "xdrlib", "xml", "xmlrpc", "zipapp", "zipfile", "zipimport", "zlib", "zoneinfo"]
+
+SYSTEM_MODULES_BY_INTERPRETER = {
+    "python2": SYSTEM_MODULES,
+    "python3": PYTHON3_SYSTEM_MODULES,
+}
+
+_yaml = None
+
+
+def load_yaml(filepath):
+    # type: (str) -> Any
+    """
+    Loads a YAML file. ruamel.yaml is slow to import, so it's only imported once it's needed; a client that forwards its
+    request to a running daemon never needs it.
+    """
+    global _yaml
+    if _yaml is None:
+        from ruamel.yaml import YAML
+        _yaml = YAML(typ="safe")
+    with open(filepath) as fp:
+        return _yaml.load(fp)
+
+
+def intern_str(s):
+    # type: (str) -> str
+    """
+    Interns a str, so that equal module names, paths and labels share a single object. None (and unicode, which can't
+    be interned) are returned as is.
+    """
+    return intern(s) if type(s) is str else s
+
+
+def to_str(value):
+    # type: (Any) -> Any
+    """
+    Converts the unicode strings in a JSON value to str.
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    elif isinstance(value, list):
+        return [to_str(item) for item in value]
+    elif isinstance(value, dict):
+        return {to_str(key): to_str(item) for key, item in value.iteritems()}
+    return value
+
+
+class Stats:
+    """
+    Collects the wall and CPU time of the phases of a run and counters of the work done in them (see --stats).
+    Counters named "<cache>.hits" and "<cache>.misses" are reported as cache hit rates, too.
+
+    Phases may be nested (e.g. third_party within config); a phase only records its self time, ie. the time spent in
+    its nested phases is left out, so the times of all phases add up to the time of the run.
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        # the wall and CPU time spent in the nested phases of each phase that is running, innermost last.
+        self._nested_seconds = []
+
+    def reset(self):
+        # type: () -> None
+        self.phases.clear()
+        self.counters.clear()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # type: (str) -> ContextManager
+        wall_start, cpu_start = time.time(), sum(os.times()[:2])
+        self._nested_seconds.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            wall_seconds, cpu_seconds = time.time() - wall_start, sum(os.times()[:2]) - cpu_start
+            nested_wall_seconds, nested_cpu_seconds = self._nested_seconds.pop()
+            if self._nested_seconds:
+                self._nested_seconds[-1][0] += wall_seconds
+                self._nested_seconds[-1][1] += cpu_seconds
+            phase = self.phases.setdefault(name, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0})
+            phase["wall_seconds"] += wall_seconds - nested_wall_seconds
+            phase["cpu_seconds"] += cpu_seconds - nested_cpu_seconds
+            phase["calls"] += 1
+
+    def count(self, name, value=1):
+        # type: (str, int) -> None
+        self.counters[name] += value
+
+    def cache_hit_rates(self):
+        # type: () -> dict
+        hit_rates = {}
+        for name in self.counters:
+            if not name.endswith(".hits"):
+                continue
+            cache = name[:-len(".hits")]
+            lookups = self.counters[name] + self.counters.get(cache + ".misses", 0)
+            hit_rates[cache] = float(self.counters[name]) / lookups if lookups else 0.0
+        return hit_rates
+
+    def report(self, stream, format):
+        # type: (file, str) -> None
+        if format == "json":
+            json.dump({"phases": self.phases, "counters": self.counters, "cache_hit_rates": self.cache_hit_rates()},
+                      stream, indent=2, sort_keys=True)
+            stream.write("\n")
+            return
+        stream.write("{:<24} {:>10} {:>10} {:>8}\n".format("phase", "wall (ms)", "cpu (ms)", "calls"))
+        for name, phase in self.phases.iteritems():
+            stream.write("{:<24} {:>10.1f} {:>10.1f} {:>8d}\n".format(
+                name, phase["wall_seconds"] * 1000, phase["cpu_seconds"] * 1000, phase["calls"]))
+        stream.write("\n{:<40} {:>10}\n".format("counter", "value"))
+        for name in sorted(self.counters):
+            stream.write("{:<40} {:>10d}\n".format(name, self.counters[name]))
+        hit_rates = self.cache_hit_rates()
+        if hit_rates:
+            stream.write("\n{:<40} {:>10}\n".format("cache", "hit rate"))
+            for cache in sorted(hit_rates):
+                stream.write("{:<40} {:>9.1f}%\n".format(cache, hit_rates[cache] * 100))
+
+
+stats = Stats()
+
 
 def main(argv):
-    # type: (list) -> None
+    # type: (list) -> int
+    if argv[1:2] == ["serve"]:
+        return serve(argv)
+    if argv[1:2] == ["affected"]:
+        return affected(argv)
     args = parse_args(argv)
     init_logging(args.enable_debug)
-    config = Config.from_args(args)
-    workspace = Workspace.from_config(config)
-    ramsay = Ramsay(workspace, config.ignored_files, config.ignored_test_files, config.manual_imports,
-            config.manual_dependencies, config.manual_data_dependencies, config.manual_tags, config.manual_sizes,
-            config.manual_timeouts, config.manual_flaky, config.pattern_deps, config.header, config.footer,
-            config.allow_scoped_imports, config.generate_library_targets, config.generate_test_targets,
-            config.generate_shared_library, config.generate_test_suite_target)
-    build_file_contents = ramsay.files(args.files)
-    build_file_contents, changed = FormatCode(build_file_contents)  # defaults to pep8
-    print(build_file_contents)
+    if args.watch:
+        return watch(args)
+    if args.use_daemon:
+        status = RamsayClient.forward(argv, args)
+        if status is not None:
+            return status
+    generator = BuildFileGenerator(args)
+    try:
+        return run(args, generator)
+    finally:
+        generator.close()
+        if args.stats:
+            report_stats(args)
+
+
+def report_stats(args):
+    # type: (argparse.Namespace) -> None
+    if args.stats_file:
+        with open(args.stats_file, "w") as fp:
+            stats.report(fp, args.stats_format)
+    else:
+        stats.report(sys.stderr, args.stats_format)
+
+
+def run(args, generator):
+    # type: (argparse.Namespace, BuildFileGenerator) -> int
+    """
+    Generates, writes or checks the BUILD file(s) requested by the command-line arguments.
+    """
+    stats.reset()
+    generator.generated_tests.clear()
+    if args.recursive:
+        return generate_recursively(args, generator)
+    build_file_contents = generator.generate(os.getcwd(), args.files)
+    status = check_closures(args, generator)
+    if status:
+        return status
+    if args.check or args.write:
+        return update_build_file(os.path.join(os.getcwd(), Ramsay.BUILD_FILENAME), build_file_contents, args.check)
+    sys.stdout.write(build_file_contents)
+    return 0
+
+
+def generate_build_file(ramsay, filepaths, formatter="starlark", merge=False, existing_contents=None):
+    # type: (Ramsay, list, str, bool, str) -> str
+    """
+    Returns the contents of the BUILD file for the given files. The "starlark" formatter emits canonical Starlark
+    directly; the "yapf" formatter renders the Jinja templates and reformats the result with yapf.
+
+    In merge mode, the generated targets are tagged as owned by Ramsay and merged into the existing contents of the
+    BUILD file (see BuildFileMerger), so targets that were written by hand are kept.
+    """
+    build_template = ramsay.build(filepaths)
+    if merge:
+        if formatter != "starlark":
+            raise ValueError("merging BUILD files requires the starlark formatter")
+        build_template.add_tag_to_targets(Ramsay.OWNED_TAG)
+        with stats.phase("render"):
+            if existing_contents and existing_contents.strip():
+                return BuildFileMerger(existing_contents).merge(build_template)
+            stream = StringIO()
+            StarlarkEmitter(stream).emit(build_template, StarlarkEmitter.MERGE_BANNER)
+            return stream.getvalue()
+    if formatter == "starlark":
+        with stats.phase("render"):
+            stream = StringIO()
+            StarlarkEmitter(stream).emit(build_template)
+            return stream.getvalue()
+    elif formatter == "yapf":
+        with stats.phase("render"):
+            build_file_contents = str(build_template)
+        with stats.phase("format"):
+            # yapf is slow to import and only needed by this formatter.
+            from yapf.yapflib.yapf_api import FormatCode
+            build_file_contents, changed = FormatCode(build_file_contents)  # defaults to pep8
+            return build_file_contents + "\n"
+    else:
+        raise ValueError("unsupported formatter '{}'; use starlark or yapf".format(formatter))
+
+
+def generate_recursively(args, generator):
+    # type: (argparse.Namespace, BuildFileGenerator) -> int
+    """
+    Generates a BUILD file for every directory with Python files below the given directory in a single process. The
+    third-party modules are only queried once and shared between all packages.
+    """
+    logger = logging.getLogger(__name__)
+    status = 0
+    build_files = []
+    for dirpath, filepaths in find_python_packages(args.recursive):
+        try:
+            build_file_contents = generator.generate(dirpath, filepaths)
+        except Exception as e:
+            logger.error("%s: failed to generate BUILD file: %s", dirpath, e)
+            status = 1
+            continue
+        build_files.append((os.path.join(dirpath, Ramsay.BUILD_FILENAME), build_file_contents))
+    # the closures of the tests can only be checked once all packages are generated.
+    if check_closures(args, generator):
+        return 1
+    for build_filepath, build_file_contents in build_files:
+        status = update_build_file(build_filepath, build_file_contents, args.check) or status
+    return status
+
+
+def check_closures(args, generator):
+    # type: (argparse.Namespace, BuildFileGenerator) -> int
+    """
+    Reports the closures of the generated tests if requested and returns 1 if any test exceeds its maximum closure
+    size.
+    """
+    logger = logging.getLogger(__name__)
+    if not args.report_closure and not any(generator.generated_tests.itervalues()):
+        return 0
+    if generator.dependency_index is None:
+        logger.error("computing the closures of tests requires the dependency index in the cache directory")
+        return 1
+    with stats.phase("closures"):
+        closures = generator.dependency_index.closures(generator.generated_tests)
+    if args.report_closure:
+        report_closures(sys.stderr, closures)
+    status = 0
+    for label, max_closure_size in sorted(generator.generated_tests.iteritems()):
+        closure_size = sum(closures[label])
+        if max_closure_size and closure_size > max_closure_size:
+            logger.error("%s depends on %d files and packages, more than its max_closure_size of %d",
+                    label, closure_size, max_closure_size)
+            status = 1
+    return status
+
+
+def report_closures(stream, closures):
+    # type: (file, dict) -> None
+    stream.write("{:>8} {:>8} {:>12} {:>8}  {}\n".format("closure", "files", "third-party", "other", "test"))
+    for label, (files, third_party, other) in sorted(closures.iteritems(), key=lambda item: (-sum(item[1]), item[0])):
+        stream.write("{:>8d} {:>8d} {:>12d} {:>8d}  {}\n".format(files + third_party + other, files, third_party, other,
+                                                                label))
+
+
+def serve(argv):
+    # type: (list) -> int
+    """
+    Runs the Ramsay daemon for the workspace until it's stopped.
+    """
+    parser = argparse.ArgumentParser(
+        prog="ramsay serve",
+        description="Serves requests of Ramsay clients with warm caches over a Unix socket.")
+    parser.add_argument("--debug",
+                        dest="enable_debug",
+                        action="store_true",
+                        default=False,
+                        help="logs debug information to stderr")
+    parser.add_argument("--workspace-dir",
+                        metavar="WORKSPACE",
+                        dest="workspace_dir",
+                        type=str,
+                        default=Workspace.find_workspace_abs_dirpath(),
+                        help="overrides the automically-discovered Bazel workspace directory")
+    parser.add_argument("-j", "--jobs",
+                        metavar="N",
+                        dest="jobs",
+                        type=int,
+                        default=1,
+                        help="parses files and extracts their imports with N processes")
+    parser.add_argument("--stop",
+                        dest="stop",
+                        action="store_true",
+                        default=False,
+                        help="stops the daemon that is running for the workspace")
+    args = parser.parse_args(argv[2:])
+    init_logging(args.enable_debug)
+    if not args.workspace_dir:
+        parser.error("couldn't find the Bazel workspace directory; use --workspace-dir")
+    socket_path = RamsayServer.socket_path(args.workspace_dir)
+    if args.stop:
+        return 0 if RamsayClient.request(socket_path, {"command": "stop"}) is not None else 1
+    if RamsayClient.request(socket_path, {"command": "ping"}) is not None:
+        sys.stderr.write("ramsay is already serving {} on {}\n".format(args.workspace_dir, socket_path))
+        return 1
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = RamsayServer(socket_path, args)
+    print("serving {} on {}".format(args.workspace_dir, socket_path))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def affected(argv):
+    # type: (list) -> int
+    """
+    Prints the labels of the tests that (transitively) depend on the given files, as recorded in the dependency index
+    by previous runs.
+    """
+    parser = argparse.ArgumentParser(
+        prog="ramsay affected",
+        description="Prints the labels of the tests affected by changes to the given files.")
+    parser.add_argument("files",
+                        metavar="FILE",
+                        type=str,
+                        nargs="+",
+                        help="sets the changed files (which don't need to exist anymore)")
+    parser.add_argument("--all",
+                        dest="all_targets",
+                        action="store_true",
+                        default=False,
+                        help="prints all affected targets, not just the tests")
+    parser.add_argument("--debug",
+                        dest="enable_debug",
+                        action="store_true",
+                        default=False,
+                        help="logs debug information to stderr")
+    parser.add_argument("--workspace-dir",
+                        metavar="WORKSPACE",
+                        dest="workspace_dir",
+                        type=str,
+                        default=Workspace.find_workspace_abs_dirpath(),
+                        help="overrides the automically-discovered Bazel workspace directory")
+    parser.add_argument("--cache-dir",
+                        metavar="DIR",
+                        dest="cache_dir",
+                        type=str,
+                        default=None,
+                        help="overrides the cache directory (defaults to .ramsay-cache in the workspace directory)")
+    args = parser.parse_args(argv[2:])
+    init_logging(args.enable_debug)
+    if not args.workspace_dir:
+        parser.error("couldn't find the Bazel workspace directory; use --workspace-dir")
+    if args.cache_dir:
+        args.cache_dir = os.path.abspath(args.cache_dir)
+    cascaded_config = Config.load_workspace_config(args)
+    cache_dir = cascaded_config["cache_dir"] or os.path.join(args.workspace_dir, Config.CACHE_DIRNAME)
+    path = os.path.join(cache_dir, DependencyIndex.FILENAME)
+    if not os.path.exists(path):
+        sys.stderr.write("{} doesn't exist; run 'ramsay --recursive {}' first\n".format(path, args.workspace_dir))
+        return 2
+    dependency_index = DependencyIndex.load(args.workspace_dir, path)
+    labels = dependency_index.affected(os.path.relpath(os.path.realpath(filepath), dependency_index.root)
+                                       for filepath in args.files)
+    for label in sorted(labels):
+        if args.all_targets or dependency_index.is_test(label):
+            sys.stdout.write(label + "\n")
+    return 0
+
+
+def watch(args):
+    # type: (argparse.Namespace) -> int
+    """
+    Brings the BUILD files below the given directory up to date and regenerates them whenever Python or .ramsayrc files
+    change. Bursts of events are collected until the directory tree is quiet for a moment, and only the affected
+    packages are regenerated. Parsed imports and the module index stay in memory between regenerations.
+    """
+    logger = logging.getLogger(__name__)
+    root = os.path.realpath(args.watch)
+    generator = BuildFileGenerator(args)
+    watcher = Inotify.create(root) if Inotify.is_supported() else PollingWatcher(root)
+    try:
+        generator.regenerate([dirpath for dirpath, filepaths in find_python_packages(root)])
+        print("watching {} for changes".format(root))
+        sys.stdout.flush()
+        while True:
+            changed_filepaths = watcher.wait(BuildFileGenerator.DEBOUNCE_SECONDS)
+            dirpaths = set()
+            for filepath in changed_filepaths:
+                dirpath, filename = os.path.split(filepath)
+                if filename == Config.FILENAME:
+                    # a configuration change affects all packages below the .ramsayrc file.
+                    generator.invalidate()
+                    dirpaths.update(subdirpath for subdirpath, filepaths in find_python_packages(dirpath))
+                elif filename.endswith(".py") or filename == "":
+                    dirpaths.add(dirpath)
+            start = time.time()
+            for build_filepath in generator.regenerate(sorted(dirpaths), changed_filepaths):
+                print("updated {} in {:.0f}ms".format(build_filepath, (time.time() - start) * 1000))
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        logger.debug("stopped watching %s", root)
+    finally:
+        watcher.close()
+        generator.close()
+    return 0
+
+
+def is_package_dirname(dirname):
+    # type: (str) -> bool
+    return not dirname.startswith(".") and not dirname.startswith("bazel-")
+
+
+def update_build_file(build_filepath, build_file_contents, check):
+    # type: (str, str, bool) -> int
+    """
+    Brings the BUILD file on disk up to date. The file is only replaced (atomically) if its contents differ, so its
+    mtime doesn't change needlessly. In check mode, the file is left alone; instead, the differences are printed and 1 is
+    returned if the file is out of date.
+    """
+    logger = logging.getLogger(__name__)
+    with stats.phase("write"):
+        return _update_build_file(logger, build_filepath, build_file_contents, check)
+
+
+def _update_build_file(logger, build_filepath, build_file_contents, check):
+    # type: (logging.Logger, str, str, bool) -> int
+    try:
+        with open(build_filepath) as fp:
+            existing_contents = fp.read()
+    except IOError:
+        existing_contents = None
+    if existing_contents == build_file_contents:
+        logger.debug("%s is up to date", build_filepath)
+        return 0
+    stats.count("build_files_changed")
+    if check:
+        print("{} is out of date:".format(build_filepath))
+        for line in diff_build_files(existing_contents or "", build_file_contents):
+            print("  {}".format(line))
+        return 1
+    dirpath = os.path.dirname(build_filepath)
+    with tempfile.NamedTemporaryFile("w", dir=dirpath, prefix=".{}.".format(Ramsay.BUILD_FILENAME), delete=False) as fp:
+        fp.write(build_file_contents)
+    # the temporary file is private to its owner; the BUILD file keeps the mode of the file it replaces.
+    try:
+        mode = stat.S_IMODE(os.stat(build_filepath).st_mode)
+    except OSError:
+        mode = 0o644
+    os.chmod(fp.name, mode)
+    os.rename(fp.name, build_filepath)
+    logger.debug("wrote %s", build_filepath)
+    return 0
+
+
+def diff_build_files(old_contents, new_contents):
+    # type: (str, str) -> list
+    """
+    Returns a compact, per-target description of the differences between two BUILD files: '+' marks added statements,
+    '-' removed statements and '~' changed statements, followed by their changed lines.
+    """
+    old_stmts = split_build_file(old_contents)
+    new_stmts = split_build_file(new_contents)
+    lines = []
+    for key, text in new_stmts.iteritems():
+        if key not in old_stmts:
+            lines.append("+ {}".format(key))
+        elif old_stmts[key] != text:
+            lines.append("~ {}".format(key))
+            for line in difflib.unified_diff(old_stmts[key].splitlines(), text.splitlines(), lineterm="", n=0):
+                if not line.startswith(("---", "+++", "@@")):
+                    lines.append("    {}".format(line))
+    for key in old_stmts:
+        if key not in new_stmts:
+            lines.append("- {}".format(key))
+    if not lines:
+        lines.append("~ order, comments or whitespace")
+    return lines
+
+
+def split_build_file(contents):
+    # type: (str) -> collections.OrderedDict
+    """
+    Splits a BUILD file into its top-level statements, keyed by a short description like 'pyz_library "foo_py"'.
+    """
+    lines = contents.splitlines(True)
+    try:
+        stmts = ast.parse(contents).body
+    except SyntaxError:
+        return collections.OrderedDict([("BUILD file", contents)])
+    blocks = collections.OrderedDict()
+    for i, stmt in enumerate(stmts):
+        end = stmts[i + 1].lineno - 1 if i + 1 < len(stmts) else len(lines)
+        text = "".join(lines[stmt.lineno - 1:end]).rstrip()
+        key = describe_build_stmt(stmt, text)
+        while key in blocks:
+            key = key + "'"
+        blocks[key] = text
+    return blocks
+
+
+def describe_build_stmt(stmt, text):
+    # type: (ast.stmt, str) -> str
+    if isinstance(stmt, ast.Expr) and isinstance(stmt.value, ast.Call) and isinstance(stmt.value.func, ast.Name):
+        call = stmt.value
+        if call.func.id == "load" and call.args and isinstance(call.args[0], ast.Str):
+            return "load {}".format(json.dumps(call.args[0].s))
+        for keyword in call.keywords:
+            if keyword.arg == "name" and isinstance(keyword.value, ast.Str):
+                return "{} {}".format(call.func.id, json.dumps(keyword.value.s))
+        return call.func.id
+    return text.splitlines()[0]
+
+
+def make_pool(jobs):
+    # type: (int) -> multiprocessing.Pool
+    """
+    Creates the process pool that parses files and extracts their imports in parallel. Returns None if files should be
+    processed serially.
+    """
+    if jobs <= 1:
+        return None
+    return multiprocessing.Pool(jobs)
+
+
+def find_python_packages(root):
+    # type: (str) -> Iterator[(str, list)]
+    """
+    Walks the directory tree below root and yields every directory that contains Python files together with the
+    (sorted) names of these files. Hidden directories and Bazel's convenience symlinks are skipped.
+    """
+    for dirpath, dirnames, filenames in os.walk(os.path.realpath(root)):
+        dirnames[:] = sorted(dirname for dirname in dirnames if is_package_dirname(dirname))
+        filepaths = sorted(filename for filename in filenames if filename.endswith(".py"))
+        if filepaths:
+            yield dirpath, filepaths
 
 
 def parse_args(argv):
@@ -72,7 +654,7 @@ def parse_args(argv):
     parser.add_argument("files",
                         metavar="FILE",
                         type=str,
-                        nargs="+",
+                        nargs="*",
                         help="sets the Python source files to process")
     parser.add_argument("--allow-scoped-imports",
                         dest="allow_scoped_imports",
@@ -90,7 +672,114 @@ def parse_args(argv):
                         type=str,
                         default=Workspace.find_workspace_abs_dirpath(),
                         help="overrides the automically-discovered Bazel workspace directory")
-    return parser.parse_args(argv[1:])
+    parser.add_argument("--cache-dir",
+                        metavar="DIR",
+                        dest="cache_dir",
+                        type=str,
+                        default=None,
+                        help="overrides the cache directory (defaults to .ramsay-cache in the workspace directory)")
+    parser.add_argument("--no-cache",
+                        dest="enable_cache",
+                        action="store_false",
+                        default=True,
+                        help="disables the on-disk cache of parsed import statements")
+    parser.add_argument("-j", "--jobs",
+                        metavar="N",
+                        dest="jobs",
+                        type=int,
+                        default=1,
+                        help="parses files and extracts their imports with N processes")
+    parser.add_argument("--refresh-third-party",
+                        dest="refresh_third_party",
+                        action="store_true",
+                        default=False,
+                        help="queries Bazel for third-party modules even if the cached modules are up to date")
+    parser.add_argument("--third-party-discovery",
+                        dest="third_party_discovery",
+                        choices=("bazel", "static"),
+                        default=None,
+                        help="discovers third-party modules with 'bazel query' or by reading the third-party BUILD, "
+                             "requirements and wheel files (defaults to bazel)")
+    parser.add_argument("--formatter",
+                        dest="formatter",
+                        choices=("starlark", "yapf"),
+                        default=None,
+                        help="selects how the BUILD file is rendered (defaults to starlark)")
+    parser.add_argument("--test-results",
+                        metavar="DIR",
+                        dest="test_results_dir",
+                        type=str,
+                        default=None,
+                        help="infers the size and timeout of tests from the test.xml files of past runs below DIR")
+    parser.add_argument("--report-closure",
+                        dest="report_closure",
+                        action="store_true",
+                        default=False,
+                        help="reports the files and packages that every generated test depends on, transitively")
+    parser.add_argument("--granularity",
+                        dest="granularity",
+                        choices=("file", "component"),
+                        default=None,
+                        help="generates a library per file or per group of tightly coupled files (defaults to file)")
+    parser.add_argument("--merge",
+                        dest="merge_build_files",
+                        action="store_true",
+                        default=False,
+                        help="keeps hand-written targets of existing BUILD files and only updates the generated ones")
+    parser.add_argument("--watch",
+                        metavar="DIR",
+                        dest="watch",
+                        type=str,
+                        default=None,
+                        help="keeps the BUILD files below DIR up to date as files change")
+    parser.add_argument("--no-daemon",
+                        dest="use_daemon",
+                        action="store_false",
+                        default=True,
+                        help="doesn't forward the request to a running 'ramsay serve' daemon")
+    parser.add_argument("--check",
+                        dest="check",
+                        action="store_true",
+                        default=False,
+                        help="exits with 1 and prints the differences if the BUILD file is out of date")
+    parser.add_argument("-w", "--write",
+                        dest="write",
+                        action="store_true",
+                        default=False,
+                        help="writes the BUILD file (only if it changed) instead of printing it")
+    parser.add_argument("--stats",
+                        dest="stats",
+                        action="store_true",
+                        default=False,
+                        help="reports the time spent in each phase and counters of the work done")
+    parser.add_argument("--stats-format",
+                        dest="stats_format",
+                        choices=("text", "json"),
+                        default="text",
+                        help="the format of the --stats report (default: text)")
+    parser.add_argument("--stats-file",
+                        metavar="FILE",
+                        dest="stats_file",
+                        type=str,
+                        default=None,
+                        help="writes the --stats report to FILE instead of stderr")
+    parser.add_argument("--recursive",
+                        metavar="DIR",
+                        dest="recursive",
+                        type=str,
+                        default=None,
+                        help="writes a BUILD file for every directory with Python files below DIR")
+    args = parser.parse_args(argv[1:])
+    if len([mode for mode in (args.files, args.recursive, args.watch) if mode]) != 1:
+        parser.error("exactly one of FILE, --recursive or --watch is required")
+    if args.check and args.write:
+        parser.error("--check and --write are mutually exclusive")
+    # the caches are opened and saved from different working directories, so relative paths are resolved up front.
+    if args.cache_dir:
+        args.cache_dir = os.path.abspath(args.cache_dir)
+    if args.test_results_dir:
+        args.test_results_dir = os.path.abspath(args.test_results_dir)
+    return args
 
 
 def init_logging(enable_debug):
@@ -101,18 +790,463 @@ def init_logging(enable_debug):
         level=logging.DEBUG if enable_debug else logging.ERROR)
 
 
+class BuildFileGenerator:
+    """
+    Generates the BUILD files of one or more packages in the same process. The state that doesn't depend on a
+    particular package (the third-party modules, the process pool, the import cache and the module index) is created
+    once and shared between all packages.
+    """
+    DEBOUNCE_SECONDS = 0.1
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, args):
+        # type: (argparse.Namespace) -> None
+        self.args = args
+        self.pool = make_pool(args.jobs)
+        self.config_loader = ConfigLoader.from_args(args)
+        self.third_party_modules = None
+        self.import_cache = None
+        self.module_index = None
+        self.dependency_index = None
+        self.test_history = None
+        self.workspaces = {}
+        # maps the labels of the tests generated since the last run to their maximum closure sizes.
+        self.generated_tests = {}
+
+    def generate(self, dirpath, filepaths):
+        # type: (str, list) -> str
+        """
+        Returns the contents of the BUILD file for the given files in the given directory.
+        """
+        cwd = os.getcwd()
+        os.chdir(dirpath)
+        try:
+            with stats.phase("config"):
+                if self.third_party_modules is None:
+                    with stats.phase("third_party"):
+                        self.third_party_modules = Config.discover_third_party_modules(
+                            self.config_loader.workspace_config(), self.args.refresh_third_party)
+                config = Config.from_args(self.args, self.third_party_modules, self.config_loader)
+            if self.dependency_index is None:
+                self.dependency_index = DependencyIndex.from_config(config)
+            if self.import_cache is None:
+                self.import_cache = ImportCache.from_config(config)
+                with stats.phase("module_index"):
+                    self.module_index = ModuleIndex.from_config(config)
+            # a workspace (and the modules it already classified) can be reused as long as its configuration is the same.
+            workspace_config = (config.workspace_dir, config.module_aliases, config.ignored_modules,
+                                config.third_party_modules, config.target_interpreter, config.third_party_package)
+            cached_workspace_config, workspace = self.workspaces.get(dirpath, (None, None))
+            if workspace is None or cached_workspace_config != workspace_config:
+                workspace = Workspace.from_config(config, self.module_index)
+                self.workspaces[dirpath] = (workspace_config, workspace)
+            test_history = None
+            if config.test_results_dir:
+                if self.test_history is None or self.test_history.root != config.test_results_dir:
+                    with stats.phase("test_history"):
+                        self.test_history = TestHistory.load(config.test_results_dir)
+                test_history = self.test_history
+            ramsay = Ramsay.from_config(workspace, config, self.import_cache, self.pool, self.dependency_index,
+                                        test_history)
+            existing_contents = None
+            if config.merge_build_files:
+                try:
+                    with open(Ramsay.BUILD_FILENAME) as fp:
+                        existing_contents = fp.read()
+                except IOError:
+                    pass
+            build_file_contents = generate_build_file(ramsay, filepaths, config.formatter, config.merge_build_files,
+                                                      existing_contents)
+            if self.dependency_index is not None:
+                package = workspace.relative(os.getcwd())
+                for label in self.dependency_index.tests("" if package == os.curdir else package):
+                    self.generated_tests[label] = config.max_closure_size
+            return build_file_contents
+        finally:
+            os.chdir(cwd)
+
+    def regenerate(self, dirpaths, changed_filepaths=()):
+        # type: (list, list) -> list
+        """
+        Regenerates and writes the BUILD files of the given directories, invalidating the module index if files changed
+        first. Returns the paths of the BUILD files that changed.
+        """
+        if self.module_index is not None and changed_filepaths:
+            self.module_index.invalidate()
+        updated_build_filepaths = []
+        for dirpath in dirpaths:
+            if not os.path.isdir(dirpath):
+                continue
+            filepaths = sorted(filename for filename in os.listdir(dirpath) if filename.endswith(".py"))
+            if not filepaths:
+                continue
+            build_filepath = os.path.join(dirpath, Ramsay.BUILD_FILENAME)
+            try:
+                with open(build_filepath) as fp:
+                    existing_contents = fp.read()
+            except IOError:
+                existing_contents = None
+            try:
+                build_file_contents = self.generate(dirpath, filepaths)
+            except Exception as e:
+                self._logger.error("%s: failed to generate BUILD file: %s", dirpath, e)
+                continue
+            if build_file_contents != existing_contents:
+                update_build_file(build_filepath, build_file_contents, False)
+                updated_build_filepaths.append(build_filepath)
+        self.flush()
+        return updated_build_filepaths
+
+    def invalidate(self):
+        # type: () -> None
+        """
+        Forgets the state that depends on the configuration, e.g. after a .ramsayrc file changed.
+        """
+        self.config_loader.reset()
+        self.third_party_modules = None
+        self.test_history = None
+        self.workspaces.clear()
+
+    def reset(self, args):
+        # type: (argparse.Namespace) -> None
+        """
+        Prepares the generator for a run with different arguments. The configuration is cascaded again and the module
+        index is invalidated, while parsed imports and the workspaces of unchanged configurations stay warm.
+        """
+        self.args = args
+        self.config_loader.reset(args)
+        self.third_party_modules = None
+        self.test_history = None
+        if self.module_index is not None:
+            self.module_index.invalidate()
+
+    def flush(self):
+        # type: () -> None
+        """
+        Persists the parsed imports, the module index, the dependency index and the parsed .ramsayrc files. The
+        dependency index isn't saved in check mode or if caching is disabled.
+        """
+        if self.config_loader.changed and self.config_loader.snapshot_path:
+            self.config_loader.save()
+        if self.import_cache is not None:
+            self.import_cache.flush()
+        if self.module_index is not None:
+            self.module_index.flush()
+        if self.dependency_index is not None and self.dependency_index.changed:
+            if getattr(self.args, "check", False) or not getattr(self.args, "enable_cache", True):
+                # the BUILD files weren't written (or caching is disabled), so the index is reloaded instead of saved.
+                self.dependency_index = None
+            else:
+                self.dependency_index.save()
+
+    def close(self):
+        # type: () -> None
+        self.flush()
+        if self.import_cache is not None:
+            self.import_cache.close()
+            self.import_cache = None
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+class RamsayServer(SocketServer.UnixStreamServer):
+    """
+    Serves the requests of Ramsay clients over a Unix socket. Requests and responses are single lines of JSON:
+
+      {"command": "run", "argv": [...], "cwd": "..."}  ->  {"status": 0, "stdout": "...", "stderr": "..."}
+      {"command": "ping"}                               ->  {"status": 0}
+      {"command": "stop"}                               ->  {"status": 0}
+
+    Requests are handled one at a time, since they change the working directory of the process. The BuildFileGenerator
+    (and with it the parsed imports, the module index and the workspaces) is kept warm between requests.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, socket_path, args):
+        # type: (str, argparse.Namespace) -> None
+        # the socket is created with mode 0600 right away; a chmod after bind() would leave a window in which other
+        # users could connect.
+        umask = os.umask(0o177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path, RamsayRequestHandler)
+        finally:
+            os.umask(umask)
+        self.socket_path = socket_path
+        self.generator = BuildFileGenerator(args)
+
+    @classmethod
+    def socket_path(cls, workspace_dir):
+        # type: (str) -> str
+        """
+        Returns the path of the socket of the daemon for the given workspace. The socket lives in the temporary
+        directory, since paths in the workspace may exceed the length limit of Unix socket paths.
+        """
+        digest = hashlib.sha1(os.path.realpath(workspace_dir)).hexdigest()[:16]
+        return os.path.join(tempfile.gettempdir(), "ramsay-{}-{}.sock".format(os.getuid(), digest))
+
+    def handle_command(self, request):
+        # type: (dict) -> dict
+        command = request.get("command")
+        if command == "ping":
+            return {"status": 0}
+        elif command == "stop":
+            threading.Thread(target=self.shutdown).start()
+            return {"status": 0}
+        elif command == "run":
+            return self._run(request["argv"], request["cwd"])
+        return {"status": 2, "stderr": "unknown command '{}'\n".format(command)}
+
+    def _run(self, argv, cwd):
+        # type: (list, str) -> dict
+        stdout, stderr = StringIO(), StringIO()
+        handler = logging.StreamHandler(stderr)
+        handler.setFormatter(logging.Formatter("%(asctime)-15s: %(name)s: %(message)s"))
+        root_logger = logging.getLogger()
+        level = root_logger.level
+        sys.stdout, sys.stderr = stdout, stderr
+        status = 1
+        try:
+            os.chdir(cwd)
+            args = parse_args(["ramsay"] + [str(arg) for arg in argv])
+            handler.setLevel(logging.DEBUG if args.enable_debug else logging.ERROR)
+            root_logger.addHandler(handler)
+            root_logger.setLevel(min(level, handler.level))
+            self.generator.reset(args)
+            status = run(args, self.generator)
+            if args.stats:
+                report_stats(args)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+            root_logger.removeHandler(handler)
+            root_logger.setLevel(level)
+            self.generator.flush()
+        return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+    def server_close(self):
+        # type: () -> None
+        SocketServer.UnixStreamServer.server_close(self)
+        self.generator.close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class RamsayRequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError as e:
+            response = {"status": 2, "stderr": "malformed request: {}\n".format(e)}
+        else:
+            response = self.server.handle_command(request)
+        self.wfile.write(json.dumps(response) + "\n")
+
+
+class RamsayClient:
+    """
+    Forwards requests to the daemon of the workspace (see RamsayServer).
+    """
+    _logger = logging.getLogger(__name__)
+
+    @classmethod
+    def forward(cls, argv, args):
+        # type: (list, argparse.Namespace) -> int
+        """
+        Lets the daemon run the request and replays its output. Returns the exit status, or None if no daemon is running
+        for the workspace.
+        """
+        if not args.workspace_dir:
+            return None
+        response = RamsayClient.request(RamsayServer.socket_path(args.workspace_dir),
+                                        {"command": "run", "argv": argv[1:], "cwd": os.getcwd()})
+        if response is None:
+            return None
+        sys.stdout.write(response.get("stdout", "").encode("utf-8"))
+        sys.stderr.write(response.get("stderr", "").encode("utf-8"))
+        return response["status"]
+
+    @classmethod
+    def request(cls, socket_path, request):
+        # type: (str, dict) -> dict
+        if not os.path.exists(socket_path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except socket.error as e:
+            cls._logger.debug("couldn't connect to the daemon on %s: %s", socket_path, e)
+            sock.close()
+            return None
+        try:
+            sock.sendall(json.dumps(request) + "\n")
+            return json.loads(sock.makefile("r").readline())
+        finally:
+            sock.close()
+
+
+class Inotify:
+    """
+    Watches a directory tree for changes to files with Linux's inotify API (through ctypes, since Python 2 has no
+    bindings for it).
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT_HEADER = struct.Struct("iIII")
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, libc, fd):
+        self._libc = libc
+        self.fd = fd
+        self.dirpaths = {}
+
+    @classmethod
+    def is_supported(cls):
+        # type: () -> bool
+        return sys.platform.startswith("linux") and ctypes.util.find_library("c") is not None
+
+    @classmethod
+    def create(cls, root):
+        # type: (str) -> Inotify
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        inotify = Inotify(libc, fd)
+        inotify.add_tree(root)
+        return inotify
+
+    def add_tree(self, root):
+        # type: (str) -> None
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [dirname for dirname in dirnames if is_package_dirname(dirname)]
+            wd = self._libc.inotify_add_watch(self.fd, dirpath, Inotify.WATCH_MASK)
+            if wd < 0:
+                self._logger.warning("failed to watch %s: %s", dirpath, os.strerror(ctypes.get_errno()))
+                continue
+            self.dirpaths[wd] = dirpath
+
+    def wait(self, debounce_seconds):
+        # type: (float) -> list
+        """
+        Blocks until files change and returns the paths of all files that changed until no more changes occurred for
+        debounce_seconds. New directories are watched automatically and reported with a trailing separator.
+        """
+        changed_filepaths = set(self._read_events(None))
+        while True:
+            filepaths = self._read_events(debounce_seconds)
+            if not filepaths:
+                return sorted(changed_filepaths)
+            changed_filepaths.update(filepaths)
+
+    def _read_events(self, timeout):
+        # type: (float) -> list
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        filepaths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = Inotify.EVENT_HEADER.unpack_from(data, offset)
+            offset += Inotify.EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            if mask & Inotify.IN_Q_OVERFLOW:
+                self._logger.warning("dropped inotify events; restart to pick up all changes")
+                continue
+            dirpath = self.dirpaths.get(wd)
+            if dirpath is None:
+                continue
+            if mask & (Inotify.IN_IGNORED | Inotify.IN_DELETE_SELF):
+                self.dirpaths.pop(wd, None)
+                continue
+            filepath = os.path.join(dirpath, name)
+            if mask & Inotify.IN_ISDIR:
+                if not is_package_dirname(name):
+                    continue
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    self.add_tree(filepath)
+                    filepaths.extend(os.path.join(subdirpath, "") for subdirpath, _ in find_python_packages(filepath))
+            filepaths.append(filepath)
+        return filepaths
+
+    def close(self):
+        # type: () -> None
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """
+    Watches a directory tree for changes to Python and .ramsayrc files by polling their mtimes. Used on platforms
+    without inotify.
+    """
+    INTERVAL_SECONDS = 1.0
+
+    def __init__(self, root):
+        self.root = root
+        self.mtimes = self._scan()
+
+    def _scan(self):
+        # type: () -> dict
+        mtimes = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [dirname for dirname in dirnames if is_package_dirname(dirname)]
+            for filename in filenames:
+                if filename.endswith(".py") or filename == Config.FILENAME:
+                    filepath = os.path.join(dirpath, filename)
+                    try:
+                        mtimes[filepath] = os.stat(filepath).st_mtime
+                    except OSError:
+                        continue
+        return mtimes
+
+    def wait(self, debounce_seconds):
+        # type: (float) -> list
+        while True:
+            time.sleep(max(PollingWatcher.INTERVAL_SECONDS, debounce_seconds))
+            mtimes = self._scan()
+            changed_filepaths = set(mtimes.viewitems() ^ self.mtimes.viewitems())
+            self.mtimes = mtimes
+            if changed_filepaths:
+                return sorted(set(filepath for filepath, mtime in changed_filepaths))
+
+    def close(self):
+        # type: () -> None
+        pass
+
+
 class Ramsay:
     RULESET = "@com_bluecore_rules_pyz//rules_python_zip:rules_python_zip.bzl"
     LIBRARY_TARGET = "pyz_library"
     TEST_TARGET = "pyz_test"
     TEST_PREFIX = "test_"
+    BUILD_FILENAME = "BUILD.bazel"
+    OWNED_TAG = "ramsay-generated"
+    # the number of files that are parsed by the process pool at once.
+    PARSE_BATCH_SIZE = 64
 
     _logger = logging.getLogger(__name__)
 
     def __init__(self, workspace, ignored_files, ignored_test_files, manual_imports, manual_dependencies,
-            manual_data_dependencies, manual_tags, manual_sizes, manual_timeouts, manual_flaky, pattern_deps, header,
-            footer, allow_scoped_imports, generate_library_targets, generate_test_targets, generate_shared_library,
-            generate_test_suite_target):
+            manual_data_dependencies, manual_tags, manual_sizes, manual_timeouts, manual_flaky, manual_shard_counts,
+            pattern_deps, header, footer, allow_scoped_imports, generate_library_targets, generate_test_targets,
+            generate_shared_library, generate_test_suite_target, tests_per_shard, max_shard_count, infer_flaky,
+            granularity, target_cost, import_cache=None, pool=None, dependency_index=None, test_history=None):
         self.workspace = workspace
         self.ignored_files = ignored_files
         self.ignored_test_files = ignored_test_files
@@ -123,7 +1257,9 @@ class Ramsay:
         self.manual_sizes = manual_sizes
         self.manual_timeouts = manual_timeouts
         self.manual_flaky = manual_flaky
+        self.manual_shard_counts = manual_shard_counts
         self.pattern_deps = pattern_deps
+        self.pattern_deps_matcher = PatternDepsMatcher.from_regexes(pattern_deps)
         self.header = header
         self.footer = footer
         self.allow_scoped_imports = allow_scoped_imports
@@ -131,129 +1267,292 @@ class Ramsay:
         self.generate_test_targets = generate_test_targets
         self.generate_shared_library = generate_shared_library
         self.generate_test_suite_target = generate_test_suite_target
+        self.tests_per_shard = tests_per_shard
+        self.max_shard_count = max_shard_count
+        self.infer_flaky = infer_flaky
+        self.granularity = granularity
+        self.target_cost = target_cost
+        self.import_cache = import_cache
+        self.pool = pool
+        # maps synthesized modules to their resolved imports, which are the same for all files of a package.
+        self._resolved_manual_imports = {}
+        # maps pattern_deps regexes to the resolved imports and dependencies they add to matching files.
+        self._resolved_pattern_deps = {}
+        self.dependency_index = dependency_index
+        self.test_history = test_history
+
+    @classmethod
+    def from_config(cls, workspace, config, import_cache=None, pool=None, dependency_index=None, test_history=None):
+        # type: (Workspace, Config, ImportCache, multiprocessing.Pool, DependencyIndex, TestHistory) -> Ramsay
+        return Ramsay(workspace, config.ignored_files, config.ignored_test_files, config.manual_imports,
+                config.manual_dependencies, config.manual_data_dependencies, config.manual_tags, config.manual_sizes,
+                config.manual_timeouts, config.manual_flaky, config.manual_shard_counts, config.pattern_deps,
+                config.header, config.footer, config.allow_scoped_imports, config.generate_library_targets,
+                config.generate_test_targets, config.generate_shared_library, config.generate_test_suite_target,
+                config.tests_per_shard, config.max_shard_count, config.infer_flaky, config.granularity,
+                config.target_cost, import_cache, pool, dependency_index, test_history)
 
     def files(self, filepaths):
         # type: (list) -> str
+        return str(self.build(filepaths))
 
-        # read all the code ahead of processing so we don't fail during transforming on files that we can't open.
-        filepaths = self._filter_ignored_files(filepaths)
-        codes = self._parse_code_files(filepaths)
+    def build(self, filepaths):
+        # type: (list) -> BazelBuildTemplate
+
+        # the memoized resolutions of earlier runs may be stale.
+        self.workspace.reset_caches()
 
-        # we only care about import nodes.
-        import_nodes = self._filter_import_nodes(codes)
-        import_stmts = self._reify_import_nodes(import_nodes)
-        assert(len(import_nodes.keys()) == len(import_stmts.keys()))
-        assert(len(import_nodes.values()) == len(import_stmts.values()))
+        # the files are streamed through reading, parsing and resolving one at a time, so only their resolved imports
+        # (and their number of tests) outlive these stages; an AST never outlives its file. A file that can't be read
+        # still fails the build before the BUILD file is rendered.
+        imports_sourcemap, test_counts = {}, {}
+        filepaths = self._filter_ignored_files(filepaths)
+        sources = self._read_code_files(filepaths)
+        import_stmts = self._extract_import_stmts(sources)
+        for filepath, resolved_imports, test_count in self._resolve_import_stmts(import_stmts):
+            imports_sourcemap[filepath] = resolved_imports
+            test_counts[filepath] = test_count
 
         # since we can't correctly evaluate dynamic imports, we allow users to synthesize imports and dependencies
         # via .ramsayrc files.
-        imports_sourcemap = self._resolve_import_stmts(import_stmts)
-        imports_sourcemap = self._synthesize_imports(imports_sourcemap)
-        imports_sourcemap = self._synthesize_dependencies(imports_sourcemap)
-        imports_sourcemap = self._apply_pattern_deps(imports_sourcemap)
-
-        build_template = BazelBuildTemplate()
-        self._append_header(build_template)
-        if self.generate_library_targets:
-            self._build_library_targets(imports_sourcemap, build_template)
-        if self.generate_test_targets:
-            self._build_test_targets(imports_sourcemap, build_template)
-        if self.generate_shared_library:
-            self._build_shared_library_target(imports_sourcemap, build_template)
-        if self.generate_test_suite_target:
-            self._build_test_suite_target(imports_sourcemap, build_template)
-        self._append_footer(build_template)
-        return str(build_template)
+        with stats.phase("synthesize"):
+            imports_sourcemap = self._synthesize_imports(imports_sourcemap)
+            imports_sourcemap = self._synthesize_dependencies(imports_sourcemap)
+            imports_sourcemap = self._apply_pattern_deps(imports_sourcemap)
+        for resolved_imports in imports_sourcemap.itervalues():
+            for resolved_import in resolved_imports:
+                stats.count("imports.{}".format(resolved_import.scope))
+
+        with stats.phase("build"):
+            build_template = BazelBuildTemplate()
+            self._append_header(build_template)
+            if self.generate_library_targets:
+                self._build_library_targets(imports_sourcemap, build_template)
+            if self.generate_test_targets:
+                self._build_test_targets(imports_sourcemap, build_template, test_counts)
+            if self.generate_shared_library:
+                self._build_shared_library_target(imports_sourcemap, build_template)
+            if self.generate_test_suite_target:
+                self._build_test_suite_target(imports_sourcemap, build_template)
+            if self.granularity == "component":
+                self._group_library_targets(build_template)
+            self._append_footer(build_template)
+        if self.dependency_index is not None:
+            self.dependency_index.update(self.workspace.relative(os.getcwd()), build_template)
+        return build_template
 
     def _filter_ignored_files(self, filepaths):
         return [filepath for filepath in filepaths if filepath not in self.ignored_files]
 
-    def _parse_code_files(self, filepaths):
-        # type: (list) -> dict
-        codes = {}
+    def _read_code_files(self, filepaths):
+        # type: (list) -> Iterator[(str, str)]
         for filepath in filepaths:
-            with open(filepath) as fp:
-                data = fp.read()
-                code = ast.parse(data, filepath)
-                codes[filepath] = code
-        return codes
+            with stats.phase("read"):
+                with open(filepath) as fp:
+                    data = fp.read()
+            yield filepath, data
 
-    def _filter_import_nodes(self, codes):
-        # type: (dict) -> dict
-        import_nodes = {}
-        for filepath, code in codes.iteritems():
-            import_nodes[filepath] = []
-            for node in ast.walk(code):
-                if not isinstance(node, ast.ImportFrom) and not isinstance(node, ast.Import):
-                    continue
-                # import statements that don't occur at the top level could lead to circular dependencies.
-                if node.col_offset > ImportStatement.TOP_LEVEL and not self.allow_scoped_imports:
-                    self._logger.debug("%s:%d:%d ignored scoped import; use --allow-scoped-imports to allow them.",
-                            filepath, node.lineno, node.col_offset)
-                    continue
-                import_nodes[filepath].append(node)
+    def _extract_import_stmts(self, sources):
+        # type: (Iterable[(str, str)]) -> Iterator[(str, list, (int, int))]
+        """
+        Yields the import statements and the number of test classes and test methods of the given files. Files whose
+        contents haven't changed since the last run don't need to be parsed again. The others are parsed one at a time,
+        or by the process pool in batches of PARSE_BATCH_SIZE files, which bounds the sources held at once.
+        """
+        batch = []
+        for filepath, data in sources:
+            with stats.phase("parse"):
+                key = None
+                entry = None
+                if self.import_cache is not None:
+                    key = ImportCache.make_key(data, self.allow_scoped_imports)
+                    entry = self.import_cache.get(key)
+                if entry is not None:
+                    records, test_count = entry
+                    result = (filepath, [ImportStatement.from_record(filepath, record) for record in records],
+                              test_count)
+                elif self.pool is not None:
+                    batch.append((filepath, data, key))
+                    result = None
+                else:
+                    import_stmts, test_count = self._parse_import_stmts(filepath, data)
+                    self._store_cached_import_stmts(key, import_stmts, test_count)
+                    result = (filepath, import_stmts, test_count)
+            if result is not None:
+                yield result
+            if len(batch) >= Ramsay.PARSE_BATCH_SIZE:
+                for result in self._extract_import_stmts_in_parallel(batch):
+                    yield result
+                batch = []
+        if batch:
+            for result in self._extract_import_stmts_in_parallel(batch):
+                yield result
+
+    def _extract_import_stmts_in_parallel(self, batch):
+        # type: (list) -> list
+        # workers only send back the compact import records; the ASTs never leave the worker processes. (A timeout on
+        # get() keeps the main process responsive to KeyboardInterrupt on Python 2.)
+        with stats.phase("parse"):
+            tasks = [(filepath, data, self.allow_scoped_imports) for filepath, data, key in batch]
+            results = self.pool.map_async(extract_import_records, tasks).get(sys.maxint)
+            extracted = []
+            for (filepath, data, key), (filepath, records, test_count, nodes_visited) in zip(batch, results):
+                import_stmts = [ImportStatement.from_record(filepath, record) for record in records]
+                self._store_cached_import_stmts(key, import_stmts, test_count)
+                extracted.append((filepath, import_stmts, test_count))
+                stats.count("files_parsed")
+                stats.count("ast_nodes_visited", nodes_visited)
+            return extracted
+
+    def _store_cached_import_stmts(self, key, import_stmts, test_count):
+        # type: (str, list, (int, int)) -> None
+        if self.import_cache is None:
+            return
+        self.import_cache.put(key, ([stmt.to_record() for stmt in import_stmts], test_count))
+
+    def _parse_import_stmts(self, filepath, data):
+        # type: (str, str) -> (list, (int, int))
+        """
+        Parses a file and returns its import statements and its number of test classes and test methods. The AST is
+        dropped as soon as they're extracted.
+        """
+        code = self._parse_code_file(filepath, data)
+        # we only care about import nodes (and counting the tests, while we have the AST at hand).
+        import_nodes = Ramsay.find_import_nodes(filepath, code, self.allow_scoped_imports)
+        return self._reify_import_nodes(filepath, import_nodes), Ramsay.count_tests(code)
+
+    def _parse_code_file(self, filepath, data):
+        # type: (str, str) -> ast.Module
+        stats.count("files_parsed")
+        return ast.parse(data, filepath)
+
+    @classmethod
+    def find_import_nodes(cls, filepath, code, allow_scoped_imports):
+        # type: (str, ast.Module, bool) -> list
+        # unless scoped imports are allowed, only the module's top-level statements can contain relevant imports. Walking
+        # the whole tree would mostly visit function bodies whose imports get discarded anyway.
+        nodes = ast.walk(code) if allow_scoped_imports else Ramsay._iter_top_level_stmts(code.body)
+        import_nodes = []
+        nodes_visited = 0
+        for node in nodes:
+            nodes_visited += 1
+            if not isinstance(node, ast.ImportFrom) and not isinstance(node, ast.Import):
+                continue
+            # import statements that don't occur at the top level could lead to circular dependencies.
+            if node.col_offset > ImportStatement.TOP_LEVEL and not allow_scoped_imports:
+                cls._logger.debug("%s:%d:%d ignored scoped import; use --allow-scoped-imports to allow them.",
+                        filepath, node.lineno, node.col_offset)
+                continue
+            import_nodes.append(node)
+        stats.count("ast_nodes_visited", nodes_visited)
         return import_nodes
 
-    def _reify_import_nodes(self, import_nodes):
-        # type: (dict) -> dict
-        import_stmts = {}
-        for filepath, nodes in import_nodes.iteritems():
-            import_stmts[filepath] = []
-            for node in nodes:
-                stmt = ImportStatement.derive_from_ast_node(filepath, node)
-                import_stmts[filepath].extend(stmt)
+    @classmethod
+    def count_tests(cls, code):
+        # type: (ast.Module) -> (int, int)
+        """
+        Returns the number of test classes and test methods of a module: the top-level classes with test methods and
+        their methods whose names start with "test", plus top-level test functions.
+        """
+        classes, methods = 0, 0
+        for stmt in code.body:
+            if isinstance(stmt, ast.ClassDef):
+                class_methods = sum(1 for node in stmt.body
+                                    if isinstance(node, ast.FunctionDef) and node.name.startswith("test"))
+                if class_methods:
+                    classes += 1
+                    methods += class_methods
+            elif isinstance(stmt, ast.FunctionDef) and stmt.name.startswith("test"):
+                methods += 1
+        return classes, methods
+
+    @classmethod
+    def _iter_top_level_stmts(cls, stmts):
+        # type: (list) -> Iterator[ast.stmt]
+        """
+        Yields the given statements and the statements of any if/try blocks among them. Imports in these blocks (e.g.
+        optional imports) are at least indented by one level, so they're still reported as scoped imports.
+        """
+        for stmt in stmts:
+            yield stmt
+            if isinstance(stmt, ast.If):
+                nested_stmts = stmt.body + stmt.orelse
+            elif isinstance(stmt, ast.TryExcept):
+                nested_stmts = stmt.body + [s for handler in stmt.handlers for s in handler.body] + stmt.orelse
+            elif isinstance(stmt, ast.TryFinally):
+                nested_stmts = stmt.body + stmt.finalbody
+            else:
+                continue
+            for nested_stmt in cls._iter_top_level_stmts(nested_stmts):
+                yield nested_stmt
+
+    def _reify_import_nodes(self, filepath, import_nodes):
+        # type: (str, list) -> list
+        import_stmts = []
+        for node in import_nodes:
+            import_stmts.extend(ImportStatement.derive_from_ast_node(filepath, node))
         return import_stmts
 
     def _resolve_import_stmts(self, import_stmts):
-        # type: (dict) -> dict
-        resolved_imports_sourcemap = {}
-        for filepath, import_stmts in import_stmts.iteritems():
-            resolved_imports_sourcemap[filepath] = []
-            for import_stmt in import_stmts:
-                resolved_import = import_stmt.resolve(self.workspace)
-                resolved_imports_sourcemap[filepath].append(resolved_import)
-            resolved_imports_sourcemap[filepath].sort(key=operator.attrgetter("bazel_path"))
-        return resolved_imports_sourcemap
+        # type: (Iterable[(str, list, (int, int))]) -> Iterator[(str, list, (int, int))]
+        for filepath, stmts, test_count in import_stmts:
+            with stats.phase("resolve"):
+                resolved_imports = [import_stmt.resolve(self.workspace) for import_stmt in stmts]
+                resolved_imports.sort(key=operator.attrgetter("bazel_path"))
+            yield filepath, resolved_imports, test_count
+
+    # the synthesize stages append to the resolved imports of the files in place rather than copying the sourcemap.
 
     def _synthesize_imports(self, imports_sourcemap):
         # type: (dict) -> dict
-        manual_imports_sourcemap = {}
         for filepath, resolved_imports in imports_sourcemap.iteritems():
-            manual_imports = resolved_imports[:]
             for module in self.manual_imports.get(filepath, []):
-                manual_import = ImportStatement.synthesize(filepath, module)
-                resolved_manual_import = manual_import.resolve(self.workspace)
-                manual_imports.append(resolved_manual_import)
-            manual_imports_sourcemap[filepath] = manual_imports
-        return manual_imports_sourcemap
+                resolved_imports.append(self._resolve_manual_import(module))
+        return imports_sourcemap
+
+    def _resolve_manual_import(self, module):
+        # type: (str) -> ResolvedImport
+        """
+        Resolves a synthesized import. An absolute import resolves the same for every file of the package, so every
+        module is only resolved once and its ResolvedImport is shared by all files that synthesize it.
+        """
+        resolved_import = self._resolved_manual_imports.get(module)
+        if resolved_import is None:
+            stats.count("manual_imports.misses")
+            resolved_import = ImportStatement.synthesize(Config.FILENAME, module).resolve(self.workspace)
+            self._resolved_manual_imports[module] = resolved_import
+        else:
+            stats.count("manual_imports.hits")
+        return resolved_import
 
     def _synthesize_dependencies(self, imports_sourcemap):
         # type: (dict) -> dict
-        manual_dependencies_sourcemap = {}
         for filepath, resolved_imports in imports_sourcemap.iteritems():
-            manual_dependencies = resolved_imports[:]
             for bazel_path in self.manual_dependencies.get(filepath, []):
-                manual_dependencies.append(ResolvedImport.make_manual_import(filepath, bazel_path))
-            manual_dependencies_sourcemap[filepath] = manual_dependencies
-        return manual_dependencies_sourcemap
+                resolved_imports.append(ResolvedImport.make_manual_import(filepath, bazel_path))
+        return imports_sourcemap
 
     def _apply_pattern_deps(self, imports_sourcemap):
         # type: (dict) -> dict
-        pattern_deps_sourcemap = {}
-        patterns = {regex: re.compile(regex) for regex in self.pattern_deps}
         for filepath, resolved_imports in imports_sourcemap.iteritems():
-            pattern_deps_imports = resolved_imports[:]
-            for regexp, pattern_deps in self.pattern_deps.iteritems():
-                if patterns[regexp].match(filepath) is None:
-                    continue
-                for module in pattern_deps.get("manual_imports", []):
-                    manual_import = ImportStatement.synthesize(filepath, module)
-                    resolved_manual_import = manual_import.resolve(self.workspace)
-                    pattern_deps_imports.append(resolved_manual_import)
-                for bazel_path in pattern_deps.get("manual_dependencies", []):
-                    pattern_deps_imports.append(ResolvedImport.make_manual_import(filepath, bazel_path))
-            pattern_deps_sourcemap[filepath] = pattern_deps_imports
-        return pattern_deps_sourcemap
+            for regex in self.pattern_deps_matcher.match(filepath):
+                resolved_imports.extend(self._resolve_pattern_deps(regex))
+        return imports_sourcemap
+
+    def _resolve_pattern_deps(self, regex):
+        # type: (str) -> list[ResolvedImport]
+        """
+        Returns the resolved imports and dependencies of a pattern_deps rule; they're shared by all files it matches.
+        """
+        resolved_imports = self._resolved_pattern_deps.get(regex)
+        if resolved_imports is None:
+            pattern_deps = self.pattern_deps[regex]
+            resolved_imports = [self._resolve_manual_import(module)
+                                for module in pattern_deps.get("manual_imports", [])]
+            resolved_imports.extend(ResolvedImport.make_manual_import(Config.FILENAME, bazel_path)
+                                    for bazel_path in pattern_deps.get("manual_dependencies", []))
+            self._resolved_pattern_deps[regex] = resolved_imports
+        return resolved_imports
 
     def _build_library_targets(self, imports_sourcemap, build_template):
         # type: (dict, BazelBuildTemplate) -> BazelBuildTemplate
@@ -281,8 +1580,8 @@ class Ramsay:
             build_template.add_library(name=to_safe_target_name(filepath), srcs=[filepath], deps=deps, data=data, tags=tags)
         return build_template
 
-    def _build_test_targets(self, imports_sourcemap, build_template):
-        # type: (dict, BazelBuildTemplate) -> BazelBuildTemplate
+    def _build_test_targets(self, imports_sourcemap, build_template, test_counts=None):
+        # type: (dict, BazelBuildTemplate, dict) -> BazelBuildTemplate
         for filepath in sorted(imports_sourcemap):
             if not filepath.startswith(Ramsay.TEST_PREFIX):
                 continue
@@ -307,22 +1606,70 @@ class Ramsay:
                 tags.add(bazel_tag)
             tags = list(tags)
             tags.sort()
+            name = to_safe_target_name(Ramsay.TEST_PREFIX + filepath)
+            size, timeout, flaky = self._infer_test_properties(name)
+            size = self.manual_sizes.get(filepath, size)
+            # the inferred timeout is only set if it differs from the default timeout of the test's size.
+            if timeout == TestHistory.DEFAULT_TIMEOUTS.get(size or "medium"):
+                timeout = None
             build_template.add_load_stmt(Ramsay.RULESET, Ramsay.TEST_TARGET)
             build_template.add_test(
-                    name=to_safe_target_name(Ramsay.TEST_PREFIX + filepath),
+                    name=name,
                     srcs=[filepath],
                     deps=deps,
                     data=data,
                     tags=tags,
-                    size=self.manual_sizes.get(filepath, None),
-                    timeout=self.manual_timeouts.get(filepath, None),
-                    flaky=self.manual_flaky.get(filepath, False))
+                    size=size,
+                    timeout=self.manual_timeouts.get(filepath, timeout),
+                    shard_count=self._infer_shard_count(filepath, (test_counts or {}).get(filepath)),
+                    flaky=self.manual_flaky.get(filepath, flaky))
         return build_template
 
+    def _infer_test_properties(self, name):
+        # type: (str) -> (str, str, bool)
+        """
+        Returns the size, timeout and flaky flag of a test target as inferred from its past runs. The flaky flag is only
+        inferred if infer_flaky is set.
+        """
+        if self.test_history is None:
+            return None, None, False
+        package = self.workspace.relative(os.getcwd())
+        runs = self.test_history.lookup("" if package == os.curdir else package, name)
+        if not runs:
+            return None, None, False
+        size, timeout = TestHistory.classify([seconds for seconds, passed in runs])
+        return size, timeout, self.infer_flaky and TestHistory.is_flaky(runs)
+
+    def _infer_shard_count(self, filepath, test_count):
+        # type: (str, (int, int)) -> int
+        """
+        Returns the shard count of a test file: the manual shard count if there is one, otherwise one shard per
+        tests_per_shard test methods (up to max_shard_count) for files with more than tests_per_shard test methods.
+        """
+        if filepath in self.manual_shard_counts:
+            return self.manual_shard_counts[filepath] or None
+        if not self.tests_per_shard or test_count is None:
+            return None
+        classes, methods = test_count
+        if methods <= self.tests_per_shard:
+            return None
+        shard_count = min(-(-methods // self.tests_per_shard), self.max_shard_count)
+        self._logger.debug("%s: sharding %d test methods in %d classes %d ways", filepath, methods, classes, shard_count)
+        return shard_count if shard_count > 1 else None
+
     def _build_test_suite_target(self, imports_sourcemap, build_template):
         # type: (dict, BazelBuildTemplate) -> BazelBuildTemplate
         if len(build_template.tests):
             build_template.add_test_suite(name="python_test_suite")
+        # with a test history, the tests are also grouped by size, so the fast ones can be run first.
+        if self.test_history is not None:
+            tests_by_size = collections.defaultdict(list)
+            for test in build_template.tests:
+                tests_by_size[test.size or "medium"].append(":" + test.name)
+            for size, _, _ in TestHistory.SIZES:
+                if size in tests_by_size:
+                    build_template.add_test_suite(name="python_{}_test_suite".format(size),
+                                                  tests=sorted(tests_by_size[size]))
         return build_template
 
     def _build_shared_library_target(self, imports_sourcemap, build_template):
@@ -339,6 +1686,65 @@ class Ramsay:
         build_template.add_library(name="python_shared_library", deps=deps)
         return build_template
 
+    def _group_library_targets(self, build_template):
+        # type: (BazelBuildTemplate) -> BazelBuildTemplate
+        """
+        Replaces the per-file libraries with one library per group of files (see LibraryGrouper). The libraries of
+        grouped files are kept as aliases of their group's library, so labels in other packages remain valid. The
+        libraries of test files are never grouped; they count as dependents of the libraries they depend on instead.
+        """
+        package = self.workspace.relative(os.getcwd())
+        prefix = "//{}:".format("" if package == os.curdir else package)
+        libraries = collections.OrderedDict()
+        test_libraries = []
+        for library in build_template.libraries:
+            if not library.srcs:
+                continue
+            if all(src.startswith(Ramsay.TEST_PREFIX) for src in library.srcs):
+                test_libraries.append(library)
+            else:
+                libraries[library.name] = library
+        deps = {name: [dep[len(prefix):] for dep in library.deps
+                       if dep.startswith(prefix) and dep[len(prefix):] in libraries and dep[len(prefix):] != name]
+                for name, library in libraries.iteritems()}
+        external_dependents = {name: sum(1 for library in test_libraries if prefix + name in library.deps)
+                               for name in libraries}
+        if self.dependency_index is not None:
+            for name in libraries:
+                external_dependents[name] += sum(1 for label in self.dependency_index.dependents(prefix + name)
+                                                 if not label.startswith(prefix))
+        groups = LibraryGrouper(deps, external_dependents, self.target_cost).group()
+
+        # maps the labels and names of grouped libraries to the labels and names of their groups.
+        renames = {}
+        grouped_libraries = {}
+        for group in groups:
+            if len(group) == 1:
+                continue
+            members = [libraries[name] for name in group]
+            name = "{}_group".format(group[0])
+            for member in group:
+                renames[prefix + member] = prefix + name
+                renames[member] = name
+            grouped_libraries[group[0]] = PyzLibraryTarget(
+                name,
+                sorted(src for member in members for src in member.srcs),
+                sorted(set(dep for member in members for dep in member.deps)),
+                sorted(set(path for member in members for path in member.data)),
+                sorted(set(tag for member in members for tag in member.tags)),
+                members[0].pythonroot)
+            for member in group:
+                build_template.add_alias(member, ":" + name)
+            self._logger.debug("grouped %s into %s", ", ".join(group), name)
+
+        grouped_names = set(renames)
+        build_template.libraries = [grouped_libraries.get(library.name, library) for library in build_template.libraries
+                                    if library.name not in grouped_names or library.name in grouped_libraries]
+        for target in build_template.libraries + build_template.tests:
+            target_label = prefix + target.name
+            target.deps = sorted(set(renames.get(dep, dep) for dep in target.deps) - {target_label, target.name})
+        return build_template
+
     def _append_header(self, build_template):
         # type: (BazelBuildTemplate) -> BazelBuildTemplate
         build_template.add_header(self.header)
@@ -355,7 +1761,8 @@ class Workspace:
 
     _logger = logging.getLogger(__name__)
 
-    def __init__(self, root, module_aliases, ignored_modules, third_party_modules):
+    def __init__(self, root, module_aliases, ignored_modules, third_party_modules, module_index=None,
+            classifier=None, third_party_package="python2/third_party/pypi"):
         if not os.path.isabs(root):
             raise ValueError("{} is not an absolute path".format(root))
         if not os.path.isdir(root):
@@ -367,15 +1774,35 @@ class Workspace:
         self.module_aliases = module_aliases
         self.ignored_modules = ignored_modules
         self.third_party_modules = third_party_modules
+        self.module_index = module_index
+        self.classifier = classifier or \
+            ModuleClassifier(module_aliases, ignored_modules, SYSTEM_MODULES, third_party_modules)
+        self.third_party_package = third_party_package
+        self.stat_cache = StatCache()
+        # maps (module, name, level, importing directory) to the ResolvedImport of such an import (see
+        # ImportStatement.resolve).
+        self.resolved_imports = {}
+
+    def reset_caches(self):
+        # type: () -> None
+        """
+        Forgets the memoized resolutions and file system queries, which are only valid as long as no files change and
+        the working directory stays the same.
+        """
+        self.stat_cache.clear()
+        self.resolved_imports.clear()
 
     @classmethod
-    def from_config(cls, config):
-        # type: (Config) -> Workspace
+    def from_config(cls, config, module_index=None):
+        # type: (Config, ModuleIndex) -> Workspace
         return Workspace(
                 config.workspace_dir,
                 config.module_aliases,
                 config.ignored_modules,
-                config.third_party_modules)
+                config.third_party_modules,
+                module_index,
+                ModuleClassifier.from_config(config),
+                config.third_party_package)
 
     @classmethod
     def find_workspace_abs_dirpath(cls, path=os.getcwd()):
@@ -395,35 +1822,21 @@ class Workspace:
             else:
                 return path
 
+    def classify_module(self, module):
+        # type: (str) -> str
+        return self.classifier.classify(module)
+
     def is_system_module(self, module):
         # type: (str) -> bool
-        components = module.split(".")
-        assert(len(components) > 0)
-        assert(len(components[0]) > 0)
-        return module in SYSTEM_MODULES or \
-                components[0] in SYSTEM_MODULES or \
-                self.module_aliases.get(module, module) in SYSTEM_MODULES or \
-                self.module_aliases.get(components[0], components[0]) in SYSTEM_MODULES
+        return self.classifier.classify(module) is ModuleClassifier.SITE
 
     def is_ignored_module(self, module):
         # type: (str) -> bool
-        components = module.split(".")
-        assert(len(components) > 0)
-        assert(len(components[0]) > 0)
-        return module in self.ignored_modules or \
-                components[0] in self.ignored_modules or \
-                self.module_aliases.get(module, module) in self.ignored_modules or \
-                self.module_aliases.get(components[0], components[0]) in self.ignored_modules
+        return self.classifier.classify(module) is ModuleClassifier.IGNORED
 
     def is_third_party_module(self, module):
         # type: (str) -> bool
-        components = module.split(".")
-        assert(len(components) > 0)
-        assert(len(components[0]) > 0)
-        return module in self.third_party_modules or \
-                components[0] in self.third_party_modules or \
-                self.module_aliases.get(module, module) in self.third_party_modules or \
-                self.module_aliases.get(components[0], components[0]) in self.third_party_modules
+        return self.classifier.classify(module) is ModuleClassifier.THIRD_PARTY
 
     def map_absolute_module(self, module, name):
         # type: (str) -> ("file"|"directory", str)
@@ -441,52 +1854,43 @@ class Workspace:
         if name is not None:
             components.append(name)
 
-        workspace_relative_path = "/".join(components)
-        assert(not os.path.isabs(workspace_relative_path))
-
-        path = os.path.realpath(os.path.join(os.getcwd(), workspace_relative_path))
-        if os.path.isdir(path):
-            self._logger.debug("mapped absolute module '%s' to relative directory path '%s'", module, path)
-            return ("dir", path)
-        path = path + ".py"
-        if os.path.isfile(path):
-            self._logger.debug("mapped absolute module '%s' to relative file path '%s'", module, path)
-            return ("file", path)
-
-        path = os.path.realpath(os.path.join(self.root, workspace_relative_path))
-        if os.path.isdir(path):
-            self._logger.debug("mapped absolute module '%s' to absolute directory path '%s'", module, path)
-            return ("dir", path)
-        path = path + ".py"
-        if os.path.isfile(path):
-            self._logger.debug("mapped absolute module '%s' to absolute file path '%s'", module, path)
-            return ("file", path)
+        position, path = self._map_workspace_relative_path(module, "/".join(components))
+        if position is not None:
+            return (position, path)
 
         if name is None:
             return (None, None)
         components.pop()
 
-        workspace_relative_path = "/".join(components)
-        assert(not os.path.isabs(workspace_relative_path))
+        return self._map_workspace_relative_path(module, "/".join(components))
 
-        path = os.path.realpath(os.path.join(os.getcwd(), workspace_relative_path))
-        if os.path.isdir(path):
-            self._logger.debug("mapped absolute module '%s' to relative directory path '%s'", module, path)
-            return ("dir", path)
-        path = path + ".py"
-        if os.path.isfile(path):
-            self._logger.debug("mapped absolute module '%s' to relative file path '%s'", module, path)
-            return ("file", path)
+    def _map_workspace_relative_path(self, module, workspace_relative_path):
+        # type: (str, str) -> ("file"|"directory", str)
+        assert(not os.path.isabs(workspace_relative_path))
+        for kind, dirpath in (("relative", os.getcwd()), ("absolute", self.root)):
+            position, path = self._map_path(os.path.join(dirpath, workspace_relative_path))
+            if position is "dir":
+                self._logger.debug("mapped absolute module '%s' to %s directory path '%s'", module, kind, path)
+                return (position, path)
+            elif position is "file":
+                self._logger.debug("mapped absolute module '%s' to %s file path '%s'", module, kind, path)
+                return (position, path)
+        return (None, None)
 
-        path = os.path.realpath(os.path.join(self.root, workspace_relative_path))
-        if os.path.isdir(path):
-            self._logger.debug("mapped absolute module '%s' to absolute directory path '%s'", module, path)
+    def _map_path(self, path):
+        # type: (str) -> ("file"|"directory", str)
+        if self.module_index is not None:
+            mapped = self.module_index.lookup(path)
+            if mapped is not None:
+                stats.count("module_index.hits")
+                return mapped
+            stats.count("module_index.misses")
+        path = self.stat_cache.realpath(path)
+        if self.stat_cache.isdir(path):
             return ("dir", path)
         path = path + ".py"
-        if os.path.isfile(path):
-            self._logger.debug("mapped absolute module '%s' to absolute file path '%s'", module, path)
+        if self.stat_cache.isfile(path):
             return ("file", path)
-
         return (None, None)
 
     def map_relative_module(self, filepath, module, level):
@@ -494,12 +1898,12 @@ class Workspace:
         components = module.split(".")
         assert(len(components) > 0)
         module = "/".join(components)
-        path = os.path.join(self.up_by(os.path.realpath(filepath), level), module)
-        if os.path.isdir(path):
+        path = os.path.join(self.up_by(self.stat_cache.realpath(filepath), level), module)
+        if self.stat_cache.isdir(path):
             self._logger.debug("mapped relative module '%s' to relative directory path '%s'", module, path)
             return ("dir", path)
         path = path + ".py"
-        if os.path.isfile(path):
+        if self.stat_cache.isfile(path):
             self._logger.debug("mapped relative module '%s' to relative file path '%s'", module, path)
             return ("file", path)
         return (None, None)
@@ -520,12 +1924,740 @@ class Workspace:
         components = module.split(".")
         return self.module_aliases.get(components[0], components[0])
 
+    def map_to_pypi_label(self, module):
+        # type: (str) -> str
+        return "//{}:{}".format(self.third_party_package, self.map_to_pypi_target(module))
+
     def __str__(self):
         return self.root
 
 
+class StatCache:
+    """
+    Memoizes the file system queries of import resolution: realpath, isdir and isfile. The entries of a directory are
+    listed once, so a query for a path that isn't in its directory's listing (the common case when probing for modules)
+    is answered without a system call, and one stat answers both isdir and isfile for existing paths. Hits and misses
+    are counted as "stat_cache.hits" and "stat_cache.misses"; the actual system calls as "fs.<call>".
+    """
+
+    def __init__(self):
+        self._realpaths = {}
+        # maps directories to the set of their entries, or None if they can't be listed.
+        self._listings = {}
+        # maps paths to "dir", "file" or None if they don't exist (or are something else).
+        self._kinds = {}
+
+    def clear(self):
+        # type: () -> None
+        self._realpaths.clear()
+        self._listings.clear()
+        self._kinds.clear()
+
+    def realpath(self, path):
+        # type: (str) -> str
+        realpath = self._realpaths.get(path)
+        if realpath is not None:
+            stats.count("stat_cache.hits")
+            return realpath
+        stats.count("stat_cache.misses")
+        stats.count("fs.realpath")
+        realpath = self._realpaths[path] = os.path.realpath(path)
+        return realpath
+
+    def isdir(self, path):
+        # type: (str) -> bool
+        return self._kind(path) == "dir"
+
+    def isfile(self, path):
+        # type: (str) -> bool
+        return self._kind(path) == "file"
+
+    def _kind(self, path):
+        # type: (str) -> str
+        if path in self._kinds:
+            stats.count("stat_cache.hits")
+            return self._kinds[path]
+        dirpath, filename = os.path.split(path)
+        listing = self._listing(dirpath) if filename not in ("", os.curdir, os.pardir) else None
+        if listing is not None and filename not in listing:
+            stats.count("stat_cache.hits")
+            self._kinds[path] = None
+            return None
+        stats.count("stat_cache.misses")
+        stats.count("fs.stat")
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            kind = None
+        else:
+            kind = "dir" if stat.S_ISDIR(mode) else "file" if stat.S_ISREG(mode) else None
+        self._kinds[path] = kind
+        return kind
+
+    def _listing(self, dirpath):
+        # type: (str) -> frozenset
+        if dirpath in self._listings:
+            return self._listings[dirpath]
+        stats.count("fs.listdir")
+        try:
+            listing = frozenset(os.listdir(dirpath or os.curdir))
+        except OSError as e:
+            # a missing directory has no entries; one that can't be listed falls back to stat.
+            listing = frozenset() if e.errno in (errno.ENOENT, errno.ENOTDIR) else None
+        self._listings[dirpath] = listing
+        return listing
+
+
+class ModuleClassifier:
+    """
+    Classifies modules as ignored, site (ie. system), third-party or local modules. A module falls into a class if the
+    module itself, its top-level package or the alias of either is in the class's list of modules. The aliases are
+    applied to the lists up front, so classifying a module takes at most two set lookups per class; the results are
+    memoized.
+    """
+    IGNORED = "ignored"
+    SITE = "site"
+    THIRD_PARTY = "third_party"
+    LOCAL = "local"
+
+    def __init__(self, module_aliases, ignored_modules, system_modules, third_party_modules):
+        self.module_aliases = module_aliases
+        self.ignored_modules = self._expand_aliases(ignored_modules)
+        self.system_modules = self._expand_aliases(system_modules)
+        self.third_party_modules = self._expand_aliases(third_party_modules)
+        self._classifications = {}
+
+    @classmethod
+    def from_config(cls, config):
+        # type: (Config) -> ModuleClassifier
+        if config.target_interpreter not in SYSTEM_MODULES_BY_INTERPRETER:
+            raise ValueError("unsupported target interpreter '{}'; use one of {}".format(
+                config.target_interpreter, ", ".join(sorted(SYSTEM_MODULES_BY_INTERPRETER))))
+        return ModuleClassifier(
+                config.module_aliases,
+                config.ignored_modules,
+                SYSTEM_MODULES_BY_INTERPRETER[config.target_interpreter],
+                config.third_party_modules)
+
+    def _expand_aliases(self, modules):
+        # type: (list) -> frozenset
+        modules = frozenset(modules)
+        return modules | frozenset(alias for alias, module in self.module_aliases.iteritems() if module in modules)
+
+    def classify(self, module):
+        # type: (str) -> str
+        classification = self._classifications.get(module)
+        if classification is not None:
+            stats.count("classifier.hits")
+            return classification
+        stats.count("classifier.misses")
+        components = module.split(".", 1)
+        assert(len(components[0]) > 0)
+        top_level_module = components[0]
+        if module in self.ignored_modules or top_level_module in self.ignored_modules:
+            classification = ModuleClassifier.IGNORED
+        elif module in self.system_modules or top_level_module in self.system_modules:
+            classification = ModuleClassifier.SITE
+        elif module in self.third_party_modules or top_level_module in self.third_party_modules:
+            classification = ModuleClassifier.THIRD_PARTY
+        else:
+            classification = ModuleClassifier.LOCAL
+        self._classifications[module] = classification
+        return classification
+
+
+class ModuleIndex:
+    """
+    An index of the directories and Python files in the workspace, so mapping a module to a path doesn't need to probe
+    the filesystem. The index is built lazily and persisted in the cache directory: a lookup validates the directories
+    on its path with one stat each (once per run), and only the directories whose mtime changed (ie. entries were added,
+    removed or renamed) or that weren't indexed yet are scanned. The system calls are counted as "fs.<call>".
+
+    Symbolic links and hidden directories aren't indexed. Paths that go through them are reported as unknown, so the
+    caller can fall back to the filesystem.
+    """
+    FILENAME = "modules.json"
+    VERSION = 1
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, root, dirs=None, path=None):
+        # type: (str, dict, str) -> None
+        self.root = os.path.realpath(root)
+        # maps a workspace-relative directory path to (mtime, subdirectories, python modules, unindexed entries)
+        self.dirs = dirs or {}
+        self.path = path
+        self.changed = False
+        self._prefix = os.path.join(self.root, "")
+        # the directories whose entries were validated since the index was (re)loaded or invalidated.
+        self._validated = set()
+        self._files = set()
+        self._unindexed = set()
+        for dirpath, entry in self.dirs.iteritems():
+            self._add_entry(dirpath, entry)
+
+    @classmethod
+    def from_config(cls, config):
+        # type: (Config) -> ModuleIndex
+        """
+        Loads the module index from the configured cache directory. Returns None if caching is disabled; scanning the
+        looked-up directories on every run would be slower than probing the filesystem.
+        """
+        if not config.enable_cache or not config.cache_dir or not config.workspace_dir:
+            return None
+        return ModuleIndex.load(config.workspace_dir, os.path.join(config.cache_dir, ModuleIndex.FILENAME))
+
+    @classmethod
+    def load(cls, root, path):
+        # type: (str, str) -> ModuleIndex
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return ModuleIndex(root, path=path)
+        if data.get("version") != ModuleIndex.VERSION or data.get("root") != os.path.realpath(root):
+            return ModuleIndex(root, path=path)
+        return ModuleIndex(root, {str(dirpath): (entry[0], [str(name) for name in entry[1]],
+                                                 [str(name) for name in entry[2]], [str(name) for name in entry[3]])
+                                  for dirpath, entry in data["dirs"].iteritems()}, path)
+
+    def flush(self):
+        # type: () -> None
+        """
+        Saves the index if lookups changed it since it was loaded or last flushed.
+        """
+        if self.changed and self.path:
+            self.save(self.path)
+            self.changed = False
+
+    def save(self, path):
+        # type: (str) -> None
+        try:
+            cache_dir = os.path.dirname(path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = "{}.{}".format(path, os.getpid())
+            with open(tmp_path, "w") as fp:
+                json.dump({"version": ModuleIndex.VERSION, "root": self.root, "dirs": self.dirs}, fp)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            self._logger.warning("failed to save the module index: %s", e)
+
+    def invalidate(self):
+        # type: () -> None
+        """
+        Makes the next lookups validate the directories on their paths again, e.g. for a new run or after files changed.
+        """
+        self._validated.clear()
+
+    def lookup(self, path):
+        # type: (str) -> ("file"|"directory", str)
+        """
+        Maps an absolute path to a module (without the .py extension) like Workspace.map_absolute_module would. Returns
+        None if the path isn't covered by the index.
+        """
+        if not path.startswith(self._prefix):
+            return None
+        relpath = path[len(self._prefix):]
+        self._validate("")
+        dirpath = ""
+        for name in relpath.split("/"):
+            dirpath = os.path.join(dirpath, name)
+            self._validate(dirpath)
+            if dirpath not in self.dirs:
+                break
+        if relpath in self.dirs:
+            return ("dir", path)
+        if relpath in self._files:
+            return ("file", path + ".py")
+        if relpath + ".py" in self._unindexed:
+            return None
+        components = relpath.split("/")
+        for i in range(1, len(components) + 1):
+            if "/".join(components[:i]) in self._unindexed:
+                return None
+        return (None, None)
+
+    def _validate(self, dirpath):
+        # type: (str) -> None
+        """
+        Brings the entry of an (indexed or new) directory up to date with one stat, unless it was validated before.
+        """
+        if dirpath in self._validated:
+            return
+        self._validated.add(dirpath)
+        parent = os.path.dirname(dirpath)
+        if dirpath and (parent not in self.dirs or os.path.basename(dirpath) not in self.dirs[parent][1]):
+            return
+        stats.count("fs.stat")
+        try:
+            mtime = os.stat(os.path.join(self.root, dirpath)).st_mtime
+        except OSError:
+            self._remove_dir(dirpath)
+            return
+        entry = self.dirs.get(dirpath)
+        if entry is not None and entry[0] == mtime:
+            return
+        scanned_entry = self._scan_dir(dirpath, mtime)
+        if entry is not None:
+            self._remove_entry(dirpath, entry)
+            for name in set(entry[1]) - set(scanned_entry[1]):
+                self._remove_dir(os.path.join(dirpath, name))
+        self.dirs[dirpath] = scanned_entry
+        self._add_entry(dirpath, scanned_entry)
+        self.changed = True
+
+    def _scan_dir(self, dirpath, mtime):
+        # type: (str, float) -> tuple
+        subdirs, modules, unindexed = [], [], []
+        for name, is_dir, is_file, is_link in self._list_dir(os.path.join(self.root, dirpath)):
+            if is_link or (is_dir and name.startswith(".")):
+                unindexed.append(name)
+            elif is_dir:
+                subdirs.append(name)
+            elif is_file and name.endswith(".py"):
+                modules.append(name[:-len(".py")])
+        return (mtime, sorted(subdirs), sorted(modules), sorted(unindexed))
+
+    def _list_dir(self, path):
+        # type: (str) -> list
+        if scandir is not None:
+            stats.count("fs.scandir")
+            return [(entry.name, entry.is_dir(follow_symlinks=False), entry.is_file(follow_symlinks=False),
+                     entry.is_symlink()) for entry in scandir(path)]
+        entries = []
+        stats.count("fs.listdir")
+        for name in os.listdir(path):
+            stats.count("fs.lstat")
+            mode = os.lstat(os.path.join(path, name)).st_mode
+            entries.append((name, stat.S_ISDIR(mode), stat.S_ISREG(mode), stat.S_ISLNK(mode)))
+        return entries
+
+    def _remove_dir(self, dirpath):
+        # type: (str) -> None
+        entry = self.dirs.pop(dirpath, None)
+        if entry is None:
+            return
+        self.changed = True
+        self._remove_entry(dirpath, entry)
+        for name in entry[1]:
+            self._remove_dir(os.path.join(dirpath, name))
+
+    def _add_entry(self, dirpath, entry):
+        # type: (str, tuple) -> None
+        self._files.update(os.path.join(dirpath, name) for name in entry[2])
+        self._unindexed.update(os.path.join(dirpath, name) for name in entry[3])
+
+    def _remove_entry(self, dirpath, entry):
+        # type: (str, tuple) -> None
+        self._files.difference_update(os.path.join(dirpath, name) for name in entry[2])
+        self._unindexed.difference_update(os.path.join(dirpath, name) for name in entry[3])
+
+
+class LibraryGrouper:
+    """
+    Groups the libraries of a package to reduce the number of targets. The files of an import cycle have to be in the
+    same library, so every strongly connected component of the package's import graph is a group to begin with.
+
+    Groups are then merged along their dependency edges as long as a cost model favors it: a library costs target_cost,
+    and every file that a dependent pulls in without needing it (the "runfiles fan-out") costs 1. Merging a group into
+    the group it depends on saves one library, but the other dependents of the dependency now pull in the files of the
+    dependent group, too. External dependents (the package's test libraries, which are never grouped, and the dependents
+    in other packages, as far as the dependency index knows about them) are assumed to need none of these files. Among
+    the merges that save more than they cost, the cheapest is done first, until no such merge is left. Merges that would
+    create a cycle between groups are skipped.
+    """
+
+    def __init__(self, deps, external_dependents, target_cost):
+        # type: (dict, dict, float) -> None
+        # maps the name of a library to the names of the libraries in the same package that it depends on.
+        self.deps = deps
+        self.external_dependents = external_dependents
+        self.target_cost = target_cost
+
+    def group(self):
+        # type: () -> list
+        """
+        Returns the groups as sorted lists of library names, ordered by their first name.
+        """
+        names = sorted(self.deps)
+        bits = {name: 1 << i for i, name in enumerate(names)}
+        groups = [frozenset(component) for component in strongly_connected_components(names, self.deps.get)]
+        while True:
+            merge = self._find_cheapest_merge(groups, bits)
+            if merge is None:
+                break
+            dependent, dependency = merge
+            groups = [group for group in groups if group is not dependent and group is not dependency] + \
+                [dependent | dependency]
+        return sorted(sorted(group) for group in groups)
+
+    def _find_cheapest_merge(self, groups, bits):
+        # type: (list, dict) -> (frozenset, frozenset)
+        group_of = {name: group for group in groups for name in group}
+        group_deps = {group: set(group_of[dep] for name in group for dep in self.deps[name]) - {group}
+                      for group in groups}
+        dependents = collections.defaultdict(set)
+        for group, deps in group_deps.iteritems():
+            for dep in deps:
+                dependents[dep].add(group)
+
+        # the files and the groups that each group depends on, transitively (including itself).
+        files, reachable = {}, {}
+        group_bits = {group: 1 << i for i, group in enumerate(groups)}
+        for component in strongly_connected_components(groups, group_deps.get):
+            group = component[0]
+            files[group] = reduce(operator.or_, (bits[name] for name in group), 0)
+            reachable[group] = group_bits[group]
+            for dep in group_deps[group]:
+                files[group] |= files[dep]
+                reachable[group] |= reachable[dep]
+
+        cheapest = None
+        for dependent in groups:
+            for dependency in group_deps[dependent]:
+                # merging is only possible if the dependency isn't also reachable through another group.
+                if any(other is not dependency and reachable[other] & group_bits[dependency]
+                       for other in group_deps[dependent]):
+                    continue
+                cost = 0
+                for other in dependents[dependency]:
+                    if other is not dependent:
+                        cost += bin(files[dependent] & ~files[other]).count("1")
+                cost += sum(self.external_dependents.get(name, 0) for name in dependency) * \
+                    bin(files[dependent] & ~files[dependency]).count("1")
+                if cost >= self.target_cost:
+                    continue
+                key = (cost, sorted(dependent | dependency))
+                if cheapest is None or key < cheapest[0]:
+                    cheapest = (key, (dependent, dependency))
+        return cheapest[1] if cheapest is not None else None
+
+
+class DependencyIndex:
+    """
+    A workspace-wide index of the generated targets: their sources, their dependencies and whether they're tests. Every
+    generated BUILD file updates the entries of its package, and the index is persisted in the cache directory, so
+    `ramsay affected` can answer which targets (transitively) depend on a file without querying Bazel.
+
+    The index only knows about the packages Ramsay generated BUILD files for; run `ramsay --recursive` over the
+    workspace to populate it.
+    """
+    FILENAME = "dependencies.json"
+    VERSION = 1
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, root, path=None, packages=None):
+        # type: (str, str, dict) -> None
+        self.root = os.path.realpath(root)
+        self.path = path
+        # maps a workspace-relative package path to {target name: (workspace-relative srcs, dependency labels, is_test)}
+        self.packages = packages or {}
+        # the packages whose targets count as third-party packages in closures.
+        self.third_party_packages = [Config.DEFAULT["third_party_dir"], Config.DEFAULT["third_party_package"]]
+        self.changed = False
+        self._targets = None
+        self._rdeps = None
+        self._targets_by_src = None
+        self._closures = None
+
+    @classmethod
+    def from_config(cls, config):
+        # type: (Config) -> DependencyIndex
+        if not config.cache_dir or not config.workspace_dir:
+            return None
+        dependency_index = DependencyIndex.load(config.workspace_dir,
+                                                os.path.join(config.cache_dir, DependencyIndex.FILENAME))
+        dependency_index.third_party_packages = [config.third_party_dir, config.third_party_package]
+        return dependency_index
+
+    @classmethod
+    def load(cls, root, path):
+        # type: (str, str) -> DependencyIndex
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return DependencyIndex(root, path)
+        if data.get("version") != DependencyIndex.VERSION or data.get("root") != os.path.realpath(root):
+            return DependencyIndex(root, path)
+        return DependencyIndex(root, path, {
+            str(package): {str(name): ([str(src) for src in target[0]], [str(dep) for dep in target[1]], target[2])
+                           for name, target in targets.iteritems()}
+            for package, targets in data["packages"].iteritems()})
+
+    def save(self):
+        # type: () -> None
+        try:
+            cache_dir = os.path.dirname(self.path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = "{}.{}".format(self.path, os.getpid())
+            with open(tmp_path, "w") as fp:
+                json.dump({"version": DependencyIndex.VERSION, "root": self.root, "packages": self.packages}, fp)
+            os.rename(tmp_path, self.path)
+            self.changed = False
+        except (IOError, OSError) as e:
+            self._logger.warning("failed to save the dependency index: %s", e)
+
+    def update(self, package, build_template):
+        # type: (str, BazelBuildTemplate) -> None
+        """
+        Replaces the targets of the given workspace-relative package with the targets of its BUILD file.
+        """
+        package = "" if package == os.curdir else package
+        targets = {}
+        for library in build_template.libraries:
+            targets[library.name] = self._make_target(package, library.srcs, library.deps, False)
+        for test in build_template.tests:
+            targets[test.name] = self._make_target(package, test.srcs, test.deps, True)
+        for alias in build_template.aliases:
+            targets[alias.name] = self._make_target(package, [], [alias.actual], False)
+        if self.packages.get(package) != targets:
+            self.packages[package] = targets
+            self.changed = True
+            self._targets = self._rdeps = self._targets_by_src = self._closures = None
+
+    def _make_target(self, package, srcs, deps, is_test):
+        # type: (str, list, list, bool) -> tuple
+        return ([os.path.join(package, src) for src in srcs], sorted(self._to_label(package, dep) for dep in deps),
+                is_test)
+
+    @classmethod
+    def _to_label(cls, package, dep):
+        # type: (str, str) -> str
+        if dep.startswith("//") or dep.startswith("@"):
+            return dep
+        return "//{}:{}".format(package, dep.lstrip(":"))
+
+    def tests(self, package):
+        # type: (str) -> list
+        """
+        Returns the labels of the tests in the given workspace-relative package.
+        """
+        return ["//{}:{}".format(package, name) for name, target in self.packages.get(package, {}).iteritems()
+                if target[2]]
+
+    def closures(self, labels):
+        # type: (Iterable[str]) -> dict
+        """
+        Returns the number of local files, third-party packages and other (e.g. hand-written) targets that each of the
+        given targets depends on, transitively and including its own sources, as (files, third_party, other).
+        """
+        if self._closures is None:
+            self._closures = self._compute_closures()
+        closures, third_party_mask, other_mask = self._closures
+        counts = {}
+        for label in labels:
+            closure = closures.get(label, 0)
+            third_party = closure & third_party_mask
+            other = closure & other_mask
+            files = closure & ~(third_party_mask | other_mask)
+            counts[label] = (bin(files).count("1"), bin(third_party).count("1"), bin(other).count("1"))
+        return counts
+
+    def _compute_closures(self):
+        # type: () -> (dict, long, long)
+        """
+        Computes the closures of all targets in a single pass. Every file and every target that isn't in the index is a
+        bit of a closure, so a closure is just an integer. The strongly connected components of the dependency graph
+        (import cycles) come after all components they depend on, so each closure is the union of its own bits and the
+        closures of its dependencies.
+        """
+        self._index()
+        third_party_prefixes = tuple(["@"] + ["//{}{}".format(package, separator)
+                                              for package in self.third_party_packages for separator in "/:"])
+        bits = {}
+        own = {}
+        third_party_mask, other_mask = 0, 0
+        for label, target in self._targets.iteritems():
+            mask = 0
+            for src in target[0]:
+                mask |= 1 << bits.setdefault(src, len(bits))
+            own[label] = mask
+        for label, target in self._targets.iteritems():
+            for dep in target[1]:
+                if dep in own:
+                    continue
+                own[dep] = 1 << bits.setdefault(dep, len(bits))
+                if dep.startswith(third_party_prefixes):
+                    third_party_mask |= own[dep]
+                else:
+                    other_mask |= own[dep]
+
+        def deps(label):
+            target = self._targets.get(label)
+            return target[1] if target is not None else ()
+
+        closures = {}
+        for component in strongly_connected_components(own, deps):
+            closure = 0
+            for member in component:
+                closure |= own[member]
+                for dep in deps(member):
+                    closure |= closures.get(dep, 0)
+            for member in component:
+                closures[member] = closure
+        return closures, third_party_mask, other_mask
+
+    def dependents(self, label):
+        # type: (str) -> set
+        """
+        Returns the labels of the targets that directly depend on the given target.
+        """
+        self._index()
+        return self._rdeps.get(label, set())
+
+    def is_test(self, label):
+        # type: (str) -> bool
+        self._index()
+        target = self._targets.get(label)
+        return target is not None and target[2]
+
+    def affected(self, filepaths):
+        # type: (Iterable[str]) -> set
+        """
+        Returns the labels of the targets with any of the given workspace-relative files in their sources and the labels
+        of the targets that depend on them, directly or transitively.
+        """
+        self._index()
+        pending = []
+        for filepath in filepaths:
+            labels = self._targets_by_src.get(filepath)
+            if labels is None:
+                self._logger.debug("%s isn't a source of any indexed target", filepath)
+                continue
+            pending.extend(labels)
+        affected = set(pending)
+        while pending:
+            for label in self._rdeps.get(pending.pop(), ()):
+                if label not in affected:
+                    affected.add(label)
+                    pending.append(label)
+        return affected
+
+    def _index(self):
+        # type: () -> None
+        if self._targets is not None:
+            return
+        self._targets, self._rdeps, self._targets_by_src = {}, collections.defaultdict(set), collections.defaultdict(set)
+        for package, targets in self.packages.iteritems():
+            for name, target in targets.iteritems():
+                label = "//{}:{}".format(package, name)
+                self._targets[label] = target
+                for src in target[0]:
+                    self._targets_by_src[src].add(label)
+                for dep in target[1]:
+                    self._rdeps[dep].add(label)
+
+
+class TestHistory:
+    """
+    The durations and outcomes of past runs of test targets, read from the test.xml files that Bazel writes to
+    bazel-testlogs. The directory may hold the test logs of several runs (e.g. archived by CI in a directory per run);
+    the runs of a target are found by the path of its test logs, <package>/<target>/test.xml, below any prefix. Every
+    shard and every attempt of a flaky test counts as a run of its own.
+    """
+    # Bazel's test sizes with the timeout categories they imply and their durations in seconds.
+    SIZES = [("small", "short", 60), ("medium", "moderate", 300), ("large", "long", 900), ("enormous", "eternal", 3600)]
+    DEFAULT_TIMEOUTS = {size: timeout for size, timeout, _ in SIZES}
+    PERCENTILE = 95
+    # the share of the timeout that the PERCENTILE-th percentile of the durations may use up.
+    HEADROOM = 0.5
+    RUN_DIRNAME_REGEX = re.compile(r"^(shard_\d+_of_\d+|run_\d+_of_\d+|test_attempts)$")
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, root, runs=None):
+        # type: (str, dict) -> None
+        self.root = root
+        # maps a target name to a list of (directory of the test logs relative to root, seconds, passed)
+        self.runs = runs or collections.defaultdict(list)
+
+    @classmethod
+    def load(cls, root):
+        # type: (str) -> TestHistory
+        test_history = TestHistory(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(".")]
+            for filename in filenames:
+                if filename != "test.xml" and not (filename.startswith("attempt_") and filename.endswith(".xml")):
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                run = TestHistory._read_test_xml(filepath)
+                if run is None:
+                    continue
+                components = [component for component in os.path.relpath(dirpath, root).split(os.sep)
+                              if not TestHistory.RUN_DIRNAME_REGEX.match(component)]
+                if not components or components == [os.curdir]:
+                    continue
+                test_history.runs[components[-1]].append(("/".join(components),) + run)
+        cls._logger.debug("read %d runs of %d test targets from %s",
+                sum(len(runs) for runs in test_history.runs.itervalues()), len(test_history.runs), root)
+        return test_history
+
+    @classmethod
+    def _read_test_xml(cls, filepath):
+        # type: (str) -> (float, bool)
+        try:
+            root = ElementTree.parse(filepath).getroot()
+        except (IOError, SyntaxError) as e:
+            cls._logger.debug("%s: skipped unreadable test results: %s", filepath, e)
+            return None
+        testsuites = [root] if root.tag == "testsuite" else root.findall("testsuite")
+        try:
+            if root.get("time") is not None:
+                seconds = float(root.get("time"))
+            else:
+                seconds = sum(float(testsuite.get("time", 0)) for testsuite in testsuites)
+            failures = sum(int(testsuite.get("failures", 0)) + int(testsuite.get("errors", 0))
+                           for testsuite in testsuites)
+        except ValueError:
+            return None
+        return seconds, failures == 0
+
+    def lookup(self, package, name):
+        # type: (str, str) -> list
+        """
+        Returns the (seconds, passed) of the past runs of the test target with the given name in the given
+        workspace-relative package.
+        """
+        path = "{}/{}".format(package, name) if package else name
+        return [(seconds, passed) for dirpath, seconds, passed in self.runs.get(name, ())
+                if dirpath == path or dirpath.endswith("/" + path)]
+
+    @classmethod
+    def classify(cls, durations):
+        # type: (list) -> (str, str)
+        """
+        Returns the smallest size and timeout whose timeout leaves enough headroom for the durations.
+        """
+        durations = sorted(durations)
+        percentile = durations[min(len(durations) - 1, int(len(durations) * TestHistory.PERCENTILE / 100.0))]
+        for size, timeout, seconds in TestHistory.SIZES:
+            if percentile <= seconds * TestHistory.HEADROOM:
+                return size, timeout
+        return TestHistory.SIZES[-1][:2]
+
+    @classmethod
+    def is_flaky(cls, runs):
+        # type: (list) -> bool
+        """
+        Returns whether the test both passed and failed in the past.
+        """
+        outcomes = set(passed for seconds, passed in runs)
+        return len(outcomes) > 1
+
+
 class Config:
     FILENAME = ".ramsayrc"
+    CACHE_DIRNAME = ".ramsay-cache"
+    # matches the targets of Python library rules, e.g. 'pyz_library(name = "requests", ...)'.
+    LIBRARY_RULE_REGEX = re.compile(r"""\b\w+_library\(\s*name\s*=\s*["']([^"']+)["']""")
+    # matches the distribution name of a requirement, e.g. 'requests[security]==2.18.4 \'.
+    REQUIREMENT_REGEX = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)")
+    THIRD_PARTY_CACHE_FILENAME = "third_party.json"
     DEFAULT = {
         "workspace_dir": None,
         "module_aliases": {},
@@ -539,6 +2671,7 @@ class Config:
         "manual_sizes": {},
         "manual_timeouts": {},
         "manual_flaky": {},
+        "manual_shard_counts": {},
         "pattern_deps": {},
         "header": None,
         "footer": None,
@@ -549,15 +2682,33 @@ class Config:
         "generate_shared_library": True,
         "generate_test_suite_target": True,
         "enable_debug": False,
+        "enable_cache": True,
+        "cache_dir": None,
+        "import_cache_size": 100000,
+        "target_interpreter": "python2",
+        "formatter": "starlark",
+        "merge_build_files": False,
+        "tests_per_shard": 0,
+        "max_shard_count": 16,
+        "test_results_dir": None,
+        "infer_flaky": False,
+        "max_closure_size": 0,
+        "granularity": "file",
+        "target_cost": 4,
+        "third_party_discovery": "bazel",
+        "third_party_dir": "python2/third_party",
+        "third_party_package": "python2/third_party/pypi",
     }
 
     _logger = logging.getLogger(__name__)
 
     def __init__(self, workspace_dir, module_aliases, ignored_modules, ignored_files, ignored_test_files,
             manual_imports, manual_dependencies, manual_data_dependencies, manual_tags, manual_sizes, manual_timeouts,
-            manual_flaky, pattern_deps, header, footer, third_party_modules, allow_scoped_imports,
+            manual_flaky, manual_shard_counts, pattern_deps, header, footer, third_party_modules, allow_scoped_imports,
             generate_library_targets, generate_test_targets, generate_shared_library, generate_test_suite_target,
-            enable_debug):
+            enable_debug, enable_cache, cache_dir, import_cache_size, target_interpreter, formatter, merge_build_files,
+            tests_per_shard, max_shard_count, test_results_dir, infer_flaky, max_closure_size, granularity,
+            target_cost, third_party_dir, third_party_package):
         self.workspace_dir = workspace_dir
         self.module_aliases = module_aliases
         self.ignored_modules = ignored_modules
@@ -570,6 +2721,7 @@ class Config:
         self.manual_sizes = manual_sizes
         self.manual_timeouts = manual_timeouts
         self.manual_flaky = manual_flaky
+        self.manual_shard_counts = manual_shard_counts
         self.pattern_deps = pattern_deps
         self.header = header
         self.footer = footer
@@ -580,46 +2732,45 @@ class Config:
         self.generate_shared_library = generate_shared_library
         self.generate_test_suite_target = generate_test_suite_target
         self.enable_debug = enable_debug
+        self.enable_cache = enable_cache
+        self.cache_dir = cache_dir or (workspace_dir and os.path.join(workspace_dir, Config.CACHE_DIRNAME))
+        self.import_cache_size = import_cache_size
+        self.target_interpreter = target_interpreter
+        self.formatter = formatter
+        self.merge_build_files = merge_build_files
+        self.tests_per_shard = tests_per_shard
+        self.max_shard_count = max_shard_count
+        # relative paths in .ramsayrc files are relative to the workspace directory.
+        self.test_results_dir = test_results_dir and workspace_dir and os.path.join(workspace_dir, test_results_dir)
+        self.infer_flaky = infer_flaky
+        self.max_closure_size = max_closure_size
+        if granularity not in ("file", "component"):
+            raise ValueError("unsupported granularity '{}'; use file or component".format(granularity))
+        self.granularity = granularity
+        self.target_cost = target_cost
+        self.third_party_dir = third_party_dir
+        self.third_party_package = third_party_package
 
     @classmethod
-    def from_args(cls, args):
-        # type: (argparse.Namespace) -> Config
-        args_as_dict = vars(args)
-        args_as_dict.update({
-            "third_party_modules": Config._query_bazel_for_third_party_deps()
-        })
-        cascaded_config = Config._cascade_configs(Config.DEFAULT.copy(), args_as_dict)
-        cls._logger.debug("initial configuration:")
-        for key in sorted(cascaded_config):
-            cls._logger.debug("  %s:%s", key, cascaded_config[key])
-
-        workspace_ramsayrc_filepath = os.path.join(cascaded_config["workspace_dir"], Config.FILENAME)
-        if os.path.exists(workspace_ramsayrc_filepath):
-            workspace_ramsayrc = yaml.load(open(workspace_ramsayrc_filepath))
-            cascaded_config = Config._cascade_configs(cascaded_config, workspace_ramsayrc)
-            cls._logger.debug("with workspace configuration:")
-            for key in sorted(cascaded_config):
-                cls._logger.debug("  %s:%s", key, cascaded_config[key])
-
-        dirpath_it = os.getcwd()
-        ramsayrc_filepaths = []
-
-        if not os.path.exists(os.path.join(dirpath_it, Config.FILENAME)):
-            ramsayrc_filepaths.append(("missing .ramsayrc file", Config.DEFAULT))
-            dirpath_it = os.path.realpath(os.path.join(dirpath_it, os.pardir))
-
-        while dirpath_it != cascaded_config["workspace_dir"]:
-            ramsayrc_filepath_it = os.path.join(dirpath_it, Config.FILENAME)
-            if os.path.exists(ramsayrc_filepath_it):
-                ramsayrc_filepaths.append((ramsayrc_filepath_it, yaml.load(open(ramsayrc_filepath_it))))
-            dirpath_it = os.path.realpath(os.path.join(dirpath_it, os.pardir))
-        ramsayrc_filepaths.reverse()
-
-        for (ramsayrc_filepath, ramsayrc) in ramsayrc_filepaths:
-            cascaded_config = Config._cascade_configs(cascaded_config, ramsayrc)
-            cls._logger.debug("with cascaded configuration from %s:", ramsayrc_filepath)
-            for key in sorted(cascaded_config):
-                cls._logger.debug("  %s:%s", key, cascaded_config[key])
+    def from_args(cls, args, third_party_modules=None, loader=None):
+        # type: (argparse.Namespace, dict, ConfigLoader) -> Config
+        """
+        Cascades the configuration for the current working directory. Callers that create configurations for several
+        directories can pass the already-discovered third-party modules and a ConfigLoader to avoid discovering the
+        modules and parsing the .ramsayrc files again.
+        """
+        if loader is None:
+            loader = ConfigLoader(args)
+        cascaded_config = dict(loader.cascaded_config(os.getcwd()))
+        if third_party_modules is None:
+            third_party_modules = Config.discover_third_party_modules(loader.workspace_config(),
+                                                                      args.refresh_third_party)
+        cascaded_config["third_party_modules"] = \
+            cascaded_config["third_party_modules"] + sorted(set(third_party_modules.itervalues()))
+        # discovered modules that are named differently than their targets become aliases, unless configured otherwise.
+        module_aliases = {module: target for module, target in third_party_modules.iteritems() if module != target}
+        module_aliases.update(cascaded_config["module_aliases"])
+        cascaded_config["module_aliases"] = module_aliases
 
         return Config(
                 cascaded_config["workspace_dir"],
@@ -634,6 +2785,7 @@ class Config:
                 cascaded_config["manual_sizes"],
                 cascaded_config["manual_timeouts"],
                 cascaded_config["manual_flaky"],
+                cascaded_config["manual_shard_counts"],
                 cascaded_config["pattern_deps"],
                 cascaded_config["header"],
                 cascaded_config["footer"],
@@ -643,21 +2795,51 @@ class Config:
                 cascaded_config["generate_test_targets"],
                 cascaded_config["generate_shared_library"],
                 cascaded_config["generate_test_suite_target"],
-                cascaded_config["enable_debug"])
+                cascaded_config["enable_debug"],
+                cascaded_config["enable_cache"],
+                cascaded_config["cache_dir"],
+                cascaded_config["import_cache_size"],
+                cascaded_config["target_interpreter"],
+                cascaded_config["formatter"],
+                cascaded_config["merge_build_files"],
+                cascaded_config["tests_per_shard"],
+                cascaded_config["max_shard_count"],
+                cascaded_config["test_results_dir"],
+                cascaded_config["infer_flaky"],
+                cascaded_config["max_closure_size"],
+                cascaded_config["granularity"],
+                cascaded_config["target_cost"],
+                cascaded_config["third_party_dir"],
+                cascaded_config["third_party_package"])
+
+    @classmethod
+    def load_workspace_config(cls, args):
+        # type: (argparse.Namespace) -> dict
+        """
+        Cascades the command-line arguments and the workspace's .ramsayrc file.
+        """
+        return ConfigLoader(args).workspace_config()
 
     @classmethod
     def _cascade_configs(cls, dest, src):
+        # type: (dict, dict) -> dict
+        """
+        Returns the configuration dest cascaded with the configuration src. Neither is modified, so the cascaded
+        configuration of a directory can be shared by all its subdirectories.
+        """
+        dest = dict(dest)
+
         # properties that are set only once
-        if not dest["workspace_dir"] and src["workspace_dir"]:
+        if not dest["workspace_dir"] and src.get("workspace_dir"):
             dest["workspace_dir"] = src["workspace_dir"]
 
         # properties that are inherited by merging
-        dest["module_aliases"].update(src.get("module_aliases", Config.DEFAULT["module_aliases"].copy()))
-        dest["ignored_modules"].extend(src.get("ignored_modules", Config.DEFAULT["ignored_modules"][:]))
-        dest["ignored_files"].extend(src.get("ignored_files", Config.DEFAULT["ignored_files"][:]))
-        dest["ignored_test_files"].extend(src.get("ignored_test_files", Config.DEFAULT["ignored_test_files"][:]))
-        dest["pattern_deps"].update(src.get("pattern_deps", Config.DEFAULT["pattern_deps"].copy()))
-        dest["third_party_modules"].extend(src.get("third_party_modules", Config.DEFAULT["third_party_modules"][:]))
+        for key in ("module_aliases", "pattern_deps"):
+            merged = dict(dest[key])
+            merged.update(src.get(key, Config.DEFAULT[key]))
+            dest[key] = merged
+        for key in ("ignored_modules", "ignored_files", "ignored_test_files", "third_party_modules"):
+            dest[key] = dest[key] + list(src.get(key, Config.DEFAULT[key]))
 
         # properties that are inherited by overwriting
         dest["allow_scoped_imports"] = src.get("allow_scoped_imports", dest["allow_scoped_imports"])
@@ -666,6 +2848,22 @@ class Config:
         dest["generate_shared_library"] = src.get("generate_shared_library", dest["generate_shared_library"])
         dest["generate_test_suite_target"] = src.get("generate_test_suite_target", dest["generate_test_suite_target"])
         dest["enable_debug"] = src.get("enable_debug", dest["enable_debug"])
+        dest["enable_cache"] = src.get("enable_cache", dest["enable_cache"])
+        dest["cache_dir"] = src.get("cache_dir") or dest["cache_dir"]
+        dest["import_cache_size"] = src.get("import_cache_size", dest["import_cache_size"])
+        dest["target_interpreter"] = src.get("target_interpreter", dest["target_interpreter"])
+        dest["formatter"] = src.get("formatter") or dest["formatter"]
+        dest["merge_build_files"] = src.get("merge_build_files", dest["merge_build_files"])
+        dest["tests_per_shard"] = src.get("tests_per_shard", dest["tests_per_shard"])
+        dest["max_shard_count"] = src.get("max_shard_count", dest["max_shard_count"])
+        dest["test_results_dir"] = src.get("test_results_dir") or dest["test_results_dir"]
+        dest["infer_flaky"] = src.get("infer_flaky", dest["infer_flaky"])
+        dest["max_closure_size"] = src.get("max_closure_size", dest["max_closure_size"])
+        dest["granularity"] = src.get("granularity") or dest["granularity"]
+        dest["target_cost"] = src.get("target_cost", dest["target_cost"])
+        dest["third_party_discovery"] = src.get("third_party_discovery") or dest["third_party_discovery"]
+        dest["third_party_dir"] = src.get("third_party_dir") or dest["third_party_dir"]
+        dest["third_party_package"] = src.get("third_party_package") or dest["third_party_package"]
 
         # properties that aren't modified
         dest["manual_imports"] = src.get("manual_imports", Config.DEFAULT["manual_imports"].copy())
@@ -675,33 +2873,517 @@ class Config:
         dest["manual_sizes"] = src.get("manual_sizes", Config.DEFAULT["manual_sizes"].copy())
         dest["manual_timeouts"] = src.get("manual_timeouts", Config.DEFAULT["manual_timeouts"].copy())
         dest["manual_flaky"] = src.get("manual_flaky", Config.DEFAULT["manual_flaky"].copy())
+        dest["manual_shard_counts"] = src.get("manual_shard_counts", Config.DEFAULT["manual_shard_counts"].copy())
         dest["header"] = src.get("header", Config.DEFAULT["header"])
         dest["footer"] = src.get("footer", Config.DEFAULT["footer"])
         
         return dest
 
     @classmethod
-    def _query_bazel_for_third_party_deps(cls):
-        # type: () -> set
+    def discover_third_party_modules(cls, cascaded_config, refresh=False):
+        # type: (dict, bool) -> dict
+        """
+        Returns the third-party modules, mapping every importable top-level module to the name of its third-party
+        target. They're either discovered statically (see _discover_third_party_modules_statically) or by querying
+        Bazel for the third-party targets, whose names are then assumed to be the modules.
+
+        Querying Bazel is slow, so its result is cached in the cache directory together with a fingerprint of the files
+        that define the third-party targets. Bazel is only queried again when one of these files changes or a refresh is
+        requested.
+        """
+        workspace_dir = cascaded_config["workspace_dir"]
+        third_party_dir = cascaded_config["third_party_dir"]
+        if cascaded_config["third_party_discovery"] == "static":
+            return Config._discover_third_party_modules_statically(workspace_dir, third_party_dir)
+        elif cascaded_config["third_party_discovery"] != "bazel":
+            raise ValueError("unsupported third-party discovery '{}'; use bazel or static".format(
+                cascaded_config["third_party_discovery"]))
+
+        cache_dir = cascaded_config["cache_dir"] or os.path.join(workspace_dir, Config.CACHE_DIRNAME)
+        if not cascaded_config["enable_cache"]:
+            return {dep: dep for dep in Config._query_bazel_for_third_party_deps(third_party_dir)}
+
+        cache_filepath = os.path.join(cache_dir, Config.THIRD_PARTY_CACHE_FILENAME)
+        fingerprint = Config._fingerprint_third_party_deps(workspace_dir, third_party_dir)
+        if not refresh:
+            try:
+                with open(cache_filepath) as fp:
+                    cached = json.load(fp)
+                if cached["fingerprint"] == fingerprint:
+                    cls._logger.debug("using cached third-party modules from %s", cache_filepath)
+                    return {str(module): str(module) for module in cached["modules"]}
+            except (IOError, ValueError, KeyError):
+                pass
+
+        deps = Config._query_bazel_for_third_party_deps(third_party_dir)
+        # an empty result usually means that Bazel couldn't be run; don't make that stick.
+        if deps:
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                with open(cache_filepath, "w") as fp:
+                    json.dump({"fingerprint": fingerprint, "modules": sorted(deps)}, fp)
+            except (IOError, OSError) as e:
+                cls._logger.warning("failed to cache the third-party modules: %s", e)
+        return {dep: dep for dep in deps}
+
+    @classmethod
+    def _iter_third_party_files(cls, workspace_dir, third_party_dir):
+        # type: (str, str) -> Iterator[str]
+        """
+        Yields the BUILD, .bzl and requirements files that define the third-party targets.
+        """
+        for dirpath, dirnames, filenames in os.walk(os.path.join(workspace_dir, third_party_dir)):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename in ("BUILD", "BUILD.bazel") or filename.endswith(".bzl") or \
+                        (filename.startswith("requirements") and filename.endswith(".txt")):
+                    yield os.path.join(dirpath, filename)
+
+    @classmethod
+    def _fingerprint_third_party_deps(cls, workspace_dir, third_party_dir):
+        # type: (str, str) -> str
+        """
+        Hashes the WORKSPACE file and the BUILD, .bzl and requirements files that define the third-party targets.
+        """
+        digest = hashlib.sha1()
+        filepaths = [os.path.join(workspace_dir, filename) for filename in ("WORKSPACE", "WORKSPACE.bazel")]
+        filepaths.extend(Config._iter_third_party_files(workspace_dir, third_party_dir))
+        for filepath in filepaths:
+            if not os.path.isfile(filepath):
+                continue
+            with open(filepath) as fp:
+                digest.update("{}\0{}\0".format(os.path.relpath(filepath, workspace_dir), fp.read()))
+        return digest.hexdigest()
+
+    @classmethod
+    def _query_bazel_for_third_party_deps(cls, third_party_dir):
+        # type: (str) -> set
         deps = set()
-        output = subprocess.check_output("bazel query //python2/third_party/... 2>/dev/null | cut -f2 -d: | sort", shell=True)
+        output = subprocess.check_output(
+            "bazel query //{}/... 2>/dev/null | cut -f2 -d: | sort".format(third_party_dir), shell=True)
         for line in output.split("\n"):
             if not line:
                 continue
             deps.add(line)
         return deps
 
+    @classmethod
+    def _discover_third_party_modules_statically(cls, workspace_dir, third_party_dir):
+        # type: (str, str) -> dict
+        """
+        Discovers the third-party modules without Bazel. The targets are the library rules in the BUILD and .bzl files
+        that pip_generate_wrapper generated below the third-party directory, plus the distributions pinned by its
+        requirements files (named like pip_generate_wrapper names their targets). Wheels and unpacked .dist-info or
+        .egg-info directories below the third-party directory tell which top-level modules a distribution provides
+        (e.g. bson and gridfs for pymongo); a distribution without this metadata is assumed to provide the module of
+        its name.
+        """
+        with stats.phase("third_party_static"):
+            targets = set()
+            for filepath in Config._iter_third_party_files(workspace_dir, third_party_dir):
+                with open(filepath) as fp:
+                    contents = fp.read()
+                if filepath.endswith(".txt"):
+                    for line in contents.splitlines():
+                        match = Config.REQUIREMENT_REGEX.match(line)
+                        if match is not None:
+                            targets.add(Config._to_third_party_target(match.group(1)))
+                else:
+                    targets.update(Config.LIBRARY_RULE_REGEX.findall(contents))
+
+            modules = {target: target for target in targets}
+            for distribution, top_level_modules in Config._find_top_level_modules(workspace_dir, third_party_dir):
+                target = Config._to_third_party_target(distribution)
+                if target not in targets:
+                    continue
+                for module in top_level_modules:
+                    modules.setdefault(module, target)
+            cls._logger.debug("discovered %d third-party modules of %d targets below %s", len(modules), len(targets),
+                    third_party_dir)
+            return modules
+
+    @classmethod
+    def _find_top_level_modules(cls, workspace_dir, third_party_dir):
+        # type: (str, str) -> Iterator[(str, list)]
+        """
+        Yields the distributions below the third-party directory with their top-level modules, as listed by the
+        top_level.txt file of wheels and of unpacked .dist-info and .egg-info directories.
+        """
+        for dirpath, dirnames, filenames in os.walk(os.path.join(workspace_dir, third_party_dir)):
+            dirnames.sort()
+            for dirname in dirnames:
+                if dirname.endswith((".dist-info", ".egg-info")):
+                    top_level_filepath = os.path.join(dirpath, dirname, "top_level.txt")
+                    if os.path.isfile(top_level_filepath):
+                        with open(top_level_filepath) as fp:
+                            yield dirname.rsplit(".", 1)[0].split("-")[0], Config._parse_top_level(fp.read())
+            for filename in sorted(filenames):
+                if not filename.endswith(".whl"):
+                    continue
+                try:
+                    with zipfile.ZipFile(os.path.join(dirpath, filename)) as wheel:
+                        for name in wheel.namelist():
+                            if name.endswith(".dist-info/top_level.txt"):
+                                yield filename.split("-")[0], Config._parse_top_level(wheel.read(name))
+                except (IOError, zipfile.BadZipfile) as e:
+                    cls._logger.warning("failed to read %s: %s", filename, e)
+
+    @classmethod
+    def _parse_top_level(cls, contents):
+        # type: (str) -> list
+        # top_level.txt lists a module per line; some list packages as paths, e.g. "google/protobuf".
+        return [line.strip().split("/")[0] for line in contents.splitlines() if line.strip()]
+
+    @classmethod
+    def _to_third_party_target(cls, distribution):
+        # type: (str) -> str
+        # pip_generate_wrapper names the target of a distribution like this.
+        return distribution.lower().replace("-", "_").replace(".", "_")
+
+
+class ConfigLoader:
+    """
+    Cascades the configurations of the directories of a workspace. Every .ramsayrc file is parsed only once, and the
+    cascaded configuration of a directory is derived from the one of its parent directory, which is kept in a tree keyed
+    by directory; generating many packages doesn't parse or cascade the same files over and over.
+
+    The parsed .ramsayrc files are persisted as a snapshot in the cache directory given on the command line (or the
+    default one), keyed by their mtimes and sizes. As long as none of them changed, ruamel.yaml isn't even imported.
+    """
+    FILENAME = "ramsayrc.json"
+    VERSION = 1
+
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, args, snapshot_path=None):
+        # type: (argparse.Namespace, str) -> None
+        self.args = args
+        self.snapshot_path = snapshot_path
+        self.changed = False
+        # maps the paths of .ramsayrc files to their mtimes, sizes and parsed contents.
+        self._files = {}
+        # maps directories to their cascaded configurations, not counting the reset of the non-inherited properties.
+        self._tree = {}
+        self._workspace_config = None
+        if snapshot_path:
+            self._load_snapshot()
+
+    @classmethod
+    def from_args(cls, args):
+        # type: (argparse.Namespace) -> ConfigLoader
+        return ConfigLoader(args, ConfigLoader.snapshot_path_of(args))
+
+    @classmethod
+    def snapshot_path_of(cls, args):
+        # type: (argparse.Namespace) -> str
+        # the arguments of 'ramsay serve' have no cache options; those of the requests it serves do.
+        if not getattr(args, "enable_cache", False) or not args.workspace_dir:
+            return None
+        cache_dir = os.path.abspath(args.cache_dir or os.path.join(args.workspace_dir, Config.CACHE_DIRNAME))
+        return os.path.join(cache_dir, ConfigLoader.FILENAME)
+
+    def reset(self, args=None):
+        # type: (argparse.Namespace) -> None
+        """
+        Forgets the cascaded configurations, e.g. for a run with different arguments. The parsed .ramsayrc files are
+        kept; they're parsed again only if their mtimes or sizes changed.
+        """
+        if args is not None:
+            self.args = args
+            snapshot_path = ConfigLoader.snapshot_path_of(args)
+            if snapshot_path != self.snapshot_path:
+                self.snapshot_path = snapshot_path
+                if snapshot_path and not self._files:
+                    self._load_snapshot()
+        self._tree.clear()
+        self._workspace_config = None
+
+    def workspace_config(self):
+        # type: () -> dict
+        """
+        Returns the command-line arguments cascaded with the workspace's .ramsayrc file.
+        """
+        if self._workspace_config is None:
+            cascaded_config = Config._cascade_configs(copy.deepcopy(Config.DEFAULT), dict(vars(self.args)))
+            self._log_config("initial configuration:", cascaded_config)
+            ramsayrc = self.load(os.path.join(cascaded_config["workspace_dir"], Config.FILENAME))
+            if ramsayrc is not None:
+                cascaded_config = Config._cascade_configs(cascaded_config, ramsayrc)
+                self._log_config("with workspace configuration:", cascaded_config)
+            self._workspace_config = cascaded_config
+        return self._workspace_config
+
+    def cascaded_config(self, dirpath):
+        # type: (str) -> dict
+        """
+        Returns the cascaded configuration of the given (real) directory. It's shared, so it must not be modified.
+        """
+        cascaded_config = self._cascade(dirpath)
+        if not os.path.exists(os.path.join(dirpath, Config.FILENAME)):
+            # an empty configuration resets the properties that aren't inherited (e.g. manual_imports), but keeps the
+            # inherited ones; Config.DEFAULT would reset command-line options such as --no-cache, too.
+            cascaded_config = Config._cascade_configs(cascaded_config, {})
+        return cascaded_config
+
+    def _cascade(self, dirpath):
+        # type: (str) -> dict
+        cascaded_config = self._tree.get(dirpath)
+        if cascaded_config is not None:
+            return cascaded_config
+        workspace_config = self.workspace_config()
+        # stop at the workspace directory (whose .ramsayrc was already applied) or when leaving the workspace.
+        if not dirpath.startswith(os.path.join(workspace_config["workspace_dir"], "")):
+            cascaded_config = workspace_config
+        else:
+            cascaded_config = self._cascade(os.path.realpath(os.path.join(dirpath, os.pardir)))
+            ramsayrc_filepath = os.path.join(dirpath, Config.FILENAME)
+            ramsayrc = self.load(ramsayrc_filepath)
+            if ramsayrc is not None:
+                cascaded_config = Config._cascade_configs(cascaded_config, ramsayrc)
+                self._log_config("with cascaded configuration from {}:".format(ramsayrc_filepath), cascaded_config)
+        self._tree[dirpath] = cascaded_config
+        return cascaded_config
+
+    def load(self, filepath):
+        # type: (str) -> dict
+        """
+        Returns the parsed contents of a .ramsayrc file, or None if it doesn't exist. A relative cache_dir is resolved
+        against the directory of the file.
+        """
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            return None
+        entry = self._files.get(filepath)
+        if entry is not None and entry[0] == st.st_mtime and entry[1] == st.st_size:
+            stats.count("ramsayrc.hits")
+            return entry[2]
+        stats.count("ramsayrc.misses")
+        ramsayrc = load_yaml(filepath) or {}
+        if ramsayrc.get("cache_dir"):
+            ramsayrc["cache_dir"] = os.path.join(os.path.dirname(os.path.abspath(filepath)), ramsayrc["cache_dir"])
+        self._files[filepath] = (st.st_mtime, st.st_size, ramsayrc)
+        self.changed = True
+        return ramsayrc
+
+    def save(self):
+        # type: () -> None
+        try:
+            cache_dir = os.path.dirname(self.snapshot_path)
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            tmp_path = "{}.{}".format(self.snapshot_path, os.getpid())
+            with open(tmp_path, "w") as fp:
+                json.dump({"version": ConfigLoader.VERSION, "files": self._files}, fp)
+            os.rename(tmp_path, self.snapshot_path)
+            self.changed = False
+        except (IOError, OSError, TypeError, ValueError) as e:
+            # TypeError: YAML values without a JSON equivalent (e.g. dates) can't be persisted.
+            self._logger.warning("failed to save the configuration snapshot: %s", e)
+
+    def _load_snapshot(self):
+        # type: () -> None
+        try:
+            with open(self.snapshot_path) as fp:
+                data = json.load(fp)
+        except (IOError, ValueError):
+            return
+        if data.get("version") != ConfigLoader.VERSION:
+            return
+        # JSON strings are unicode, the parsed YAML strings aren't.
+        self._files = {str(filepath): (mtime, size, to_str(ramsayrc))
+                       for filepath, (mtime, size, ramsayrc) in data["files"].iteritems()}
+
+    def _log_config(self, message, cascaded_config):
+        # type: (str, dict) -> None
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(message)
+            for key in sorted(cascaded_config):
+                self._logger.debug("  %s:%s", key, cascaded_config[key])
+
+
+class ImportCache:
+    """
+    An on-disk cache of the import statements of Python files (and of the number of their test classes and methods).
+    Entries are keyed by the hash of a file's contents and the configuration options that influence which imports are
+    extracted, so an unchanged file never has to be parsed again. The cache holds at most max_entries entries; the least
+    recently used ones are evicted first.
+    """
+    FILENAME = "imports.sqlite"
+    VERSION = 2
 
-class ImportStatement:
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._used_keys = set()
+        # the entries read or written by this process, least recently used first; bounded by max_entries, too.
+        self._records = collections.OrderedDict()
+        # the number of entries put since the last flush; the cache can only outgrow max_entries if there are any.
+        self._puts = 0
+        self._connection = sqlite3.connect(path, timeout=30)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS imports (key TEXT PRIMARY KEY, records TEXT NOT NULL, last_used REAL NOT NULL)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS imports_last_used ON imports (last_used)")
+
+    @classmethod
+    def from_config(cls, config):
+        # type: (Config) -> ImportCache
+        """
+        Opens the import cache in the configured cache directory. Returns None if caching is disabled or the cache
+        can't be opened; Ramsay then parses every file.
+        """
+        if not config.enable_cache or not config.cache_dir:
+            return None
+        try:
+            if not os.path.isdir(config.cache_dir):
+                os.makedirs(config.cache_dir)
+            return ImportCache(os.path.join(config.cache_dir, ImportCache.FILENAME), config.import_cache_size)
+        except (OSError, sqlite3.Error) as e:
+            cls._logger.warning("disabled the import cache: %s", e)
+            return None
+
+    @classmethod
+    def make_key(cls, data, allow_scoped_imports):
+        # type: (str, bool) -> str
+        return hashlib.sha1("{}:{:d}:{}".format(ImportCache.VERSION, allow_scoped_imports, data)).hexdigest()
+
+    def get(self, key):
+        # type: (str) -> (list, (int, int))
+        """
+        Returns the import records and the test count of the entry, or None if there is none.
+        """
+        entry = self._records.pop(key, None)
+        if entry is not None:
+            self._records[key] = entry
+            self.hits += 1
+            stats.count("import_cache.hits")
+            self._used_keys.add(key)
+            return entry
+        row = self._connection.execute("SELECT records FROM imports WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            stats.count("import_cache.misses")
+            return None
+        self.hits += 1
+        stats.count("import_cache.hits")
+        self._used_keys.add(key)
+        # json decodes strings as unicode; module names are plain identifiers, so they're converted back to str.
+        data = json.loads(row[0])
+        records = [tuple(str(value) if isinstance(value, unicode) else value for value in record)
+                   for record in data["imports"]]
+        entry = (records, tuple(data["tests"]))
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        # type: (str, (list, (int, int))) -> None
+        self._remember(key, entry)
+        self._puts += 1
+        records, test_count = entry
+        self._connection.execute("INSERT OR REPLACE INTO imports (key, records, last_used) VALUES (?, ?, ?)",
+                (key, json.dumps({"imports": records, "tests": test_count}), time.time()))
+
+    def _remember(self, key, entry):
+        # type: (str, (list, (int, int))) -> None
+        self._records.pop(key, None)
+        self._records[key] = entry
+        while len(self._records) > self.max_entries:
+            self._records.popitem(last=False)
+
+    def flush(self):
+        # type: () -> None
+        """
+        Records which entries were used, evicts the least recently used entries above the size limit and commits.
+        """
+        now = time.time()
+        self._connection.executemany("UPDATE imports SET last_used = ? WHERE key = ?",
+                ((now, key) for key in self._used_keys))
+        self._used_keys.clear()
+        if self._puts:
+            self._puts = 0
+            excess = self._connection.execute("SELECT COUNT(*) FROM imports").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._connection.execute(
+                    "DELETE FROM imports WHERE key IN (SELECT key FROM imports ORDER BY last_used LIMIT ?)", (excess,))
+        self._connection.commit()
+
+    def close(self):
+        # type: () -> None
+        self.flush()
+        self._connection.close()
+        self._logger.debug("import cache: %d hits, %d misses", self.hits, self.misses)
+
+
+class PatternDepsMatcher:
+    """
+    Matches file paths against all the regexes of pattern_deps in one pass. The regexes are combined into a single
+    regex of empty alternatives with lookaheads, (?:(?=(regex1))|)(?:(?=(regex2))|)..., whose groups tell which of the
+    regexes match at the start of a path. Python 2 supports at most 100 groups per regex, so the regexes are combined
+    in chunks. Regexes with groups of their own (which would shift the group numbers) or inline flags (which would
+    apply to the whole chunk) are matched separately.
+    """
+    MAX_GROUPS = 90
+
+    # compiled matchers are shared by all packages with the same pattern_deps.
+    _matchers = {}
+
+    def __init__(self, regexes):
+        # type: (list[str]) -> None
+        self.regexes = regexes
+        self._chunks = []
+        self._separate = []
+        combinable = []
+        for index, regex in enumerate(regexes):
+            compiled = re.compile(regex)
+            if compiled.groups or compiled.flags not in (0, re.UNICODE):
+                self._separate.append((index, compiled))
+            else:
+                combinable.append((index, regex))
+        for start in xrange(0, len(combinable), PatternDepsMatcher.MAX_GROUPS):
+            chunk = combinable[start:start + PatternDepsMatcher.MAX_GROUPS]
+            self._chunks.append(([index for index, regex in chunk],
+                                 re.compile("".join("(?:(?=({}))|)".format(regex) for index, regex in chunk))))
+
+    @classmethod
+    def from_regexes(cls, regexes):
+        # type: (Iterable[str]) -> PatternDepsMatcher
+        regexes = tuple(sorted(regexes))
+        matcher = cls._matchers.get(regexes)
+        if matcher is None:
+            matcher = cls._matchers[regexes] = PatternDepsMatcher(list(regexes))
+        return matcher
+
+    def match(self, filepath):
+        # type: (str) -> list[str]
+        """
+        Returns the regexes that match the given path, in sorted order.
+        """
+        indices = []
+        for chunk_indices, compiled in self._chunks:
+            groups = compiled.match(filepath).groups()
+            indices.extend(index for index, group in zip(chunk_indices, groups) if group is not None)
+        indices.extend(index for index, compiled in self._separate if compiled.match(filepath) is not None)
+        return [self.regexes[index] for index in sorted(indices)]
+
+
+class ImportStatement(object):
     TOP_LEVEL = 0
 
+    # a large package has many thousands of import statements, most of which import the same modules.
+    __slots__ = ("filepath", "module", "level", "name", "lineno", "col_offset")
+
     _logger = logging.getLogger(__name__)
 
     def __init__(self, filepath, module, level, name, lineno, col_offset):
-        self.filepath = filepath
-        self.module = module
+        self.filepath = intern_str(filepath)
+        self.module = intern_str(module)
         self.level = level
-        self.name = name
+        self.name = intern_str(name)
         self.lineno = lineno
         self.col_offset = col_offset
 
@@ -724,6 +3406,19 @@ class ImportStatement:
         else:
             return []
 
+    @classmethod
+    def from_record(cls, filepath, record):
+        # type: (str, tuple) -> ImportStatement
+        module, level, name, lineno, col_offset = record
+        return ImportStatement(filepath, module, level, name, lineno, col_offset)
+
+    def to_record(self):
+        # type: () -> tuple
+        """
+        Returns the file-independent parts of this import statement, e.g. for storing them in the ImportCache.
+        """
+        return (self.module, self.level, self.name, self.lineno, self.col_offset)
+
     @classmethod
     def synthesize(cls, filepath, module):
         # type: (str, str) -> ImportStatement
@@ -735,10 +3430,23 @@ class ImportStatement:
 
     def resolve(self, workspace):
         # type: (Workspace) -> ResolvedImport
+        """
+        Resolves this import statement. The same module is usually imported by many files, so the results are memoized
+        in the workspace, keyed by everything that resolution depends on. The memoized ResolvedImport is shared by all
+        files that import the module; only its scope and Bazel path are specific to the import.
+        """
+        key = (self.module, self.name, self.level, os.path.dirname(self.filepath))
+        resolved_import = workspace.resolved_imports.get(key)
+        if resolved_import is not None:
+            stats.count("resolved_imports.hits")
+            return resolved_import
+        stats.count("resolved_imports.misses")
         if self.level == ImportStatement.TOP_LEVEL:
-            return self._resolve_absolute_module(workspace)
+            resolved_import = self._resolve_absolute_module(workspace)
         else:
-            return self._resolve_relative_module(workspace)
+            resolved_import = self._resolve_relative_module(workspace)
+        workspace.resolved_imports[key] = resolved_import
+        return resolved_import
 
     def _resolve_absolute_module(self, workspace):
         # type: (Workspace) -> ResolvedImport
@@ -762,25 +3470,25 @@ class ImportStatement:
         # programmer's intention is to enable and disable certain features at run-time. The programmer will have to
         # further control the inclusion of the module with the ignored_modules configuration project-level configuration
         # option.
-        if workspace.is_ignored_module(self.module):
+        classification = workspace.classify_module(self.module)
+        if classification is ModuleClassifier.IGNORED:
             self._logger.debug("%s:%d:%d parsed import as skipped; it's in the list of ignored modules.",
                     self.filepath, self.lineno, self.col_offset)
             return ResolvedImport.make_skipped_import(self.filepath, self.module, self.level, self.name)
 
         # A system import is a module guaranteed to be present on every system. We can't generate a dependency for them,
         # because we don't have a facility to manage them.
-        if workspace.is_system_module(self.module):
+        if classification is ModuleClassifier.SITE:
             self._logger.debug("%s:%d:%d parsed import as site import.",
                     self.filepath, self.lineno, self.col_offset)
             return ResolvedImport.make_site_import(self.filepath, self.module, self.name)
 
         # Give highest precedence to third-party modules.
-        if workspace.is_third_party_module(self.module):
+        if classification is ModuleClassifier.THIRD_PARTY:
             self._logger.debug("%s:%d:%d parsed import as third-party import.",
                     self.filepath, self.lineno, self.col_offset)
             return ResolvedImport.make_requirement_import(
-                self.filepath, self.module, self.name,
-                "//python2/third_party/pypi:{}".format(workspace.map_to_pypi_target(self.module)))
+                self.filepath, self.module, self.name, workspace.map_to_pypi_label(self.module))
 
         position, path = workspace.map_absolute_module(self.module, self.name)
         if position is "file":
@@ -822,16 +3530,18 @@ class ImportStatement:
             raise Exception("failed to resolve module '{}'".format(self.module))
 
 
-class ResolvedImport:
+class ResolvedImport(object):
+    __slots__ = ("filepath", "module", "level", "name", "scope", "bazel_path")
+
     _logger = logging.getLogger(__name__)
 
     def __init__(self, filepath, module, level, name, scope, bazel_path):
-        self.filepath = filepath
-        self.module = module
+        self.filepath = intern_str(filepath)
+        self.module = intern_str(module)
         self.level = level
-        self.name = name
+        self.name = intern_str(name)
         self.scope = scope
-        self.bazel_path = bazel_path
+        self.bazel_path = intern_str(bazel_path)
 
     @classmethod
     def make_site_import(cls, filepath, module, name):
@@ -872,6 +3582,7 @@ class BazelBuildTemplate:
         self.libraries = []
         self.tests = []
         self.test_suites = []
+        self.aliases = []
         self.header = None
         self.footer = None
 
@@ -895,12 +3606,13 @@ class BazelBuildTemplate:
         """
         self.libraries.append(PyzLibraryTarget(name, srcs, deps, data, tags, pythonroot))
 
-    def add_test(self, name, srcs, deps=[], data=[], tags=[], size=None, timeout=None, flaky=False, pythonroot="//", interpreter_path="python2.7"):
-        # type: (str, list[str], list[str], list[str], list[str], str, str, bool) -> None
+    def add_test(self, name, srcs, deps=[], data=[], tags=[], size=None, timeout=None, flaky=False, pythonroot="//", interpreter_path="python2.7", shard_count=None):
+        # type: (str, list[str], list[str], list[str], list[str], str, str, bool, str, str, int) -> None
         """
         Adds a 'pyz_test' target to the generated BUILD file.
         """
-        self.tests.append(PyzTestTarget(name, srcs, deps, data, tags, size, timeout, flaky, pythonroot, interpreter_path))
+        self.tests.append(PyzTestTarget(name, srcs, deps, data, tags, size, timeout, flaky, pythonroot, interpreter_path,
+                                        shard_count))
 
     def add_test_suite(self, name, tags=[], tests=[]):
         # type: (str, list[str], list[str]) -> None
@@ -909,6 +3621,22 @@ class BazelBuildTemplate:
         """
         self.test_suites.append(TestSuiteTarget(name, tags, tests))
 
+    def add_alias(self, name, actual, tags=[]):
+        # type: (str, str, list[str]) -> None
+        """
+        Adds an 'alias' target to the generated BUILD file.
+        """
+        self.aliases.append(AliasTarget(name, actual, tags))
+
+    def add_tag_to_targets(self, tag):
+        # type: (str) -> None
+        """
+        Adds a tag to all 'pyz_library', 'pyz_test' and 'alias' targets. (The tags of a 'test_suite' select the tests
+        it runs, so they're left alone.)
+        """
+        for target in self.libraries + self.tests + self.aliases:
+            target.tags = sorted(set(target.tags) | {tag})
+
     def add_header(self, header):
         # type: (str) -> None
         """
@@ -924,6 +3652,8 @@ class BazelBuildTemplate:
         self.footer = footer
 
     def __str__(self):
+        # jinja2 is slow to import and only needed by the yapf formatter.
+        import jinja2
         loader = jinja2.DictLoader({
             "BUILD": """\
 #
@@ -944,6 +3674,9 @@ class BazelBuildTemplate:
 {% for library in this.libraries %}
     {%- include "pyz_library" %}
 
+{% endfor %}{% for alias in this.aliases %}
+    {%- include "alias" %}
+
 {% endfor %}{% for test in this.tests %}
     {%- include "pyz_test" %}
 
@@ -995,6 +3728,9 @@ pyz_test(
 {% if test.timeout %}
     timeout = {{ test.timeout|tojson }},
 {% endif %}
+{% if test.shard_count %}
+    shard_count = {{ test.shard_count }},
+{% endif %}
 {% if test.flaky %}
     flaky = True,
 {% endif %}
@@ -1005,6 +3741,15 @@ pyz_test(
     interpreter_path = {{ test.interpreter_path|tojson }},
 {% endif %}
 )
+""",
+            "alias": """\
+alias(
+    name = {{ alias.name|tojson }},
+    actual = {{ alias.actual|tojson }},
+{% if alias.tags %}
+    tags = {{ alias.tags|tojson }},
+{% endif %}
+)
 """,
             "test_suite": """\
 test_suite(
@@ -1023,19 +3768,441 @@ test_suite(
         return template.render(this=self)
 
 
-class StarlarkPackageStatement:
+class StarlarkEmitter:
+    """
+    Writes a BazelBuildTemplate to a stream as canonical Starlark in the style of buildifier, so the output doesn't
+    need to be reformatted.
+    """
+    INDENT = "    "
+    BANNER = ("#\n"
+              "#   This file was auto-generated by ramsay, the BUILD file generator for Python code.\n"
+              "#   DO NOT EDIT.\n"
+              "#\n")
+    MERGE_BANNER = ("#\n"
+                    "#   Targets tagged \"{}\" are maintained by ramsay, the BUILD file generator for Python code.\n"
+                    "#   All other targets are kept as they are.\n"
+                    "#\n").format(Ramsay.OWNED_TAG)
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def emit(self, build_template, banner=BANNER):
+        # type: (BazelBuildTemplate, str) -> None
+        write = self.stream.write
+        write(banner)
+        if build_template.header:
+            write("\n{}\n".format(build_template.header.rstrip("\n")))
+        if build_template.loads:
+            write("\n")
+            for module in sorted(build_template.loads):
+                macros = sorted(build_template.loads[module].macros)
+                write(self.format_load_stmt(module, [self.format_value(macro) for macro in macros]))
+        if build_template.packages:
+            write("\n")
+            for package in build_template.packages:
+                write(self.format_package_stmt(package))
+        for rule, attributes in self.iter_rules(build_template):
+            write("\n")
+            write(self.format_rule(rule, attributes))
+        if build_template.footer:
+            write("\n{}\n".format(build_template.footer.rstrip("\n")))
+
+    def iter_rules(self, build_template):
+        # type: (BazelBuildTemplate) -> Iterator[(str, list)]
+        """
+        Yields the rule and the (ordered) attributes of every target of the template. Unset attributes are omitted.
+        """
+        for library in build_template.libraries:
+            yield self._make_rule(Ramsay.LIBRARY_TARGET, [
+                ("name", library.name),
+                ("srcs", library.srcs),
+                ("deps", library.deps or None),
+                ("data", library.data or None),
+                ("tags", library.tags or None),
+                ("pythonroot", library.pythonroot or None),
+            ])
+        for alias in build_template.aliases:
+            yield self._make_rule("alias", [
+                ("name", alias.name),
+                ("actual", alias.actual),
+                ("tags", alias.tags or None),
+            ])
+        for test in build_template.tests:
+            yield self._make_rule(Ramsay.TEST_TARGET, [
+                ("name", test.name),
+                ("srcs", test.srcs),
+                ("deps", test.deps or None),
+                ("data", test.data or None),
+                ("tags", test.tags or None),
+                ("size", test.size or None),
+                ("timeout", test.timeout or None),
+                ("shard_count", test.shard_count or None),
+                ("flaky", True if test.flaky else None),
+                ("pythonroot", test.pythonroot or None),
+                ("interpreter_path", test.interpreter_path or None),
+            ])
+        for test_suite in build_template.test_suites:
+            yield self._make_rule("test_suite", [
+                ("name", test_suite.name),
+                ("tags", test_suite.tags or None),
+                ("tests", test_suite.tests or None),
+            ])
+
+    def _make_rule(self, rule, attributes):
+        # type: (str, list) -> (str, list)
+        return rule, [(key, value) for key, value in attributes if value is not None]
+
+    def format_package_stmt(self, package):
+        # type: (StarlarkPackageStatement) -> str
+        return "package({} = {})\n".format(package.property, self.format_value(package.value))
+
+    def format_load_stmt(self, module, symbols):
+        # type: (str, list) -> str
+        return "load({})\n".format(", ".join([self.format_value(module)] + list(symbols)))
+
+    def format_rule(self, rule, attributes):
+        # type: (str, list) -> str
+        if len(attributes) == 1:
+            key, value = attributes[0]
+            return "{}({} = {})\n".format(rule, key, self.format_value(value))
+        lines = ["{}(\n".format(rule)]
+        for key, value in attributes:
+            lines.append(self.format_attribute(key, value, StarlarkEmitter.INDENT))
+        lines.append(")\n")
+        return "".join(lines)
+
+    def format_attribute(self, key, value, indent):
+        # type: (str, Any, str) -> str
+        return "{}{} = {},\n".format(indent, key, self.format_value(value, indent))
+
+    def format_value(self, value, indent=""):
+        # type: (Any, str) -> str
+        if isinstance(value, bool):
+            return "True" if value else "False"
+        elif isinstance(value, (list, tuple, set)):
+            if len(value) <= 1:
+                return "[{}]".format("".join(self.format_value(item) for item in value))
+            item_indent = indent + StarlarkEmitter.INDENT
+            items = "".join("{}{},\n".format(item_indent, self.format_value(item, item_indent)) for item in value)
+            return "[\n{}{}]".format(items, indent)
+        elif isinstance(value, (int, long)):
+            return str(value)
+        else:
+            return json.dumps(value)
+
+
+class BuildFileMerger:
+    """
+    Merges the targets of a BazelBuildTemplate into the existing contents of a BUILD file. Ramsay owns the targets
+    tagged with Ramsay.OWNED_TAG (and its test suites, which are recognized by name); everything else is kept
+    verbatim. Of the owned targets, only the attributes whose values changed are rewritten, so unchanged targets stay
+    byte-for-byte the same. Owned targets that aren't generated anymore are removed and new ones are added after the
+    last owned target. A generated target never replaces a hand-written target of the same name.
+
+    In a BUILD file that was generated as a whole (ie. that starts with StarlarkEmitter.BANNER), Ramsay owns all the
+    targets of the rules it generates; merging it converts it into a merged BUILD file.
+    """
+    _logger = logging.getLogger(__name__)
+
+    def __init__(self, contents):
+        # type: (str) -> None
+        self.contents = contents
+        self.stmts = parse_starlark(contents)
+        self.emitter = StarlarkEmitter(None)
+
+    def merge(self, build_template):
+        # type: (BazelBuildTemplate) -> str
+        contents = self.contents
+        edits = []
+        generated_file = contents.startswith(StarlarkEmitter.BANNER)
+        if generated_file:
+            edits.append((0, len(StarlarkEmitter.BANNER), StarlarkEmitter.MERGE_BANNER))
+
+        rules = collections.OrderedDict()
+        for rule, attributes in self.emitter.iter_rules(build_template):
+            rules[dict(attributes)["name"]] = (rule, attributes)
+        test_suite_names = set(test_suite.name for test_suite in build_template.test_suites)
+
+        load_stmts, package_stmts, named_stmts, owned_stmts = {}, [], {}, []
+        for stmt in self.stmts:
+            if stmt.rule == "load" and stmt.args and stmt.args[0].key is None:
+                load_stmts[stmt.literal(stmt.args[0])] = stmt
+            elif stmt.rule == "package":
+                package_stmts.append(stmt)
+            name = stmt.attribute("name")
+            if not isinstance(name, basestring):
+                continue
+            named_stmts[name] = stmt
+            tags = stmt.attribute("tags")
+            if (generated_file and stmt.rule in (Ramsay.LIBRARY_TARGET, Ramsay.TEST_TARGET, "alias", "test_suite")) or \
+                    (isinstance(tags, list) and Ramsay.OWNED_TAG in tags) or \
+                    (stmt.rule == "test_suite" and name in test_suite_names):
+                owned_stmts.append((name, stmt))
+
+        anchor = None
+        for name, stmt in owned_stmts:
+            if name in rules:
+                edits.extend(self._update_target(stmt, *rules[name]))
+                anchor = stmt
+            else:
+                edits.append(self._remove_stmt(stmt))
+
+        new_rules = []
+        owned_names = set(name for name, stmt in owned_stmts)
+        for name, (rule, attributes) in rules.iteritems():
+            if name in owned_names:
+                continue
+            if name in named_stmts:
+                self._logger.warning("keeping the hand-written target '%s' instead of generating it", name)
+                continue
+            new_rules.append("\n" + self.emitter.format_rule(rule, attributes))
+        if new_rules:
+            edits.append(self._insert_after(anchor, "".join(new_rules)))
+
+        prologue = self._make_prologue(build_template, load_stmts, package_stmts)
+        if prologue:
+            edits.extend(prologue)
+        if build_template.footer and build_template.footer.strip() not in contents:
+            edits.append(self._insert_after(None, "\n{}\n".format(build_template.footer.rstrip("\n"))))
+
+        for start, end, text in sorted(edits, key=operator.itemgetter(0, 1), reverse=True):
+            contents = contents[:start] + text + contents[end:]
+        return contents
+
+    def _make_prologue(self, build_template, load_stmts, package_stmts):
+        # type: (BazelBuildTemplate, dict, list) -> list
+        """
+        Returns the edits that add the missing load statements, package statements and header.
+        """
+        edits = []
+        new_loads = []
+        for module in sorted(build_template.loads):
+            macros = build_template.loads[module].macros
+            load_stmt = load_stmts.get(module)
+            if load_stmt is None:
+                new_loads.append(self.emitter.format_load_stmt(
+                    module, [self.emitter.format_value(macro) for macro in sorted(macros)]))
+                continue
+            positional = [load_stmt.literal(arg) for arg in load_stmt.args[1:] if arg.key is None]
+            if macros.issubset(set(positional) | set(arg.key for arg in load_stmt.args)):
+                continue
+            symbols = [self.emitter.format_value(symbol) for symbol in sorted(set(positional) | macros)]
+            symbols.extend(self.contents[arg.start:arg.end] for arg in load_stmt.args[1:] if arg.key is not None)
+            edits.append((load_stmt.start, load_stmt.end, self.emitter.format_load_stmt(module, symbols).rstrip("\n")))
+
+        text = "".join(new_loads)
+        if not package_stmts and build_template.packages:
+            text += ("\n" if text or load_stmts else "") + \
+                "".join(self.emitter.format_package_stmt(package) for package in build_template.packages)
+        if build_template.header and build_template.header.strip() not in self.contents:
+            text += ("\n" if text or load_stmts else "") + "{}\n".format(build_template.header.rstrip("\n"))
+        if not text:
+            return edits
+        if load_stmts:
+            last_load_stmt = max(load_stmts.itervalues(), key=operator.attrgetter("end"))
+            position = self._line_end(last_load_stmt.end)
+        elif self.stmts:
+            position = self._line_start(self.stmts[0].start)
+            text += "\n"
+        else:
+            return edits + [self._insert_after(None, "\n" + text)]
+        edits.append((position, position, text))
+        return edits
+
+    def _update_target(self, stmt, rule, attributes):
+        # type: (StarlarkStatement, str, list) -> list
+        """
+        Returns the edits that bring an owned target up to date. Attributes are edited in place if every attribute is on
+        a line of its own; otherwise, the whole target is rewritten.
+        """
+        contents = self.contents
+        if stmt.rule != rule or not self._has_attribute_per_line(stmt):
+            text = self.emitter.format_rule(rule, attributes).rstrip("\n")
+            return [] if text == contents[stmt.start:stmt.end] else [(stmt.start, stmt.end, text)]
+
+        edits = []
+        values = dict(attributes)
+        for arg in stmt.args:
+            if arg.key not in values:
+                edits.append((self._line_start(arg.start), self._line_end(arg.end), ""))
+                continue
+            value = values[arg.key]
+            if stmt.literal(arg) == (list(value) if isinstance(value, (tuple, set)) else value):
+                continue
+            indent = contents[self._line_start(arg.start):arg.start]
+            edits.append((arg.value_start, arg.end, self.emitter.format_value(value, indent)))
+        # new attributes are inserted after the preceding attribute in the order they're emitted in.
+        args = {arg.key: arg for arg in stmt.args}
+        position = self._line_end(stmt.start)
+        for key, value in attributes:
+            if key in args:
+                position = self._line_end(args[key].end)
+                continue
+            edits.append((position, position, self.emitter.format_attribute(key, value, StarlarkEmitter.INDENT)))
+        return edits
+
+    def _has_attribute_per_line(self, stmt):
+        # type: (StarlarkStatement) -> bool
+        contents = self.contents
+        lines = [contents.count("\n", 0, stmt.start)]
+        for arg in stmt.args:
+            if arg.key is None:
+                return False
+            line = contents.count("\n", 0, arg.start)
+            # every attribute must be followed by a comma and end its line, so it can be removed as a whole.
+            if line == lines[-1] or not contents[arg.end:self._line_end(arg.end)].strip() == ",":
+                return False
+            lines.append(contents.count("\n", 0, arg.end))
+        return contents[self._line_start(stmt.end - 1):stmt.end - 1].strip() == ""
+
+    def _remove_stmt(self, stmt):
+        # type: (StarlarkStatement) -> (int, int, str)
+        start, end = self._line_start(stmt.start), self._line_end(stmt.end)
+        # remove the blank line that separated the target from the previous statement, too.
+        if self.contents[max(start - 2, 0):start] == "\n\n":
+            start -= 1
+        return (start, end, "")
+
+    def _insert_after(self, stmt, text):
+        # type: (StarlarkStatement, str) -> (int, int, str)
+        if stmt is not None:
+            position = self._line_end(stmt.end)
+            return (position, position, text)
+        if self.contents and not self.contents.endswith("\n"):
+            text = "\n" + text
+        return (len(self.contents), len(self.contents), text)
+
+    def _line_start(self, position):
+        # type: (int) -> int
+        return self.contents.rfind("\n", 0, position) + 1
+
+    def _line_end(self, position):
+        # type: (int) -> int
+        """
+        Returns the position after the newline that ends the line of the given position.
+        """
+        end = self.contents.find("\n", position)
+        return len(self.contents) if end == -1 else end + 1
+
+
+class StarlarkStatement:
+    """
+    A top-level statement of a BUILD file. For calls, like rules or load statements, rule is the name of the called
+    function and args are its arguments.
+    """
+    def __init__(self, contents, start, end, rule=None, args=()):
+        self.contents = contents
+        self.start = start
+        self.end = end
+        self.rule = rule
+        self.args = args
+
+    def attribute(self, key):
+        # type: (str) -> Any
+        """
+        Returns the value of the given keyword argument if it's a literal, or None otherwise.
+        """
+        for arg in self.args:
+            if arg.key == key:
+                return self.literal(arg)
+        return None
+
+    def literal(self, arg):
+        # type: (StarlarkArgument) -> Any
+        try:
+            return ast.literal_eval(self.contents[arg.value_start:arg.end].strip())
+        except (SyntaxError, ValueError):
+            return None
+
+
+class StarlarkArgument:
+    """
+    An argument of a call. The positions are offsets into the BUILD file; key is None for positional arguments.
+    """
+    def __init__(self, key, start, value_start, end):
+        self.key = key
+        self.start = start
+        self.value_start = value_start
+        self.end = end
+
+
+def parse_starlark(contents):
+    # type: (str) -> list
+    """
+    Splits a BUILD file into its top-level statements with Python's tokenizer, which covers the subset of Starlark that
+    BUILD files use. The arguments of calls are located, so they can be edited without reformatting anything else.
+    Raises ValueError if the contents can't be tokenized.
+    """
+    line_offsets = [0]
+    for line in contents.splitlines(True):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    stmts = []
+    tokens = []
+    try:
+        for token_type, token, start, end, _ in tokenize.generate_tokens(StringIO(contents).readline):
+            if token_type in (tokenize.COMMENT, tokenize.NL):
+                continue
+            if token_type in (tokenize.NEWLINE, tokenize.ENDMARKER, tokenize.INDENT, tokenize.DEDENT):
+                if tokens:
+                    stmts.append(_make_starlark_stmt(contents, tokens))
+                    tokens = []
+                continue
+            tokens.append((token_type, token, line_offsets[start[0] - 1] + start[1], line_offsets[end[0] - 1] + end[1]))
+    except (tokenize.TokenError, IndentationError) as e:
+        raise ValueError("failed to parse BUILD file: {}".format(e))
+    if tokens:
+        stmts.append(_make_starlark_stmt(contents, tokens))
+    return stmts
+
+
+def _make_starlark_stmt(contents, tokens):
+    # type: (str, list) -> StarlarkStatement
+    start, end = tokens[0][2], tokens[-1][3]
+    if len(tokens) < 3 or tokens[0][0] != tokenize.NAME or tokens[1][1] != "(" or tokens[-1][1] != ")":
+        return StarlarkStatement(contents, start, end)
+    args = []
+    arg_tokens = []
+    depth = 0
+    for token in tokens[2:-1] + [(tokenize.OP, ",", end, end)]:
+        if token[1] in ("(", "[", "{"):
+            depth += 1
+        elif token[1] in (")", "]", "}"):
+            depth -= 1
+        elif token[1] == "," and depth == 0:
+            if arg_tokens:
+                if len(arg_tokens) > 2 and arg_tokens[0][0] == tokenize.NAME and arg_tokens[1][1] == "=":
+                    args.append(StarlarkArgument(arg_tokens[0][1], arg_tokens[0][2], arg_tokens[2][2], arg_tokens[-1][3]))
+                else:
+                    args.append(StarlarkArgument(None, arg_tokens[0][2], arg_tokens[0][2], arg_tokens[-1][3]))
+            arg_tokens = []
+            continue
+        arg_tokens.append(token)
+    return StarlarkStatement(contents, start, end, tokens[0][1], args)
+
+
+# the statements and targets of BUILD files are kept for all packages of a recursive run, so they don't carry a __dict__.
+
+
+class StarlarkPackageStatement(object):
+    __slots__ = ("property", "value")
+
     def __init__(self, property, value):
         self.property = property
         self.value = value
 
 
-class StarlarkLoadStatement:
-    def __init__(self, module, macros=set()):
+class StarlarkLoadStatement(object):
+    __slots__ = ("module", "macros")
+
+    def __init__(self, module, macros=None):
         self.module = module
-        self.macros = macros
+        self.macros = set(macros) if macros else set()
+
 
+class PyzLibraryTarget(object):
+    __slots__ = ("name", "srcs", "deps", "data", "tags", "pythonroot")
 
-class PyzLibraryTarget:
     def __init__(self, name, srcs, deps, data, tags, pythonroot):
         self.name = name
         self.srcs = srcs
@@ -1045,8 +4212,12 @@ class PyzLibraryTarget:
         self.pythonroot = pythonroot
 
 
-class PyzTestTarget:
-    def __init__(self, name, srcs, deps, data, tags, size, timeout, flaky, pythonroot, interpreter_path):
+class PyzTestTarget(object):
+    __slots__ = ("name", "srcs", "deps", "data", "tags", "size", "timeout", "flaky", "pythonroot", "interpreter_path",
+                 "shard_count")
+
+    def __init__(self, name, srcs, deps, data, tags, size, timeout, flaky, pythonroot, interpreter_path,
+            shard_count=None):
         self.name = name
         self.srcs = srcs
         self.deps = deps
@@ -1057,15 +4228,88 @@ class PyzTestTarget:
         self.flaky = flaky
         self.pythonroot = pythonroot
         self.interpreter_path = interpreter_path
+        self.shard_count = shard_count
+
 
+class AliasTarget(object):
+    __slots__ = ("name", "actual", "tags")
+
+    def __init__(self, name, actual, tags):
+        self.name = name
+        self.actual = actual
+        self.tags = tags
+
+
+class TestSuiteTarget(object):
+    __slots__ = ("name", "tags", "tests")
 
-class TestSuiteTarget:
     def __init__(self, name, tags, tests):
         self.name = name
         self.tags = tags
         self.tests = tests
 
 
+def extract_import_records(task):
+    # type: ((str, str, bool)) -> (str, list, (int, int), int)
+    """
+    Parses a file and returns the records of its import statements and its number of test classes and methods. This is
+    the unit of work of the process pool, so it lives on the module level and takes a single, picklable argument.
+    """
+    filepath, data, allow_scoped_imports = task
+    code = ast.parse(data, filepath)
+    records = []
+    nodes_visited = stats.counters["ast_nodes_visited"]
+    for node in Ramsay.find_import_nodes(filepath, code, allow_scoped_imports):
+        records.extend(stmt.to_record() for stmt in ImportStatement.derive_from_ast_node(filepath, node))
+    return filepath, records, Ramsay.count_tests(code), stats.counters["ast_nodes_visited"] - nodes_visited
+
+
+def strongly_connected_components(nodes, deps):
+    # type: (Iterable, Callable) -> list
+    """
+    Returns the strongly connected components of a directed graph, found with Tarjan's algorithm. Every component comes
+    after all the components it depends on. The algorithm is iterative, so long import chains don't exceed the recursion
+    limit.
+    """
+    components = []
+    indices, lowlinks = {}, {}
+    stack, on_stack = [], set()
+    for root in nodes:
+        if root in indices:
+            continue
+        indices[root] = lowlinks[root] = len(indices)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(deps(root)))]
+        while work:
+            node, it = work[-1]
+            for dep in it:
+                if dep not in indices:
+                    indices[dep] = lowlinks[dep] = len(indices)
+                    stack.append(dep)
+                    on_stack.add(dep)
+                    work.append((dep, iter(deps(dep))))
+                    break
+                elif dep in on_stack:
+                    lowlinks[node] = min(lowlinks[node], indices[dep])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlinks[parent] = min(lowlinks[parent], lowlinks[node])
+                if lowlinks[node] != indices[node]:
+                    continue
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                components.append(component)
+    return components
+
+
 def to_safe_target_name(s):
     # type: (str) -> str
     s = s.lower()
@@ -1073,4 +4317,4 @@ def to_safe_target_name(s):
 
 
 if __name__ == "__main__":
-    main(sys.argv)
+    sys.exit(main(sys.argv))
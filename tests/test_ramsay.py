@@ -0,0 +1,812 @@
+"""
+Tests for ramsay. They create throwaway Bazel workspaces in a temporary directory and run ramsay in-process; run them
+from the repository root with:
+
+  python2 -m unittest discover -s tests
+"""
+import argparse
+import ast
+import os
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "ramsay"))
+
+import ramsay  # noqa: E402
+
+
+class WorkspaceTestCase(unittest.TestCase):
+    """
+    Sets up an empty workspace whose third-party modules are discovered statically, so no Bazel is needed.
+    """
+
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp(prefix="ramsay-test-"))
+        self.addCleanup(shutil.rmtree, self.root)
+        cwd = os.getcwd()
+        self.addCleanup(os.chdir, cwd)
+        self.write("WORKSPACE", "")
+        self.write(".ramsayrc", "third_party_discovery: static\n")
+
+    def write(self, path, contents):
+        # type: (str, str) -> str
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as fp:
+            fp.write(contents)
+        return path
+
+    def read(self, path):
+        # type: (str) -> str
+        with open(os.path.join(self.root, path)) as fp:
+            return fp.read()
+
+    def parse_args(self, *argv):
+        # type: (*str) -> argparse.Namespace
+        return ramsay.parse_args(["ramsay", "--workspace-dir", self.root, "--no-daemon"] + list(argv))
+
+    def make_generator(self, *argv):
+        # type: (*str) -> ramsay.BuildFileGenerator
+        generator = ramsay.BuildFileGenerator(self.parse_args(*(argv or ("--recursive", self.root))))
+        self.addCleanup(generator.close)
+        return generator
+
+    def run_ramsay(self, *argv):
+        # type: (*str) -> int
+        """
+        Runs ramsay recursively over the whole workspace in a fresh process.
+        """
+        args = self.parse_args(*(argv + ("--recursive", self.root)))
+        generator = ramsay.BuildFileGenerator(args)
+        try:
+            return ramsay.run(args, generator)
+        finally:
+            generator.close()
+
+    def generate(self, package, *argv):
+        # type: (str, *str) -> str
+        """
+        Returns the BUILD file of a package as generated by a fresh process.
+        """
+        dirpath = os.path.join(self.root, package)
+        filepaths = sorted(filename for filename in os.listdir(dirpath) if filename.endswith(".py"))
+        generator = ramsay.BuildFileGenerator(self.parse_args(*(argv + ("--recursive", self.root))))
+        try:
+            return generator.generate(dirpath, filepaths)
+        finally:
+            generator.close()
+
+    def write_packages(self):
+        # type: () -> None
+        """
+        Writes two packages; pkg_a has a test file, pkg_b doesn't.
+        """
+        self.write("pkg_a/__init__.py", "")
+        self.write("pkg_a/a.py", "import os\n")
+        self.write("pkg_a/test_a.py", "import pkg_a.a\n")
+        self.write("pkg_b/__init__.py", "")
+        self.write("pkg_b/b.py", "import os\n")
+
+    def load_stmt(self, contents):
+        # type: (str) -> str
+        return [line for line in contents.splitlines() if line.startswith("load(")][0]
+
+
+class LoadStatementTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write_packages()
+
+    def test_load_symbols_dont_leak_between_packages(self):
+        expected = self.generate("pkg_b")
+        self.assertEqual('load("{}", "pyz_library")'.format(ramsay.Ramsay.RULESET), self.load_stmt(expected))
+
+        generator = self.make_generator()
+        generator.generate(os.path.join(self.root, "pkg_a"), ["__init__.py", "a.py", "test_a.py"])
+        self.assertEqual(expected, generator.generate(os.path.join(self.root, "pkg_b"), ["__init__.py", "b.py"]))
+
+    def test_recursive_run_matches_per_package_runs(self):
+        expected = self.generate("pkg_b")
+        self.assertEqual(0, self.run_ramsay())
+        self.assertEqual(expected, self.read("pkg_b/BUILD.bazel"))
+
+
+class ImportCacheTest(unittest.TestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp(prefix="ramsay-test-")
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.import_cache = ramsay.ImportCache(os.path.join(cache_dir, ramsay.ImportCache.FILENAME), 2)
+        self.addCleanup(self.import_cache.close)
+
+    def keys(self):
+        # type: () -> list
+        return sorted(row[0] for row in self.import_cache._connection.execute("SELECT key FROM imports"))
+
+    def test_flush_evicts_the_least_recently_used_entries(self):
+        self.import_cache.put("a", ([], (0, 0)))
+        self.import_cache.put("b", ([], (0, 0)))
+        self.import_cache.flush()
+        time.sleep(0.01)
+        self.import_cache.get("a")
+        self.import_cache.put("c", ([], (0, 0)))
+        self.import_cache.flush()
+        self.assertEqual(["a", "c"], self.keys())
+
+    def test_flush_without_new_entries_doesnt_evict(self):
+        self.import_cache.put("a", ([], (0, 0)))
+        self.import_cache.put("b", ([], (0, 0)))
+        self.import_cache.flush()
+        self.import_cache.max_entries = 1
+        self.import_cache.flush()
+        self.assertEqual(["a", "b"], self.keys())
+
+    def test_entries_kept_in_memory_are_bounded(self):
+        self.import_cache.put("a", ([("os", 0, None, 1, 0)], (0, 0)))
+        self.import_cache.put("b", ([], (0, 0)))
+        self.import_cache.put("c", ([], (0, 0)))
+        self.assertEqual(["b", "c"], list(self.import_cache._records))
+        self.assertEqual(([("os", 0, None, 1, 0)], (0, 0)), self.import_cache.get("a"))
+        self.assertEqual(["c", "a"], list(self.import_cache._records))
+
+
+class CacheDirTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write_packages()
+        os.chdir(self.root)
+
+    def cache_dirs(self):
+        # type: () -> list
+        return sorted(os.path.relpath(dirpath, self.root) for dirpath, dirnames, filenames in os.walk(self.root)
+                      if ramsay.ImportCache.FILENAME in filenames)
+
+    def test_recursive_run_uses_one_relative_cache_dir(self):
+        self.assertEqual(0, self.run_ramsay("--cache-dir", "cache"))
+        self.assertEqual(["cache"], self.cache_dirs())
+
+    def test_relative_cache_dir_of_ramsayrc_is_resolved_against_its_directory(self):
+        self.write(".ramsayrc", "third_party_discovery: static\ncache_dir: rc-cache\n")
+        os.chdir(os.path.join(self.root, "pkg_a"))
+        self.assertEqual(0, self.run_ramsay())
+        self.assertEqual(["rc-cache"], self.cache_dirs())
+
+
+class ConfigCascadeTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("app/.ramsayrc", "allow_scoped_imports: true\nheader: '# app'\nmanual_imports: {a.py: [os]}\n")
+        self.write("app/a.py", "")
+        self.write("app/pkg/a.py", "")
+
+    def config(self, package, *argv):
+        # type: (str, *str) -> ramsay.Config
+        os.chdir(os.path.join(self.root, package))
+        return ramsay.Config.from_args(self.parse_args(*(argv + ("a.py",))))
+
+    def test_directory_with_ramsayrc(self):
+        config = self.config("app", "--no-cache", "--granularity", "component")
+        self.assertFalse(config.enable_cache)
+        self.assertEqual("component", config.granularity)
+        self.assertTrue(config.allow_scoped_imports)
+        self.assertEqual("# app", config.header)
+        self.assertEqual({"a.py": ["os"]}, config.manual_imports)
+
+    def test_directory_without_ramsayrc_keeps_inherited_properties(self):
+        # Config.DEFAULT used to be cascaded here, which reset these to True, file and False.
+        config = self.config("app/pkg", "--no-cache", "--granularity", "component")
+        self.assertFalse(config.enable_cache)
+        self.assertEqual("component", config.granularity)
+        self.assertTrue(config.allow_scoped_imports)
+
+    def test_directory_without_ramsayrc_resets_properties_that_arent_inherited(self):
+        config = self.config("app/pkg")
+        self.assertIsNone(config.header)
+        self.assertEqual({}, config.manual_imports)
+
+
+class ParallelParsingTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("pkg/__init__.py", "")
+        for i in xrange(40):
+            self.write("pkg/m{:02d}.py".format(i), "import os\nimport pkg.m{:02d}\n".format((i + 1) % 40))
+        self.write("pkg/test_m00.py", "import unittest\nimport pkg.m00\n")
+
+    def test_parallel_output_is_identical_to_serial_output(self):
+        self.assertEqual(self.generate("pkg", "--no-cache"), self.generate("pkg", "--no-cache", "-j", "2"))
+
+    def test_syntax_error_points_at_the_file(self):
+        filepath = self.write("pkg/m07.py", "def f(:\n")
+        with self.assertRaises(SyntaxError) as cm:
+            self.generate("pkg", "--no-cache", "-j", "2")
+        self.assertEqual(filepath, os.path.join(self.root, "pkg", cm.exception.filename))
+        self.assertEqual(1, cm.exception.lineno)
+
+
+class ScopedImportsTest(WorkspaceTestCase):
+    CODE = "\n".join([
+        "import pkg.a",
+        "try:",
+        "    import pkg.b",
+        "except ImportError:",
+        "    pass",
+        "if TYPE_CHECKING:",
+        "    import pkg.c",
+        "def f():",
+        "    import pkg.d",
+        "class C(object):",
+        "    def f(self):",
+        "        if True:",
+        "            import pkg.e",
+        "",
+    ])
+
+    def modules(self, allow_scoped_imports):
+        # type: (bool) -> list
+        import_nodes = ramsay.Ramsay.find_import_nodes("x.py", ast.parse(self.CODE), allow_scoped_imports)
+        return sorted(alias.name for node in import_nodes for alias in node.names)
+
+    def test_default_mode_uses_only_top_level_imports(self):
+        # imports in if/try blocks, like "if TYPE_CHECKING:", are indented, so they count as scoped imports.
+        self.assertEqual(["pkg.a"], self.modules(False))
+
+    def test_default_mode_matches_the_full_walk(self):
+        expected = sorted(alias.name for node in ast.walk(ast.parse(self.CODE))
+                          if isinstance(node, ast.Import) and node.col_offset == ramsay.ImportStatement.TOP_LEVEL
+                          for alias in node.names)
+        self.assertEqual(expected, self.modules(False))
+
+    def test_scoped_imports_are_used_when_allowed(self):
+        self.assertEqual(["pkg.a", "pkg.b", "pkg.c", "pkg.d", "pkg.e"], self.modules(True))
+
+    def test_generated_deps(self):
+        self.write("pkg/__init__.py", "")
+        for module in "abcde":
+            self.write("pkg/{}.py".format(module), "")
+        self.write("pkg/x.py", self.CODE)
+        contents = self.generate("pkg")
+        self.assertEqual(["a"], [module for module in "abcde" if '"//pkg:{}_py"'.format(module) in contents])
+        contents = self.generate("pkg", "--allow-scoped-imports")
+        self.assertEqual(list("abcde"), [module for module in "abcde" if '"//pkg:{}_py"'.format(module) in contents])
+
+
+class ModuleIndexTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("a/b/c.py", "")
+        self.write("d/e/f.py", "")
+        self.module_index = ramsay.ModuleIndex(self.root, path=os.path.join(self.root, ".ramsay-cache", "modules.json"))
+
+    def lookup(self, path):
+        # type: (str) -> (str, str)
+        return self.module_index.lookup(os.path.join(self.root, path))
+
+    def test_lookup_scans_only_the_directories_on_its_path(self):
+        self.assertEqual(("file", os.path.join(self.root, "a/b/c.py")), self.lookup("a/b/c"))
+        self.assertEqual(("dir", os.path.join(self.root, "a/b")), self.lookup("a/b"))
+        self.assertEqual((None, None), self.lookup("a/x/y"))
+        self.assertEqual(["", "a", "a/b"], sorted(self.module_index.dirs))
+
+    def test_lookup_sees_changes_after_invalidation(self):
+        self.assertEqual((None, None), self.lookup("a/b/g"))
+        self.write("a/b/g.py", "")
+        self.write("a/h/__init__.py", "")
+        shutil.rmtree(os.path.join(self.root, "d"))
+        self.module_index.invalidate()
+        self.assertEqual(("file", os.path.join(self.root, "a/b/g.py")), self.lookup("a/b/g"))
+        self.assertEqual(("dir", os.path.join(self.root, "a/h")), self.lookup("a/h"))
+        self.assertEqual((None, None), self.lookup("d/e/f"))
+
+    def test_flush_saves_the_scanned_directories(self):
+        self.lookup("d/e/f")
+        self.module_index.flush()
+        self.assertFalse(self.module_index.changed)
+        self.assertEqual(self.module_index.dirs, ramsay.ModuleIndex.load(self.root, self.module_index.path).dirs)
+
+
+class StarlarkEmitterTest(unittest.TestCase):
+    RULES = ["load", "package", "pyz_library", "pyz_test", "test_suite"]
+
+    def setUp(self):
+        self.build_template = ramsay.BazelBuildTemplate()
+        self.build_template.add_load_stmt("//tools:defs.bzl", "my_macro")
+        self.build_template.add_load_stmt(ramsay.Ramsay.RULESET, "pyz_test")
+        self.build_template.add_load_stmt(ramsay.Ramsay.RULESET, "pyz_library")
+        self.build_template.add_library(name="a_py", srcs=["a.py"], deps=["//x:y_py", "//x:z_py", "b_py"], data=[],
+                                        tags=['say "hi"', "back\\slash"])
+        self.build_template.add_library(name="python_shared_library", deps=["a_py"])
+        self.build_template.add_test(name="test_a_py", srcs=["test_a.py"], deps=["a_py"], size="small", flaky=True)
+        self.build_template.add_test_suite(name="python_test_suite")
+
+    def emit(self):
+        # type: () -> str
+        stream = ramsay.StringIO()
+        ramsay.StarlarkEmitter(stream).emit(self.build_template)
+        return stream.getvalue()
+
+    def calls(self, contents):
+        # type: (str) -> (set, list)
+        """
+        Evaluates a BUILD file and returns its load statements and, in order, the other calls with their arguments.
+        """
+        calls = []
+        namespace = {rule: (lambda rule: lambda *args, **kwargs: calls.append((rule, args, kwargs)))(rule)
+                     for rule in self.RULES}
+        exec compile(contents, "BUILD.bazel", "exec") in namespace
+        loads = set((args[0], frozenset(args[1:])) for rule, args, kwargs in calls if rule == "load")
+        return loads, [call for call in calls if call[0] != "load"]
+
+    def test_emitted_build_file(self):
+        self.assertEqual("\n".join([
+            "#",
+            "#   This file was auto-generated by ramsay, the BUILD file generator for Python code.",
+            "#   DO NOT EDIT.",
+            "#",
+            "",
+            'load("//tools:defs.bzl", "my_macro")',
+            'load("{}", "pyz_library", "pyz_test")'.format(ramsay.Ramsay.RULESET),
+            "",
+            'package(default_visibility = ["//visibility:public"])',
+            "",
+            "pyz_library(",
+            '    name = "a_py",',
+            '    srcs = ["a.py"],',
+            "    deps = [",
+            '        "//x:y_py",',
+            '        "//x:z_py",',
+            '        "b_py",',
+            "    ],",
+            "    tags = [",
+            r'        "say \"hi\"",',
+            r'        "back\\slash",',
+            "    ],",
+            '    pythonroot = "//",',
+            ")",
+            "",
+            "pyz_library(",
+            '    name = "python_shared_library",',
+            "    srcs = [],",
+            '    deps = ["a_py"],',
+            '    pythonroot = "//",',
+            ")",
+            "",
+            "pyz_test(",
+            '    name = "test_a_py",',
+            '    srcs = ["test_a.py"],',
+            '    deps = ["a_py"],',
+            '    size = "small",',
+            "    flaky = True,",
+            '    pythonroot = "//",',
+            '    interpreter_path = "python2.7",',
+            ")",
+            "",
+            'test_suite(name = "python_test_suite")',
+            "",
+        ]), self.emit())
+
+    def test_emitted_build_file_is_equivalent_to_the_yapf_formatted_one(self):
+        from yapf.yapflib.yapf_api import FormatCode
+        formatted, changed = FormatCode(str(self.build_template))
+        self.assertEqual(self.calls(formatted), self.calls(self.emit()))
+
+
+class UpdateBuildFileTest(WorkspaceTestCase):
+    def mode(self, path):
+        # type: (str) -> int
+        return stat.S_IMODE(os.stat(os.path.join(self.root, path)).st_mode)
+
+    def test_new_build_file_is_readable_by_everyone(self):
+        ramsay.update_build_file(os.path.join(self.root, "BUILD.bazel"), "# new\n", False)
+        self.assertEqual("# new\n", self.read("BUILD.bazel"))
+        self.assertEqual(0o644, self.mode("BUILD.bazel"))
+
+    def test_updated_build_file_keeps_its_mode(self):
+        os.chmod(self.write("BUILD.bazel", "# old\n"), 0o664)
+        ramsay.update_build_file(os.path.join(self.root, "BUILD.bazel"), "# new\n", False)
+        self.assertEqual("# new\n", self.read("BUILD.bazel"))
+        self.assertEqual(0o664, self.mode("BUILD.bazel"))
+
+
+class RegenerateTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write_packages()
+
+    def test_regenerated_build_files_dont_depend_on_earlier_packages(self):
+        expected = self.generate("pkg_b")
+        generator = self.make_generator("--watch", self.root)
+        build_filepaths = generator.regenerate([os.path.join(self.root, "pkg_a"), os.path.join(self.root, "pkg_b")])
+        self.assertEqual([os.path.join(self.root, package, "BUILD.bazel") for package in ("pkg_a", "pkg_b")],
+                         build_filepaths)
+        self.assertEqual(expected, self.read("pkg_b/BUILD.bazel"))
+        self.assertEqual('load("{}", "pyz_library")'.format(ramsay.Ramsay.RULESET), self.load_stmt(expected))
+
+
+class RamsayServerTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write_packages()
+        socket_dir = tempfile.mkdtemp(prefix="ramsay-test-")
+        self.addCleanup(shutil.rmtree, socket_dir)
+        self.socket_path = os.path.join(socket_dir, "ramsay.sock")
+        self.addCleanup(os.umask, os.umask(0o022))
+        self.server = ramsay.RamsayServer(
+            self.socket_path, argparse.Namespace(workspace_dir=self.root, jobs=1, enable_debug=False))
+        thread = threading.Thread(target=self.serve)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+
+    def serve(self):
+        # type: () -> None
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def request(self, package, *filenames):
+        # type: (str, *str) -> str
+        response = ramsay.RamsayClient.request(self.socket_path, {
+            "command": "run",
+            "argv": ["--workspace-dir", self.root] + list(filenames),
+            "cwd": os.path.join(self.root, package)
+        })
+        self.assertEqual(0, response["status"], response.get("stderr"))
+        return response["stdout"]
+
+    def test_socket_is_private(self):
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(self.socket_path).st_mode))
+        self.assertEqual(0o022, os.umask(0o022))
+
+    def test_responses_dont_depend_on_earlier_requests(self):
+        expected = self.request("pkg_b", "__init__.py", "b.py")
+        self.assertIn('load("{}", "pyz_library")\n'.format(ramsay.Ramsay.RULESET), expected)
+        self.request("pkg_a", "__init__.py", "a.py", "test_a.py")
+        self.assertEqual(expected, self.request("pkg_b", "__init__.py", "b.py"))
+
+
+class StatsTest(unittest.TestCase):
+    def test_nested_phases_are_left_out_of_the_outer_phase(self):
+        stats = ramsay.Stats()
+        with stats.phase("outer"):
+            with stats.phase("inner"):
+                time.sleep(0.05)
+            with stats.phase("inner"):
+                time.sleep(0.05)
+        self.assertEqual(2, stats.phases["inner"]["calls"])
+        self.assertGreaterEqual(stats.phases["inner"]["wall_seconds"], 0.1)
+        self.assertEqual(1, stats.phases["outer"]["calls"])
+        self.assertLess(stats.phases["outer"]["wall_seconds"], 0.05)
+
+
+class DependencyIndexTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write_packages()
+        self.path = os.path.join(self.root, ramsay.Config.CACHE_DIRNAME, ramsay.DependencyIndex.FILENAME)
+
+    def test_generator_saves_the_dependency_index(self):
+        self.generate("pkg_a")
+        self.assertEqual(["pkg_a"], sorted(ramsay.DependencyIndex.load(self.root, self.path).packages))
+
+    def test_generator_doesnt_save_the_dependency_index_in_check_mode(self):
+        self.generate("pkg_a", "--check")
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_generator_doesnt_save_the_dependency_index_without_cache(self):
+        self.generate("pkg_a", "--no-cache")
+        self.assertFalse(os.path.exists(self.path))
+
+
+class BuildFileMergerTest(WorkspaceTestCase):
+    HAND_WRITTEN = "\n".join([
+        "# Hand-written rules; keep them.",
+        'load("//tools:defs.bzl", "my_macro")',
+        "",
+        "my_macro(",
+        '    name = "generated_py",  # writes generated.py',
+        '    srcs = ["template.py.in"],',
+        ")",
+        "",
+    ])
+    STALE = "\n".join([
+        "pyz_library(",
+        '    name = "stale_py",',
+        '    srcs = ["stale.py"],',
+        '    tags = ["{}"],'.format(ramsay.Ramsay.OWNED_TAG),
+        ")",
+        "",
+    ])
+    BINARY = "\n".join([
+        "# The binary is maintained by hand.",
+        "pyz_binary(",
+        '    name = "main",',
+        '    deps = [":a_py"],',
+        ")",
+        "",
+    ])
+
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("pkg/a.py", "import pkg.b\n")
+        self.write("pkg/b.py", "")
+        self.write("pkg/BUILD.bazel", self.HAND_WRITTEN + "\n" + self.STALE + "\n" + self.BINARY)
+
+    def names(self):
+        # type: () -> list
+        return [stmt.attribute("name") for stmt in ramsay.parse_starlark(self.read("pkg/BUILD.bazel"))
+                if stmt.attribute("name") is not None]
+
+    def test_parse_starlark(self):
+        contents = self.read("pkg/BUILD.bazel")
+        stmts = ramsay.parse_starlark(contents)
+        self.assertEqual(["load", "my_macro", "pyz_library", "pyz_binary"], [stmt.rule for stmt in stmts])
+        self.assertEqual(self.HAND_WRITTEN[self.HAND_WRITTEN.index("my_macro("):].rstrip(),
+                         contents[stmts[1].start:stmts[1].end])
+        self.assertEqual(["template.py.in"], stmts[1].attribute("srcs"))
+
+    def test_merge_keeps_hand_written_rules_and_comments(self):
+        self.assertEqual(0, self.run_ramsay("--merge", "-w"))
+        contents = self.read("pkg/BUILD.bazel")
+        self.assertTrue(contents.startswith(self.HAND_WRITTEN[:self.HAND_WRITTEN.index("\n\n")]))
+        self.assertIn(self.HAND_WRITTEN[self.HAND_WRITTEN.index("my_macro("):], contents)
+        self.assertIn(self.BINARY, contents)
+
+    def test_merge_adds_owned_targets_and_removes_stale_ones(self):
+        self.assertEqual(0, self.run_ramsay("--merge", "-w"))
+        self.assertEqual(["generated_py", "main", "a_py", "b_py", "python_shared_library"], self.names())
+        self.assertNotIn("stale", self.read("pkg/BUILD.bazel"))
+
+    def test_merge_is_idempotent(self):
+        self.assertEqual(0, self.run_ramsay("--merge", "-w"))
+        contents = self.read("pkg/BUILD.bazel")
+        self.assertEqual(0, self.run_ramsay("--merge", "--check"))
+        self.assertEqual(0, self.run_ramsay("--merge", "-w"))
+        self.assertEqual(contents, self.read("pkg/BUILD.bazel"))
+
+    def test_malformed_build_file_is_left_alone(self):
+        for contents in ('pyz_library(\n    name = "a_py",\n', ")\n", 'x = """\n'):
+            self.write("pkg/BUILD.bazel", contents)
+            self.assertEqual(1, self.run_ramsay("--merge", "-w"))
+            self.assertEqual(contents, self.read("pkg/BUILD.bazel"))
+
+
+class ShardCountTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("pkg/test_a.py", "".join(
+            ["import unittest\n", "class ATest(unittest.TestCase):\n"] +
+            ["    def test_{}(self):\n        pass\n".format(i) for i in xrange(5)] +
+            ["class BTest(unittest.TestCase):\n", "    def test_b(self):\n        pass\n"] +
+            ["def test_c():\n    pass\n"]))
+
+    def shard_count(self, ramsayrc):
+        # type: (str) -> int
+        self.write("pkg/.ramsayrc", ramsayrc)
+        match = re.search(r"shard_count = (\d+),", self.generate("pkg"))
+        return int(match.group(1)) if match else None
+
+    def test_test_methods_are_counted(self):
+        self.assertEqual((2, 7), ramsay.Ramsay.count_tests(ast.parse(self.read("pkg/test_a.py"))))
+
+    def test_no_shards_by_default(self):
+        self.assertIsNone(self.shard_count("{}\n"))
+
+    def test_shard_count_from_tests_per_shard(self):
+        self.assertEqual(4, self.shard_count("tests_per_shard: 2\n"))
+        self.assertEqual(2, self.shard_count("tests_per_shard: 5\n"))
+        self.assertIsNone(self.shard_count("tests_per_shard: 7\n"))
+
+    def test_shard_count_is_capped(self):
+        self.assertEqual(3, self.shard_count("tests_per_shard: 1\nmax_shard_count: 3\n"))
+
+    def test_manual_shard_count_takes_precedence(self):
+        self.assertEqual(5, self.shard_count("tests_per_shard: 2\nmanual_shard_counts: {test_a.py: 5}\n"))
+
+
+class TestHistoryTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("pkg/test_a.py", "")
+        self.write_test_xml("run_1/pkg/test_test_a_py/test.xml", 10, 0)
+        self.write_test_xml("run_2/pkg/test_test_a_py/test.xml", 200, 1)
+        self.write_test_xml("run_1/pkg/test_test_b_py/shard_1_of_2/test.xml", 20, 0)
+        self.write_test_xml("run_1/pkg/test_test_b_py/shard_2_of_2/test.xml", 30, 0)
+        self.write_test_xml("run_1/pkg/test_test_b_py/test_attempts/attempt_1.xml", 40, 1)
+        self.write_test_xml("run_1/other/test_test_b_py/test.xml", 1000, 0)
+        self.write("results/run_1/pkg/test_test_c_py/test.xml", "<testsuites><testsuite time=")
+        self.write("results/run_1/pkg/test_test_d_py/test.xml", '<testsuite time="fast" failures="0"/>')
+        self.write("results/run_1/pkg/test_test_e_py/test.log", "")
+        self.test_history = ramsay.TestHistory.load(os.path.join(self.root, "results"))
+
+    def write_test_xml(self, path, seconds, failures):
+        # type: (str, float, int) -> None
+        self.write(os.path.join("results", path),
+                   '<testsuites><testsuite name="t" time="{}" failures="{}" errors="0"/></testsuites>'.format(
+                       seconds, failures))
+
+    def test_lookup(self):
+        self.assertEqual([(10.0, True), (200.0, False)], sorted(self.test_history.lookup("pkg", "test_test_a_py")))
+        self.assertEqual([(20.0, True), (30.0, True), (40.0, False)],
+                         sorted(self.test_history.lookup("pkg", "test_test_b_py")))
+        self.assertEqual([(1000.0, True)], self.test_history.lookup("other", "test_test_b_py"))
+
+    def test_garbled_or_missing_test_results_are_skipped(self):
+        for name in ("test_test_c_py", "test_test_d_py", "test_test_e_py", "test_test_f_py"):
+            self.assertEqual([], self.test_history.lookup("pkg", name))
+        self.assertEqual({}, ramsay.TestHistory.load(os.path.join(self.root, "missing")).runs)
+
+    def test_classify(self):
+        self.assertEqual(("small", "short"), ramsay.TestHistory.classify([1, 2, 30]))
+        self.assertEqual(("medium", "moderate"), ramsay.TestHistory.classify([31]))
+        self.assertEqual(("large", "long"), ramsay.TestHistory.classify([10, 200]))
+        self.assertEqual(("enormous", "eternal"), ramsay.TestHistory.classify([5000]))
+        # the outliers above the 95th percentile don't count.
+        self.assertEqual(("small", "short"), ramsay.TestHistory.classify([1] * 96 + [1000] * 4))
+
+    def test_is_flaky(self):
+        self.assertTrue(ramsay.TestHistory.is_flaky([(10, True), (200, False)]))
+        self.assertFalse(ramsay.TestHistory.is_flaky([(10, True), (200, True)]))
+
+    def test_generated_test_target(self):
+        self.write("pkg/.ramsayrc", "infer_flaky: true\n")
+        contents = self.generate("pkg", "--test-results", os.path.join(self.root, "results"))
+        self.assertIn('name = "test_test_a_py",\n    srcs = ["test_a.py"],\n    size = "large",\n    flaky = True,',
+                      contents)
+        self.assertIn('name = "python_large_test_suite",\n    tests = [":test_test_a_py"],', contents)
+
+    def test_manual_size_takes_precedence(self):
+        self.write("pkg/.ramsayrc", "manual_sizes: {test_a.py: small}\n")
+        contents = self.generate("pkg", "--test-results", os.path.join(self.root, "results"))
+        self.assertIn('name = "test_test_a_py",\n    srcs = ["test_a.py"],\n    size = "small",\n', contents)
+        self.assertNotIn("flaky", contents)
+
+
+class LibraryGroupingTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("pkg/x.py", "import pkg.y\n")
+        self.write("pkg/y.py", "import pkg.x\n")
+        self.write("pkg/z.py", "import pkg.x\n")
+        self.write("pkg/test_z.py", "import pkg.z\n")
+        self.write("pkg/.ramsayrc", "granularity: component\n")
+
+    def test_test_libraries_arent_grouped(self):
+        contents = self.generate("pkg")
+        self.assertIn('name = "x_py_group",', contents)
+        self.assertIn('srcs = [\n        "x.py",\n        "y.py",\n        "z.py",\n    ],', contents)
+        self.assertIn('pyz_library(\n    name = "test_z_py",\n    srcs = ["test_z.py"],\n    deps = ["//pkg:x_py_group"],',
+                      contents)
+        self.assertIn('alias(\n    name = "z_py",\n    actual = ":x_py_group",\n)', contents)
+        self.assertNotIn("test_z_py_group", contents)
+        self.assertIn('name = "python_shared_library",\n    srcs = [],\n    deps = ["x_py_group"],', contents)
+
+
+class ConfigLoaderTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("app/.ramsayrc", "header: '# app'\n")
+        self.write("app/pkg/a.py", "")
+        loader = self.loader()
+        self.assertEqual("# app", self.header(loader))
+        loader.save()
+
+    def loader(self):
+        # type: () -> ramsay.ConfigLoader
+        return ramsay.ConfigLoader.from_args(self.parse_args("--recursive", self.root))
+
+    def header(self, loader=None, package="app"):
+        # type: (ramsay.ConfigLoader, str) -> str
+        """
+        Returns the header of a package, as cascaded by the given loader or by a new one that starts from the snapshot.
+        """
+        ramsay.stats.reset()
+        return (loader or self.loader()).cascaded_config(os.path.join(self.root, package))["header"]
+
+    def test_snapshot_is_used_while_nothing_changed(self):
+        self.assertEqual("# app", self.header())
+        self.assertEqual(0, ramsay.stats.counters["ramsayrc.misses"])
+
+    def test_snapshot_is_invalidated_when_a_ramsayrc_changes(self):
+        self.write("app/.ramsayrc", "header: '# changed'\n")
+        self.assertEqual("# changed", self.header())
+        self.assertEqual(1, ramsay.stats.counters["ramsayrc.misses"])
+
+    def test_snapshot_is_invalidated_when_only_the_mtime_of_a_ramsayrc_changes(self):
+        os.utime(self.write("app/.ramsayrc", "header: '# APP'\n"), (0, 0))
+        self.assertEqual("# APP", self.header())
+
+    def test_snapshot_is_invalidated_when_a_ramsayrc_is_added(self):
+        self.assertIsNone(self.header(package="app/pkg"))
+        self.write("app/pkg/.ramsayrc", "header: '# pkg'\n")
+        self.assertEqual("# pkg", self.header(package="app/pkg"))
+
+
+class PatternDepsMatcherTest(unittest.TestCase):
+    REGEXES = [
+        r"app/",
+        r"app/core/",
+        r"app/core/.*\.py$",
+        r"^app/web",
+        r".*models",
+        r"models",
+        r"x*",
+        r"app/(core|web)/",
+        r"lib/(?P<name>\w+)/(?P=name)",
+        r"(?i)APP/",
+        r"app/[^/]+/test_",
+        r"nothing",
+    ]
+    FILEPATHS = ["app/core/models.py", "app/core/test_models.py", "app/web/views.py", "lib/utils/utils.py",
+                 "lib/utils/helpers.py", "models.py", "APP/x.py", "other/app/x.py", ""]
+
+    def assertMatchesLikeReMatch(self, regexes, filepaths):
+        matcher = ramsay.PatternDepsMatcher.from_regexes(regexes)
+        for filepath in filepaths:
+            self.assertEqual([regex for regex in sorted(regexes) if re.match(regex, filepath)], matcher.match(filepath),
+                             filepath)
+
+    def test_matches_like_re_match(self):
+        self.assertMatchesLikeReMatch(self.REGEXES, self.FILEPATHS)
+
+    def test_no_match(self):
+        self.assertEqual([], ramsay.PatternDepsMatcher.from_regexes(["nothing", "(no)thing"]).match("app/x.py"))
+
+    def test_regexes_are_combined_in_chunks(self):
+        regexes = ["d{}/".format(i) for i in xrange(2 * ramsay.PatternDepsMatcher.MAX_GROUPS + 1)]
+        self.assertMatchesLikeReMatch(regexes + self.REGEXES, self.FILEPATHS + ["d0/x.py", "d150/x.py", "d180/"])
+
+
+class StaticThirdPartyDiscoveryTest(WorkspaceTestCase):
+    def setUp(self):
+        WorkspaceTestCase.setUp(self)
+        self.write("python2/third_party/pypi/BUILD", "\n".join([
+            'pyz_library(name = "pymongo", deps = [])',
+            'pyz_library(\n    name = "python_dateutil",\n)',
+            'pyz_library(name = "requests")',
+            'pyz_library(name = "pyyaml")',
+            "",
+        ]))
+        self.write("python2/third_party/pypi/BUILD.bazel", 'pyz_library(name = "protobuf")\n')
+        self.write("python2/third_party/requirements.txt", "Django==1.11.8 \\\n    --hash=sha256:0\n# comment\n")
+        self.write("python2/third_party/pypi/pymongo-3.4.0.dist-info/top_level.txt", "bson\ngridfs\npymongo\n")
+        self.write("python2/third_party/pypi/python_dateutil-2.6.1.egg-info/top_level.txt", "dateutil\n")
+        # PyYAML provides the yaml module, but without top_level.txt there's no telling.
+        self.write("python2/third_party/pypi/PyYAML-3.12.dist-info/METADATA", "")
+        self.write("python2/third_party/pypi/unused-1.0.dist-info/top_level.txt", "unused\n")
+        with zipfile.ZipFile(os.path.join(self.root, "python2/third_party/pypi/protobuf-3.5.1-py2-none-any.whl"),
+                             "w") as wheel:
+            wheel.writestr("protobuf-3.5.1.dist-info/top_level.txt", "google/protobuf\n")
+
+    def test_discovery(self):
+        self.assertEqual({
+            "bson": "pymongo",
+            "gridfs": "pymongo",
+            "pymongo": "pymongo",
+            "dateutil": "python_dateutil",
+            "python_dateutil": "python_dateutil",
+            "requests": "requests",
+            "pyyaml": "pyyaml",
+            "django": "django",
+            "google": "protobuf",
+            "protobuf": "protobuf",
+        }, ramsay.Config._discover_third_party_modules_statically(self.root, "python2/third_party"))
+
+    def test_generated_deps(self):
+        self.write("pkg/a.py", "import bson\nimport dateutil.parser\nimport google.protobuf\n")
+        self.assertIn('deps = [\n        "//python2/third_party/pypi:protobuf",\n'
+                      '        "//python2/third_party/pypi:pymongo",\n'
+                      '        "//python2/third_party/pypi:python_dateutil",\n    ],', self.generate("pkg"))
+
+
+
+if __name__ == "__main__":
+    unittest.main()